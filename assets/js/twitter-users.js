@@ -0,0 +1,97 @@
+// Loads the rest of the followers/following list as the page is scrolled.
+//
+// The page itself only has the first page of users in it. The rest are in pages of JSON in
+// assets/js/data/users, listed in the index in assets/js/data/users.js, (both written by the parser's
+// UserPages) and each one is only fetched when the bottom of the list comes into view.
+(function () {
+    var list = document.querySelector('.twitter-list[data-users]');
+    if (!list || typeof users === 'undefined' || !('IntersectionObserver' in window)) {
+        return;
+    }
+    var mode = list.dataset.users;              // 'followers' or 'following'
+    var baseUrl = list.dataset.baseUrl || '';
+    var dataUrl = list.dataset.dataUrl;
+    var index = users[mode];
+    var next = list.querySelectorAll('.twitter-user').length;       // The next user to show
+    var loading = false;
+
+    function escapeHtml(text) {
+        return String(text).replace(/[&<>"']/g, function (c) {
+            return { '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;' }[c];
+        });
+    }
+
+    // As Jekyll's relative_url: the baseurl and the path, with a single '/' between them.
+    function relativeUrl(path) {
+        return baseUrl.replace(/\/+$/, '') + '/' + path.replace(/^\/+/, '');
+    }
+
+    // The parser points the emojis in descriptions at /assets/images/emoji/, without the baseurl.
+    function emojiUrls(description) {
+        return description.split('src="/assets/images/emoji/').join('src="' + relativeUrl('/assets/images/emoji/'));
+    }
+
+    // As _includes/twitter-user.html.
+    function renderUser(user) {
+        var url = escapeHtml(user.url || '');
+        var name = escapeHtml(user.screen_name || '');
+        var imageName = name + '\'s profile image';
+        var avatar;
+        if (user.local_url) {
+            avatar = '<img src="' + escapeHtml(relativeUrl(user.local_url)) + '"';
+            if (user.avatar_variants) {
+                avatar += ' srcset="' + user.avatar_variants.map(function (variant) {
+                    return escapeHtml(relativeUrl(variant.url)) + ' ' + variant.width + 'w';
+                }).join(', ') + '" sizes="48px"';
+            }
+            avatar += ' loading="lazy" class="avatar" alt="' + imageName + '" title="' + imageName + '" />';
+        } else {
+            avatar = '<img src="' + escapeHtml(relativeUrl('/assets/images/defaultAvatar.svg')) + '" alt="' + imageName + '" title="' + imageName + '" />';
+        }
+        var followsYou = (mode == 'following' && user.follower) ? '<span class="follower">Follows you</span>' : '';
+        return '<article class="twitter-user"><header>'
+            + '<a href="' + url + '" target="_blank">' + avatar + '</a>'
+            + '<section class="name">'
+            + '<a href="' + url + '" target="_blank">' + name + '</a>'
+            + '<a href="' + url + '" target="_blank" class="handle">@' + escapeHtml(user.username) + followsYou + '</a>'
+            + '</section></header>'
+            + (user.description ? '<p>' + emojiUrls(user.description) + '</p>' : '')     // Already sanitised by the parser
+            + '</article>';
+    }
+
+    var sentinel = document.createElement('div');
+    list.parentNode.insertBefore(sentinel, list.nextSibling);
+    var observer = new IntersectionObserver(function (entries) {
+        if (entries[0].isIntersecting) {
+            loadMore();
+        }
+    }, { rootMargin: '1000px' });
+
+    function loadMore() {
+        if (loading) {
+            return;
+        }
+        if (next >= index.count) {
+            observer.disconnect();
+            return;
+        }
+        loading = true;
+        var page = Math.floor(next / users.page_size);
+        fetch(dataUrl + index.pages[page])
+            .then(function (response) { return response.json(); })
+            .then(function (pageUsers) {
+                var start = next - page * users.page_size;
+                list.insertAdjacentHTML('beforeend', pageUsers.slice(start).map(renderUser).join(''));
+                next = page * users.page_size + pageUsers.length;
+                loading = false;
+                // Observing again checks straight away whether the end of the list is still in view.
+                observer.unobserve(sentinel);
+                observer.observe(sentinel);
+            })
+            .catch(function () {
+                loading = false;
+            });
+    }
+
+    observer.observe(sentinel);
+})();
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+# Benchmarks for the download code, run against a local stand-in for Twitter's servers (see
+# lib/stand_in_server.py), so nothing goes out to the internet. For each way the parser fetches things,
+# it reports how many requests a second and MB a second we managed, and how long requests took
+# (median, 95th and 99th percentile, and the slowest).
+#
+#   python benchmark.py
+#   python benchmark.py --latency 0.1 --bandwidth 500 --failure-rate 0.05 --throttle-rate 20
+#
+# Run `python benchmark.py --help` for all the options.
+
+from lib.link_resolver import LinkResolver
+from lib.network import AdaptiveRateController, Downloader
+from lib.stand_in_server import StandInServer
+from lib.utils import UriLoader
+import argparse
+import os
+import re
+import tempfile
+import time
+
+# The settings UriLoader and the Downloader need, without loading (or creating) config.json.
+class BenchmarkConfig:
+
+    def __init__(self, workers):
+        self.user_agent = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/'
+        self.download_workers = workers
+        self.host_requests_per_second = 0
+        self.sleep_time = 0
+
+# The timings for one download path.
+class BenchmarkResult:
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.succeeded = 0
+        self.failed = 0
+        self.bytes = 0
+        self.elapsed = 0
+
+    def record(self, latency, success, size = 0):
+        self.latencies.append(latency)
+        if success:
+            self.succeeded += 1
+            self.bytes += size
+        else:
+            self.failed += 1
+
+    def percentile(self, percent):
+        if not self.latencies:
+            return 0
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))]
+
+    def as_row(self):
+        requests = self.succeeded + self.failed
+        return (f'{self.name:<18} {requests:>6} {self.failed:>6} {self.elapsed:>8.2f} {requests / self.elapsed:>8.1f} '
+                f'{self.bytes / self.elapsed / 2**20:>7.2f} {self.percentile(50) * 1000:>7.0f} {self.percentile(95) * 1000:>7.0f} '
+                f'{self.percentile(99) * 1000:>7.0f} {max(self.latencies, default=0) * 1000:>7.0f}')
+
+    @staticmethod
+    def header():
+        return (f'{"path":<18} {"reqs":>6} {"failed":>6} {"secs":>8} {"req/s":>8} {"MB/s":>7} '
+                f'{"p50 ms":>7} {"p95 ms":>7} {"p99 ms":>7} {"max ms":>7}')
+
+# Wraps a function so each call's time goes into the result.
+def timed(function, result, size_of):
+    def timed_function(*args, **kwargs):
+        start = time.monotonic()
+        value = function(*args, **kwargs)
+        success, size = size_of(value)
+        result.record(time.monotonic() - start, success, size)
+        return value
+    return timed_function
+
+def loader_size(loader):
+    if not loader.success:
+        return False, 0
+    if loader.filename:
+        return True, os.path.getsize(loader.filename)
+    return True, len(loader.data.content) if loader.data is not None and not loader.head else 0
+
+# The old way: one UriLoader at a time, each held in memory.
+def benchmark_uri_loader(server, config, args, output_directory):
+    result = BenchmarkResult('uri_loader')
+    def load(url):
+        loader = UriLoader(url, config)
+        loader.load()
+        return loader
+    load = timed(load, result, loader_size)
+    start = time.monotonic()
+    for index in range(args.files):
+        load(server.url(f'/media/file-{index}.jpg?size={args.size * 1024}'))
+    result.elapsed = time.monotonic() - start
+    return result
+
+# As __download_missing_media: streamed to disk, a few at a time, through a pooled session.
+def benchmark_media_downloads(server, config, args, output_directory):
+    result = BenchmarkResult('media_downloads')
+    jobs = [(index, server.url(f'/media/file-{index}.jpg?size={args.size * 1024}'), os.path.join(output_directory, f'media-{index}.jpg'))
+            for index in range(args.files)]
+    start = time.monotonic()
+    with Downloader(config) as downloader:
+        downloader.fetch = timed(downloader.fetch, result, loader_size)
+        for key, loader in downloader.fetch_all(jobs):
+            pass
+    result.elapsed = time.monotonic() - start
+    return result
+
+# As __save_users_avatars: lots of users, sharing a smaller number of distinct avatars.
+def benchmark_avatars(server, config, args, output_directory):
+    result = BenchmarkResult('avatars')
+    distinct_avatars = max(1, args.users // 4)
+    avatar_urls = set(server.url(f'/avatar/avatar-{user % distinct_avatars}.png') for user in range(args.users))
+    jobs = [(url, url, os.path.join(output_directory, f'avatar-{index}.download')) for index, url in enumerate(sorted(avatar_urls))]
+    start = time.monotonic()
+    with Downloader(config) as downloader:
+        downloader.fetch = timed(downloader.fetch, result, loader_size)
+        for key, loader in downloader.fetch_all(jobs):
+            pass
+    result.elapsed = time.monotonic() - start
+    return result
+
+# As __get_user_profile: a full GET of the t.co page, and the target pulled out of its <title>.
+def benchmark_tco_profile(server, config, args, output_directory):
+    result = BenchmarkResult('tco_profile')
+    def resolve(url):
+        loader = UriLoader(url, config)
+        loader.load()
+        return loader.success and bool(re.findall('<title>(.*)<\\/title>', str(loader.data.content)))
+    resolve = timed(resolve, result, lambda success: (success, 0))
+    start = time.monotonic()
+    for index in range(args.links):
+        resolve(server.url(f'/t.co/link{index}'))
+    result.elapsed = time.monotonic() - start
+    return result
+
+# As step 3a: HEAD requests for the redirects, a few at a time. (The link cache is left empty, so every
+# link is looked up.)
+def benchmark_link_resolver(server, config, args, output_directory):
+    result = BenchmarkResult('link_resolver')
+    resolver = LinkResolver(config, os.path.join(output_directory, 'link_cache.json'))
+    resolver.resolve = timed(resolver.resolve, result, lambda target: (target is not None, 0))
+    LinkResolver.SHORTENER_HOSTS = LinkResolver.SHORTENER_HOSTS + [server.base_url.split('//')[1]]
+    start = time.monotonic()
+    resolver.resolve_all([server.url(f'/t.co/link{index}') for index in range(args.links)])
+    result.elapsed = time.monotonic() - start
+    return result
+
+BENCHMARKS = {
+    'uri_loader': benchmark_uri_loader,
+    'media_downloads': benchmark_media_downloads,
+    'avatars': benchmark_avatars,
+    'tco_profile': benchmark_tco_profile,
+    'link_resolver': benchmark_link_resolver,
+}
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the download code against a local stand-in server.')
+    parser.add_argument('paths', nargs='*', help='Which paths to run, from: ' + ', '.join(BENCHMARKS) + '. (Default: all of them.)')
+    parser.add_argument('--files', type=int, default=100, help='Media files to download.')
+    parser.add_argument('--size', type=int, default=256, help='Size of each media file, in KB.')
+    parser.add_argument('--users', type=int, default=400, help='Users, for the avatar benchmark.')
+    parser.add_argument('--links', type=int, default=100, help='t.co links to resolve.')
+    parser.add_argument('--workers', type=int, default=4, help='Downloads to run at once.')
+    parser.add_argument('--rate', type=float, default=1000, help='Starting requests per second for the rate controller.')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds the server waits before each answer.')
+    parser.add_argument('--bandwidth', type=float, default=None, help='KB/s the server sends each response at.')
+    parser.add_argument('--throttle-rate', type=float, default=None, help='Requests/s the server allows before sending 429s.')
+    parser.add_argument('--failure-rate', type=float, default=0, help='Fraction of requests the server fails with a 503.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the failures, so runs can be compared.')
+    args = parser.parse_args()
+    for name in args.paths:
+        if name not in BENCHMARKS:
+            parser.error(f'unknown path: {name}')
+
+    config = BenchmarkConfig(args.workers)
+    bandwidth = args.bandwidth * 1024 if args.bandwidth else None
+    print(BenchmarkResult.header())
+    with StandInServer(args.latency, bandwidth, args.throttle_rate, args.failure_rate, seed=args.seed) as server:
+        for name in args.paths or list(BENCHMARKS):
+            # Each path gets a fresh rate controller, and no HTTP cache, so they all start from the same place.
+            UriLoader.http_cache = None
+            UriLoader.rate_controller = AdaptiveRateController(args.rate, args.workers)
+            server.reset_counters()
+            with tempfile.TemporaryDirectory() as output_directory:
+                result = BENCHMARKS[name](server, config, args, output_directory)
+            print(result.as_row() + f'   (server: {server.requests} requests, {server.throttled} throttled, {server.failed} failed)')
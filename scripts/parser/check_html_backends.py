@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+# Checks that the HTML backends (see Utils.select_html_backend) pull the same users out of a saved
+# followers or following page: the same ids, usernames, screen names, descriptions and avatars, in the
+# same order. Prints any differences, and how long each backend took.
+#
+#   python check_html_backends.py followers.html
+#   python check_html_backends.py following.html --timeline "Timeline: Following" --users <output folder>/assets/js/data/users.js
+#
+# The ids are looked up from the usernames in the users pages from a previous run, if you give the
+# users.js index they're listed in. (See UserPages.)
+
+from lib.page_parser import UserCell
+from lib.user_pages import UserPages
+from lib.utils import Utils
+import argparse
+import os
+import sys
+import time
+
+FIELDS = ['id', 'username', 'screen_name', 'description', 'follow_state', 'avatar_url']
+
+# Every user on the page, as read by one backend.
+def read_users(page_filename, timeline_label, backend, user_ids):
+    users = []
+    for cell_html in UserCell.stream(page_filename, timeline_label, backend):
+        username, screen_name, description, follow_state, avatar_url = UserCell.extract(cell_html, backend)
+        user_id = user_ids.get(username.lower()) if username else None
+        users.append(dict(zip(FIELDS, [user_id, username, screen_name, description, follow_state, avatar_url])))
+    return users
+
+def read_user_ids(users_filename):
+    if not users_filename:
+        return {}
+    users_data = UserPages(os.path.dirname(users_filename), None).read_users()
+    return { user['username'].lower(): user['id'] for user in users_data if user.get('username') }
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Check the HTML backends read the same users from a saved followers/following page.')
+    parser.add_argument('page', help='The saved followers or following page.')
+    parser.add_argument('--timeline', default='Timeline: Followers', help='The aria-label of the timeline on the page.')
+    parser.add_argument('--users', default=None, help='The users.js index from a previous run, to look the user ids up in.')
+    args = parser.parse_args()
+
+    if Utils.select_html_backend('lxml') != 'lxml':
+        sys.exit(1)
+    user_ids = read_user_ids(args.users)
+    results = {}
+    for backend in Utils.HTML_BACKENDS:
+        start = time.monotonic()
+        results[backend] = read_users(args.page, args.timeline, backend, user_ids)
+        print(f'{backend:<12} {len(results[backend]):>6} users in {time.monotonic() - start:.2f}s')
+
+    differences = 0
+    expected, actual = results['html.parser'], results['lxml']
+    if len(expected) != len(actual):
+        print(f'Different numbers of users: {len(expected)} with html.parser, {len(actual)} with lxml.')
+        differences += 1
+    for index, (expected_user, actual_user) in enumerate(zip(expected, actual)):
+        for field in FIELDS:
+            if expected_user[field] != actual_user[field]:
+                differences += 1
+                print(f'User {index} ({expected_user["username"]}), {field}:')
+                print(f'    html.parser: {expected_user[field]!r}')
+                print(f'    lxml:        {actual_user[field]!r}')
+    if differences:
+        print(f'{differences} differences.')
+        sys.exit(1)
+    print('The backends agree.')
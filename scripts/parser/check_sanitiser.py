@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+# Checks that Utils.sanitise_html (see HtmlSanitiser) gives exactly what the Beautiful Soup version it
+# replaced did, on the descriptions from saved followers/following pages, a set of awkward examples, and
+# as many randomly put together bits of HTML as you ask for. Prints any differences, and the timings.
+#
+#   python check_sanitiser.py followers.html following.html
+#   python check_sanitiser.py --random 10000
+
+from bs4 import BeautifulSoup, MarkupResemblesLocatorWarning
+from lib.page_parser import UserCell
+from lib.utils import HtmlSanitiser, Utils
+import argparse
+import random
+import sys
+import time
+import warnings
+
+# How descriptions come out of UserCell.extract, plus the corners of HTML that trip tokenizers up.
+EXAMPLES = [
+    'Just a description',
+    'Tea &amp; biscuits &lt;3 &copy; &nbsp;&#8212; &#x1F600; &#147;quoted&#148; &bogus; &amp',
+    'Emoji <img src=\\"data:image/svg+xml;base64,PHN2Zz48L3N2Zz4=\\"/> and more <img src=\\"data:image/svg+xml;base64,PHN2Zz48L3N2Zz4=\\"/>',
+    '<a href=\\"https://example.com/path\\">https://example.com/path</a> and @<a href=\\"https://x.com/someone\\">someone</a>',
+    '<a href="https://example.com" class="css-1" target="_blank" rel="noopener" dir="ltr">link</a>',
+    '<img src="a.png" alt="An &quot;image&quot;" class="r-4qtqp9" draggable="false"/>',
+    '<img src=\'it\'s\' alt="both \' and &quot;">',
+    '<span class="x">unclosed <b>bold <i>italic</span> after',
+    'stray </div> end </a> tags',
+    '<br> line<br/>breaks<br /><hr>',
+    '<span/>self-closing non-void<div />',
+    '<!-- a comment --> text <!DOCTYPE html> <?pi thing?> <![CDATA[x < y]]>',
+    'AT&T, R&D, &copy &copy; &COPY; &#0; &#xD800; &#1114112; &#; &#x;',
+    '<script>if (a < b && c > d) {}</script><style>a > b {}</style>',
+    '<A HREF="UPPER" CLASS="case">Upper case</A>',
+    '<a href>no value</a><a href="">empty</a><input disabled>',
+    '<a href="1" href="2" class="c">duplicate attributes</a>',
+    'Line one\nLine two<br/>\u00a0non-breaking\u200dzero width',
+    '<p>para<p>another para',
+    'a < b > c & d',
+    '',
+]
+
+FRAGMENTS = ['text', ' ', '&amp;', '&lt;', '&#39;', '&nbsp;', '<', '>', '"', "'", '\\"', '<a href="x" class="y">', '</a>',
+             '<img src="s" alt="t" class="c"/>', '<img src=\\"u\\"/>', '<span>', '</span>', '<div class="d">', '</div>',
+             '<br>', '<br/>', '<b>', '</i>', '<!--c-->', '\n', '@user', 'https://t.co/x']
+
+# The Beautiful Soup version of Utils.sanitise_html, as it was.
+def sanitise_html_with_soup(html):
+    html_parser = BeautifulSoup(html, 'html.parser')
+    a_tags = html_parser.find_all('a')
+    if a_tags:
+        allow_attributes = ['href', 'target']
+        for tag in a_tags:
+            tag.attrs = {key: value for key, value in tag.attrs.items()
+                    if key in allow_attributes}
+    img_tags = html_parser.find_all('img')
+    if img_tags:
+        allow_attributes = ['src', 'alt']
+        for tag in img_tags:
+            tag.attrs = {key: value for key, value in tag.attrs.items()
+                    if key in allow_attributes}
+    return str(html_parser)
+
+# The descriptions from a saved page, as they are before sanitising.
+def read_descriptions(page_filename, timeline_label):
+    descriptions = []
+    sanitise_html = Utils.sanitise_html
+    def record_description(html):
+        descriptions.append(html)
+        return html
+    Utils.sanitise_html = record_description
+    try:
+        for cell_html in UserCell.stream(page_filename, timeline_label):
+            UserCell.extract(cell_html)
+    finally:
+        Utils.sanitise_html = sanitise_html
+    return descriptions
+
+def random_html(generator):
+    return ''.join(generator.choice(FRAGMENTS) for count in range(generator.randint(1, 30)))
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Check the HTML sanitiser against the Beautiful Soup version it replaced.')
+    parser.add_argument('pages', nargs='*', help='Saved followers or following pages to take descriptions from.')
+    parser.add_argument('--random', type=int, default=1000, help='Random bits of HTML to try.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the random HTML.')
+    args = parser.parse_args()
+    warnings.filterwarnings('ignore', category=MarkupResemblesLocatorWarning)
+
+    corpus = list(EXAMPLES)
+    for page_filename in args.pages:
+        for timeline_label in ['Timeline: Followers', 'Timeline: Following']:
+            corpus += read_descriptions(page_filename, timeline_label)
+    generator = random.Random(args.seed)
+    corpus += [random_html(generator) for count in range(args.random)]
+
+    start = time.monotonic()
+    expected = [sanitise_html_with_soup(html) for html in corpus]
+    soup_time = time.monotonic() - start
+    start = time.monotonic()
+    actual = [HtmlSanitiser().sanitise(html) for html in corpus]
+    sanitiser_time = time.monotonic() - start
+    start = time.monotonic()
+    cached = [Utils.sanitise_html(html) for html in corpus]
+    cached_time = time.monotonic() - start
+
+    differences = 0
+    for html, expected_html, actual_html, cached_html in zip(corpus, expected, actual, cached):
+        if expected_html != actual_html or actual_html != cached_html:
+            differences += 1
+            print(f'Input:          {html!r}')
+            print(f'  Beautiful Soup: {expected_html!r}')
+            print(f'  HtmlSanitiser:  {actual_html!r}')
+    print(f'{len(corpus)} descriptions. Beautiful Soup {soup_time:.2f}s, HtmlSanitiser {sanitiser_time:.2f}s, '
+          f'Utils.sanitise_html (cached) {cached_time:.2f}s.')
+    if differences:
+        print(f'{differences} differences.')
+        sys.exit(1)
+    print('The sanitisers agree.')
@@ -17,6 +17,7 @@ class Config:
         self.output_threads_folder_name = None
         self.output_json_folder_name = None
         self.output_media_url_base = None
+        self.output_emoji_url_base = None
         self.output_assets_folder = None
         self.output_assets_images_folder = None
         self.output_posts = None
@@ -36,6 +37,25 @@ class Config:
         self.jekyll_config_filename = None
         self.user_agent = None
         self.sleep_time = None
+        self.media_store_folder = None
+        self.media_store_max_size = None
+        self.hash_cache_filename = None
+        self.retry_queue_filename = None
+        self.link_cache_filename = None
+        self.page_cache_filename = None
+        self.avatar_index_filename = None
+        self.sharded_media_layout = False
+        self.make_image_variants = False
+        self.upgrade_media_quality = False
+        self.html_parser = None
+        self.parser_workers = None
+        self.image_workers = None
+        self.download_workers = None
+        self.host_requests_per_second = None
+        self.http_cache_folder = None
+        self.http_cache_max_size = None
+        self.http_cache_max_age_days = None
+        self.offline = False
         
         self.config_filename = 'config.json'
         if not self.load():     # if the config file doesn't exist, create it with the following defaults
@@ -67,6 +87,8 @@ class Config:
             self.output_json_folder_name = self.data['output_json_folder_name']
         if 'output_media_url_base' in self.data:
             self.output_media_url_base = self.data['output_media_url_base']
+        if 'output_emoji_url_base' in self.data:
+            self.output_emoji_url_base = self.data['output_emoji_url_base']
         if 'output_assets_folder' in self.data:
             self.output_assets_folder = self.data['output_assets_folder']
         if 'output_assets_images_folder' in self.data:
@@ -107,6 +129,44 @@ class Config:
             self.sleep_time = self.data['sleep_time']
         if 'download_media' in self.data:
             self.download_media = self.data['download_media']
+        if 'media_store_folder' in self.data:
+            self.media_store_folder = self.data['media_store_folder']
+        if 'media_store_max_size' in self.data:
+            self.media_store_max_size = self.data['media_store_max_size']
+        if 'hash_cache_filename' in self.data:
+            self.hash_cache_filename = self.data['hash_cache_filename']
+        if 'retry_queue_filename' in self.data:
+            self.retry_queue_filename = self.data['retry_queue_filename']
+        if 'link_cache_filename' in self.data:
+            self.link_cache_filename = self.data['link_cache_filename']
+        if 'page_cache_filename' in self.data:
+            self.page_cache_filename = self.data['page_cache_filename']
+        if 'avatar_index_filename' in self.data:
+            self.avatar_index_filename = self.data['avatar_index_filename']
+        if 'sharded_media_layout' in self.data:
+            self.sharded_media_layout = self.data['sharded_media_layout']
+        if 'make_image_variants' in self.data:
+            self.make_image_variants = self.data['make_image_variants']
+        if 'upgrade_media_quality' in self.data:
+            self.upgrade_media_quality = self.data['upgrade_media_quality']
+        if 'html_parser' in self.data:
+            self.html_parser = self.data['html_parser']
+        if 'parser_workers' in self.data:
+            self.parser_workers = self.data['parser_workers']
+        if 'image_workers' in self.data:
+            self.image_workers = self.data['image_workers']
+        if 'download_workers' in self.data:
+            self.download_workers = self.data['download_workers']
+        if 'host_requests_per_second' in self.data:
+            self.host_requests_per_second = self.data['host_requests_per_second']
+        if 'http_cache_folder' in self.data:
+            self.http_cache_folder = self.data['http_cache_folder']
+        if 'http_cache_max_size' in self.data:
+            self.http_cache_max_size = self.data['http_cache_max_size']
+        if 'http_cache_max_age_days' in self.data:
+            self.http_cache_max_age_days = self.data['http_cache_max_age_days']
+        if 'offline' in self.data:
+            self.offline = self.data['offline']
         
     def already_existing(self):
         return os.path.exists(self.output_media_folder_name) or os.path.exists(self.output_posts) or os.path.exists(self.output_status) or os.path.exists(self.output_thread)
@@ -160,6 +220,7 @@ class Config:
         self.data['output_json_folder_name' ] = os.path.join(self.data['output_folder'],'assets/js/data')
         self.data['output_threads_folder_name'] = os.path.join(self.data['output_folder'], '_threads')
         self.data['output_media_url_base'] = '/media/'
+        self.data['output_emoji_url_base'] = '/assets/images/emoji/'
         self.data['output_assets_folder'] = os.path.join(self.data['output_folder'], 'assets')
         self.data['output_assets_images_folder'] = os.path.join(self.data['output_assets_folder'], 'images')
         self.data['output_posts'] = os.path.join(self.data['output_folder'], 'archive')
@@ -177,6 +238,11 @@ class Config:
         self.data['output_threadstats_filename'] = os.path.join(self.data['output_folder'], '_data/thread_stats.yaml')
         self.data['user_id_URL_template'] = 'https://twitter.com/{}'
         self.data['jekyll_config_filename'] = os.path.join(self.data['output_folder'], '_config.yml')
+        self.data['hash_cache_filename'] = os.path.join(self.data['output_folder'], '.hash_cache.json')   # Dot file, so Jekyll ignores it
+        self.data['retry_queue_filename'] = os.path.join(self.data['output_folder'], '.failed_downloads.json')
+        self.data['link_cache_filename'] = os.path.join(self.data['output_folder'], '.link_cache.json')
+        self.data['page_cache_filename'] = os.path.join(self.data['output_folder'], '.page_cache.json')
+        self.data['avatar_index_filename'] = os.path.join(self.data['output_folder'], '.avatar_index.json')
         self.data['user_agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/'
         if 'sleep_time' not in self.data:
             self.data['sleep_time'] = 0.25
@@ -186,6 +252,46 @@ class Config:
             self.data['download_media'] = True
         else:
             self.data['download_media'] = download_media
+        # Optional shared media store. (See lib/media_store.py) Leave the folder as None to turn it off.
+        # The maximum size is in megabytes, with 0 meaning no limit.
+        if 'media_store_folder' not in self.data:
+            self.data['media_store_folder'] = None
+        if 'media_store_max_size' not in self.data:
+            self.data['media_store_max_size'] = 0
+        # Spread media and avatars over media/ab/cd/ style sub-folders, for very large archives.
+        if 'sharded_media_layout' not in self.data:
+            self.data['sharded_media_layout'] = False
+        # Smaller copies of photos and avatars for the web pages. (Needs Pillow.) Workers of 0 means one per CPU.
+        if 'make_image_variants' not in self.data:
+            self.data['make_image_variants'] = True
+        if 'image_workers' not in self.data:
+            self.data['image_workers'] = 0
+        # Swap photos for the original-quality (':orig') versions on Twitter's servers, where they're bigger.
+        if 'upgrade_media_quality' not in self.data:
+            self.data['upgrade_media_quality'] = False
+        # Which parser Beautiful Soup uses for the followers and following pages: 'lxml' (faster, if it's
+        # installed), 'html.parser' (Python's own), or 'auto' for lxml if it's there, and html.parser if not.
+        if 'html_parser' not in self.data:
+            self.data['html_parser'] = 'auto'
+        # Processes pulling the users out of those pages. (0 means one per CPU.)
+        if 'parser_workers' not in self.data:
+            self.data['parser_workers'] = 0
+        # How many downloads to run at once, and how many requests a second to make to any one server.
+        # (A rate of 0 means one request every sleep_time seconds.)
+        if 'download_workers' not in self.data:
+            self.data['download_workers'] = 4
+        if 'host_requests_per_second' not in self.data:
+            self.data['host_requests_per_second'] = 0
+        # Cache of everything fetched from the web. (Size in megabytes, 0 for no limit.) Responses younger
+        # than the maximum age are used without asking the server again. In offline mode, only the cache is used.
+        if 'http_cache_folder' not in self.data or not self.data['http_cache_folder']:
+            self.data['http_cache_folder'] = os.path.join(self.data['output_folder'], '.http_cache')
+        if 'http_cache_max_size' not in self.data:
+            self.data['http_cache_max_size'] = 1024
+        if 'http_cache_max_age_days' not in self.data:
+            self.data['http_cache_max_age_days'] = 7
+        if 'offline' not in self.data:
+            self.data['offline'] = False
         self.__update_constants()
         self.save()
         
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import mmap
+import os
+
+# FILE HASHER =====================================================================================
+# Works out content hashes for media files. Videos can run to hundreds of megabytes, so:
+#  * large files are memory-mapped and fed to the hash a slice at a time, so there's no copying into
+#    Python buffers, and smaller ones are read in big chunks into a single reusable buffer,
+#  * we use BLAKE2, which is quicker than SHA-256 on the sort of machines this is going to be run on,
+#  * every result is cached against the file's inode, size and modification time, and the cache is
+#    saved between runs, so a file that hasn't changed is never hashed twice.
+class FileHasher:
+
+    DIGEST_SIZE = 20
+    CHUNK_SIZE = 4 * 1024 * 1024                    # A multiple of mmap.ALLOCATIONGRANULARITY on all platforms
+    MMAP_THRESHOLD = 16 * 1024 * 1024               # Files larger than this get memory-mapped
+
+    def __init__(self, cache_filename = None):
+        self.cache_filename = cache_filename
+        self.cache = {}                             # file key -> { 'size': bytes, 'mtime': ns, 'hash': hex digest }
+        self.files_hashed = 0
+        self.cache_hits = 0
+        self.__buffer = None
+        self.load()
+
+    def load(self):
+        if not self.cache_filename or not os.path.exists(self.cache_filename):
+            return False
+        try:
+            with open(self.cache_filename, 'r', encoding='utf8') as f:
+                self.cache = json.loads(f.read())
+                return True
+        except Exception as e:
+            print(f"Error loading hash cache: {e}")
+            return False
+
+    def save(self):
+        if not self.cache_filename:
+            return
+        tmp_filename = self.cache_filename + '.tmp'
+        with open(tmp_filename, 'w', encoding='utf8') as f:
+            f.write(json.dumps(self.cache))
+        os.replace(tmp_filename, self.cache_filename)
+
+    @staticmethod
+    def hash_data(data):
+        return hashlib.blake2b(data, digest_size=FileHasher.DIGEST_SIZE).hexdigest()
+
+    # Returns the hash of a file, from the cache if the file hasn't changed since we last saw it.
+    def hash_file(self, filename):
+        file_stat = os.stat(filename)
+        key = FileHasher.__file_key(filename, file_stat)
+        cached = self.cache.get(key)
+        if cached and cached['size'] == file_stat.st_size and cached['mtime'] == file_stat.st_mtime_ns:
+            self.cache_hits += 1
+            return cached['hash']
+        content_hash = self.__digest_file(filename, file_stat.st_size)
+        self.cache[key] = { 'size': file_stat.st_size, 'mtime': file_stat.st_mtime_ns, 'hash': content_hash }
+        self.files_hashed += 1
+        return content_hash
+
+    # Tells the cache about a file we already know the hash of, (eg. one we've just written from a
+    # block of data) so that we don't have to read it back in again.
+    def remember(self, filename, content_hash):
+        file_stat = os.stat(filename)
+        key = FileHasher.__file_key(filename, file_stat)
+        self.cache[key] = { 'size': file_stat.st_size, 'mtime': file_stat.st_mtime_ns, 'hash': content_hash }
+
+    # Files are identified by device and inode, so the cache still works if the file is renamed or
+    # hard linked somewhere else. Some file systems don't have inode numbers, so we use the path there.
+    @staticmethod
+    def __file_key(filename, file_stat):
+        if file_stat.st_ino:
+            return f'{file_stat.st_dev}:{file_stat.st_ino}'
+        return os.path.normcase(os.path.abspath(filename))
+
+    def __digest_file(self, filename, file_size):
+        hasher = hashlib.blake2b(digest_size=FileHasher.DIGEST_SIZE)
+        with open(filename, 'rb') as f:
+            if file_size >= FileHasher.MMAP_THRESHOLD:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+                    with memoryview(mapped_file) as view:
+                        for offset in range(0, file_size, FileHasher.CHUNK_SIZE):
+                            hasher.update(view[offset:offset + FileHasher.CHUNK_SIZE])
+            else:
+                if self.__buffer is None:
+                    self.__buffer = bytearray(FileHasher.CHUNK_SIZE)
+                with memoryview(self.__buffer) as view:
+                    bytes_read = f.readinto(view)
+                    while bytes_read:
+                        hasher.update(view[:bytes_read])
+                        bytes_read = f.readinto(view)
+        return hasher.hexdigest()
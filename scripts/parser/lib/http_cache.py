@@ -0,0 +1,178 @@
+from requests.structures import CaseInsensitiveDict
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+# CACHED RESPONSE =================================================================================
+# Stands in for a requests.Response when the answer comes from the cache, with just the parts of it
+# the rest of the parser uses.
+class CachedResponse:
+
+    def __init__(self, url, status_code, headers, body_filename):
+        self.url = url
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers)
+        self.body_filename = body_filename
+        self.from_cache = True
+        self.__content = None
+
+    @property
+    def content(self):
+        if self.__content is None:
+            with open(self.body_filename, 'rb') as f:
+                self.__content = f.read()
+        return self.__content
+
+# HTTP CACHE ======================================================================================
+# Keeps the responses UriLoader gets on disk, so that the next run doesn't have to fetch them again.
+#  * Entries younger than max_age are used without asking the server at all.
+#  * Older ones are revalidated with If-None-Match / If-Modified-Since, and a '304 Not Modified'
+#    answer means we use what we have.
+#  * In offline mode, anything in the cache is used regardless of age, and anything not in the cache
+#    fails without touching the network.
+#  * When the cache grows past max_size, the least recently used entries are thrown out.
+class HttpCache:
+
+    INDEX_FILENAME = 'index.json'
+    BODIES_FOLDER = 'bodies'
+    KEPT_HEADERS = ['Content-Type', 'ETag', 'Last-Modified']
+
+    def __init__(self, cache_directory, max_size = 0, max_age = 0, offline = False):
+        self.cache_directory = cache_directory
+        self.max_size = max_size                # In bytes. 0 means no limit.
+        self.max_age = max_age                  # In seconds. 0 means always revalidate.
+        self.offline = offline
+        self.index_filename = os.path.join(cache_directory, HttpCache.INDEX_FILENAME)
+        self.entries = {}                       # url -> { 'status', 'headers', 'size', 'stored', 'last_used' }
+        self.lock = threading.Lock()            # Downloads run in several threads at once
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        if not os.path.exists(os.path.join(cache_directory, HttpCache.BODIES_FOLDER)):
+            os.makedirs(os.path.join(cache_directory, HttpCache.BODIES_FOLDER))
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.index_filename):
+            return False
+        try:
+            with open(self.index_filename, 'r', encoding='utf8') as f:
+                self.entries = json.loads(f.read())
+                return True
+        except Exception as e:
+            print(f"Error loading HTTP cache index: {e}")
+            return False
+
+    def save(self):
+        with self.lock:
+            tmp_filename = self.index_filename + '.tmp'
+            with open(tmp_filename, 'w', encoding='utf8') as f:
+                f.write(json.dumps(self.entries))
+            os.replace(tmp_filename, self.index_filename)
+
+    def body_path(self, url):
+        key = hashlib.sha1(url.encode('utf8')).hexdigest()
+        return os.path.join(self.cache_directory, HttpCache.BODIES_FOLDER, key[:2], key)
+
+    # Returns the cache entry for a URL, if we have one and its body is still on disk.
+    def lookup(self, url):
+        with self.lock:
+            entry = self.entries.get(url)
+        if entry and os.path.exists(self.body_path(url)):
+            return entry
+        return None
+
+    # Whether an entry can be used as it is, without checking with the server.
+    def is_fresh(self, entry):
+        return self.offline or (self.max_age > 0 and time.time() - entry['stored'] < self.max_age)
+
+    # Headers to send so the server can answer '304 Not Modified' if our copy is still current.
+    def conditional_headers(self, entry):
+        headers = {}
+        if 'ETag' in entry['headers']:
+            headers['If-None-Match'] = entry['headers']['ETag']
+        if 'Last-Modified' in entry['headers']:
+            headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+        return headers
+
+    # Makes a response object from a cache entry, and marks the entry as used.
+    def response(self, url, entry, revalidated = False):
+        with self.lock:
+            entry['last_used'] = time.time()
+            if revalidated:
+                entry['stored'] = entry['last_used']
+                self.revalidated += 1
+            else:
+                self.hits += 1
+        return CachedResponse(url, entry['status'], entry['headers'], self.body_path(url))
+
+    # Copies the cached body of a URL to filename. (Hard linked, where the file system allows.)
+    def copy_body(self, url, filename):
+        body_filename = self.body_path(url)
+        if os.path.exists(filename):
+            os.remove(filename)
+        try:
+            os.link(body_filename, filename)
+        except OSError:
+            shutil.copy(body_filename, filename)
+
+    # Stores a response whose body we have in memory.
+    def store_data(self, url, response, data):
+        body_filename = self.body_path(url)
+        self.__make_folder(body_filename)
+        tmp_filename = f'{body_filename}.{threading.get_ident()}.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_filename, body_filename)
+        self.__add_entry(url, response, len(data))
+
+    # Stores a response whose body has been downloaded to a file. The file is hard linked into the
+    # cache where possible, so big downloads don't take up the space twice. status overrides the
+    # response's, eg. when a download was finished off with a '206 Partial Content'.
+    def store_file(self, url, response, filename, status = None):
+        body_filename = self.body_path(url)
+        self.__make_folder(body_filename)
+        if os.path.exists(body_filename):
+            os.remove(body_filename)
+        try:
+            os.link(filename, body_filename)
+        except OSError:
+            shutil.copy(filename, body_filename)
+        self.__add_entry(url, response, os.path.getsize(filename), status)
+
+    def total_size(self):
+        with self.lock:
+            return sum(entry['size'] for entry in self.entries.values())
+
+    # Throws out least recently used entries until the cache is under max_size.
+    def evict(self):
+        if not self.max_size:
+            return 0
+        evicted = 0
+        total_size = self.total_size()
+        with self.lock:
+            for url in sorted(self.entries, key=lambda url: self.entries[url]['last_used']):
+                if total_size <= self.max_size:
+                    break
+                total_size -= self.entries[url]['size']
+                body_filename = self.body_path(url)
+                if os.path.exists(body_filename):
+                    os.remove(body_filename)
+                del self.entries[url]
+                evicted += 1
+        return evicted
+
+    def __add_entry(self, url, response, size, status = None):
+        headers = { header: response.headers[header] for header in HttpCache.KEPT_HEADERS if header in response.headers }
+        now = time.time()
+        with self.lock:
+            self.entries[url] = { 'status': status or response.status_code, 'headers': headers, 'size': size, 'stored': now, 'last_used': now }
+            self.misses += 1
+
+    def __make_folder(self, body_filename):
+        folder = os.path.dirname(body_filename)
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
@@ -0,0 +1,105 @@
+import json
+import os
+
+# IMAGE VARIANTS ==================================================================================
+# Makes smaller, web-friendly copies of photos and avatars, so the index pages don't have to pull in
+# every full-size image from the archive. The layouts then offer them to the browser with `srcset`.
+#
+# The resizing is done in a pool of worker processes, and the results are kept in an index against
+# the hash of the source image. On a rerun, any image whose variants are all still there is skipped.
+#
+# This needs Pillow. If it isn't installed, available() returns False and the step is skipped.
+class ImageVariants:
+
+    INDEX_FILENAME = 'variants.json'
+    PHOTO_WIDTHS = [320, 640, 1280]
+    AVATAR_WIDTHS = [48, 96, 200]
+    JPEG_QUALITY = 80
+
+    def __init__(self, output_directory, url_base):
+        self.output_directory = output_directory
+        self.url_base = url_base                # URL of output_directory, relative to the website root
+        self.index_filename = os.path.join(output_directory, ImageVariants.INDEX_FILENAME)
+        self.index = {}                         # source hash -> [ { 'width', 'height', 'filename' }, ... ]
+        if not os.path.exists(output_directory):
+            os.makedirs(output_directory)
+        self.load()
+
+    @staticmethod
+    def available():
+        try:
+            import PIL.Image
+            return True
+        except ImportError:
+            return False
+
+    def load(self):
+        if not os.path.exists(self.index_filename):
+            return False
+        try:
+            with open(self.index_filename, 'r', encoding='utf8') as f:
+                self.index = json.loads(f.read())
+                return True
+        except Exception as e:
+            print(f"Error loading image variants index: {e}")
+            return False
+
+    def save(self):
+        tmp_filename = self.index_filename + '.tmp'
+        with open(tmp_filename, 'w', encoding='utf8') as f:
+            f.write(json.dumps(self.index))
+        os.replace(tmp_filename, self.index_filename)
+
+    # Returns the variants we already have for an image, or None if it still needs doing.
+    def cached(self, content_hash):
+        variants = self.index.get(content_hash)
+        if variants is None:
+            return None
+        for variant in variants:
+            if not os.path.exists(os.path.join(self.output_directory, variant['filename'])):
+                return None
+        return variants
+
+    def add(self, content_hash, variants):
+        self.index[content_hash] = variants
+
+    # Variants as they go in the front matter and data files, with URLs rather than filenames.
+    def as_urls(self, variants):
+        return [{ 'width': variant['width'], 'height': variant['height'], 'url': self.url_base + variant['filename'] }
+                for variant in variants]
+
+    # Runs in a worker process. Resizes one image to each of the given widths (never making it bigger
+    # than it already is), and returns what it made, or None if the image couldn't be read.
+    @staticmethod
+    def make_variants(source_filename, content_hash, output_directory, widths):
+        from PIL import Image, ImageOps
+        try:
+            with Image.open(source_filename) as image:
+                image = ImageOps.exif_transpose(image)
+                width, height = image.size
+                # Keep transparency where there is any, otherwise JPEG is much smaller.
+                keep_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+                image = image.convert('RGBA' if keep_alpha else 'RGB')
+                ext = '.png' if keep_alpha else '.jpg'
+                target_widths = sorted(set([target for target in widths if target < width] + [min(width, widths[-1])]))
+                shard = content_hash[:2]
+                if not os.path.exists(os.path.join(output_directory, shard)):
+                    os.makedirs(os.path.join(output_directory, shard), exist_ok=True)
+                variants = []
+                for target_width in target_widths:
+                    target_height = max(1, round(height * target_width / width))
+                    variant_filename = f'{shard}/{content_hash}-{target_width}w{ext}'
+                    output_filename = os.path.join(output_directory, variant_filename)
+                    if not os.path.exists(output_filename):
+                        resized = image.resize((target_width, target_height), Image.LANCZOS)
+                        tmp_filename = output_filename + '.tmp'
+                        if keep_alpha:
+                            resized.save(tmp_filename, 'PNG', optimize=True)
+                        else:
+                            resized.save(tmp_filename, 'JPEG', quality=ImageVariants.JPEG_QUALITY, optimize=True, progressive=True)
+                        os.replace(tmp_filename, output_filename)
+                    variants.append({ 'width': target_width, 'height': target_height, 'filename': variant_filename })
+                return variants
+        except Exception as e:
+            print(f"Couldn't make variants of {source_filename}: {e}")
+            return None
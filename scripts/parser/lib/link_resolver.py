@@ -0,0 +1,114 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from lib.network import Downloader
+from lib.utils import UriLoader
+from urllib.parse import urljoin, urlsplit
+import json
+import os
+import threading
+
+# LINK RESOLVER ===================================================================================
+# Works out where short links (t.co, bit.ly and the like) in tweets actually go, so the pages can link
+# straight to them. Each link is resolved with HEAD requests, following the redirects only as long as
+# they lead to another link shortener, so we never download the pages themselves.
+#
+# Where a link goes doesn't change, so every answer is kept in a cache file for good, and each link is
+# only ever looked up once.
+class LinkResolver:
+
+    SHORTENER_HOSTS = ['t.co', 'bit.ly', 'bitly.com', 'buff.ly', 'dlvr.it', 'fb.me', 'goo.gl', 'ift.tt',
+                       'is.gd', 'j.mp', 'ow.ly', 'tinyurl.com', 'trib.al', 'wp.me']
+    REDIRECT_STATUS_CODES = [301, 302, 303, 307, 308]
+    GONE_STATUS_CODES = [404, 410]          # The link's dead, so it goes nowhere else
+    MAX_HOPS = 5
+    # t.co sends browsers a page with a script redirect on it, and everyone else a plain redirect, which
+    # is the one we want.
+    USER_AGENT = 'NorwegianBlue link resolver'
+
+    def __init__(self, config, cache_filename):
+        self.config = config
+        self.cache_filename = cache_filename
+        self.links = {}                         # short URL -> where it goes
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.cache_filename):
+            return False
+        try:
+            with open(self.cache_filename, 'r', encoding='utf8') as f:
+                self.links = json.loads(f.read())
+                return True
+        except Exception as e:
+            print(f"Error loading link cache: {e}")
+            return False
+
+    def save(self):
+        tmp_filename = self.cache_filename + '.tmp'
+        with open(tmp_filename, 'w', encoding='utf8') as f:
+            f.write(json.dumps(self.links, indent=4))
+        os.replace(tmp_filename, self.cache_filename)
+
+    @staticmethod
+    def is_short_link(url):
+        return bool(url) and urlsplit(url).netloc.lower() in LinkResolver.SHORTENER_HOSTS
+
+    # The link in a tweet's URL entity that needs resolving, if any: the expanded URL if it's another short
+    # link, or the t.co link itself if there isn't an expanded URL.
+    @staticmethod
+    def short_link_for(url_entity):
+        expanded_url = url_entity.get('expanded_url')
+        if not expanded_url:
+            return url_entity.get('url')
+        if LinkResolver.is_short_link(expanded_url):
+            return expanded_url
+        return None
+
+    # Resolves all the short links we haven't seen before, a few at a time, calling progress(done, total)
+    # as each one finishes. Returns the number resolved.
+    def resolve_all(self, urls, progress = None):
+        urls = [url for url in set(urls) if url and url not in self.links]
+        if not urls:
+            return 0
+        workers = self.config.download_workers or 1
+        resolved = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            session = Downloader.make_session(workers)
+            futures = { pool.submit(self.resolve, url, session): url for url in urls }
+            for count, future in enumerate(as_completed(futures), 1):
+                if future.result():
+                    resolved += 1
+                if progress:
+                    progress(count, len(urls))
+            session.close()
+        return resolved
+
+    # Follows one short link. Returns where it goes, or None if we couldn't find out, in which case it's
+    # left out of the cache, so it can be tried again next time. Only a redirect off the shorteners, or a
+    # link the shortener says is gone for good, (404 or 410) counts as an answer. Anything else, (eg. rate
+    # limiting, server errors, HEAD not being allowed, or a page from the shortener itself) or running
+    # out of hops while still on a shortener, doesn't.
+    def resolve(self, url, session = None):
+        target = url
+        for hop in range(LinkResolver.MAX_HOPS):
+            loader = UriLoader(target, self.config, head=True, redirects=False, session=session, user_agent=LinkResolver.USER_AGENT)
+            loader.load()
+            if loader.data is None:
+                return None
+            status_code = loader.data.status_code
+            location = loader.data.headers.get('Location')
+            if status_code in LinkResolver.REDIRECT_STATUS_CODES and location:
+                target = urljoin(target, location)
+                if not LinkResolver.is_short_link(target):
+                    break
+            elif status_code in LinkResolver.GONE_STATUS_CODES:
+                break
+            else:
+                return None
+        else:
+            return None
+        with self.lock:
+            self.links[url] = target
+        return target
+
+    def get(self, url):
+        return self.links.get(url)
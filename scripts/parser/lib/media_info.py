@@ -0,0 +1,134 @@
+import io
+import os
+import struct
+
+# MEDIA INFO ======================================================================================
+# Reads the width and height of images and videos from their headers, without decoding them. For most
+# formats this is the first few dozen bytes. JPEGs and MP4s keep the size further in, so we hop from
+# one marker or box header to the next, seeking over everything else, so even for a large video we
+# only ever read a few KB.
+class MediaInfo:
+
+    HEADER_BYTES = 32
+
+    @staticmethod
+    def read_dimensions(filename):
+        try:
+            with open(filename, 'rb') as f:
+                return MediaInfo.__read_stream(f, os.fstat(f.fileno()).st_size)
+        except (OSError, IndexError, struct.error) as e:
+            print(f"Couldn't read dimensions of {filename}: {e}")
+        return None, None
+
+    # The file extension for a file, from its first few bytes, or None if it's not a kind we know.
+    @staticmethod
+    def sniff_ext(filename):
+        try:
+            with open(filename, 'rb') as f:
+                return MediaInfo.sniff_ext_from_data(f.read(MediaInfo.HEADER_BYTES))
+        except OSError:
+            return None
+
+    @staticmethod
+    def sniff_ext_from_data(header):
+        if header.startswith(b'\x89PNG\r\n\x1a\n'):
+            return 'png'
+        if header[:6] in (b'GIF87a', b'GIF89a'):
+            return 'gif'
+        if header.startswith(b'\xff\xd8'):
+            return 'jpg'
+        if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+            return 'webp'
+        if header[4:8] == b'ftyp':
+            return 'mp4'
+        return None
+
+    # The same, from the first part of a file, (eg. from a Range request) rather than the whole file.
+    # If the size is further in than the data we have, we get (None, None).
+    @staticmethod
+    def read_dimensions_from_data(data):
+        try:
+            return MediaInfo.__read_stream(io.BytesIO(data), len(data))
+        except (IndexError, struct.error):
+            return None, None
+
+    @staticmethod
+    def __read_stream(f, file_size):
+        header = f.read(MediaInfo.HEADER_BYTES)
+        if header.startswith(b'\x89PNG\r\n\x1a\n'):
+            return struct.unpack('>II', header[16:24])
+        if header[:6] in (b'GIF87a', b'GIF89a'):
+            return struct.unpack('<HH', header[6:10])
+        if header.startswith(b'\xff\xd8'):
+            return MediaInfo.__read_jpeg_dimensions(f)
+        if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+            return MediaInfo.__read_webp_dimensions(header)
+        if header[4:8] == b'ftyp':
+            return MediaInfo.__read_mp4_dimensions(f, file_size)
+        return None, None
+
+    # JPEG: walk the segments until we find a start-of-frame marker, which holds the size.
+    @staticmethod
+    def __read_jpeg_dimensions(f):
+        f.seek(2)
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xff:
+                return None, None
+            while marker[1] == 0xff:                    # Padding bytes between markers
+                marker = marker[1:] + f.read(1)
+            segment_length = struct.unpack('>H', f.read(2))[0]
+            if marker[1] in (0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf):
+                height, width = struct.unpack('>xHH', f.read(5))
+                return width, height
+            f.seek(segment_length - 2, os.SEEK_CUR)
+
+    # WebP comes in three flavours, each with the size in a different place.
+    @staticmethod
+    def __read_webp_dimensions(header):
+        chunk = header[12:16]
+        if chunk == b'VP8 ':
+            width, height = struct.unpack('<HH', header[26:30])
+            return width & 0x3fff, height & 0x3fff
+        if chunk == b'VP8L':
+            bits = struct.unpack('<I', header[21:25])[0]
+            return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+        if chunk == b'VP8X':
+            width = int.from_bytes(header[24:27], 'little') + 1
+            height = int.from_bytes(header[27:30], 'little') + 1
+            return width, height
+        return None, None
+
+    # MP4: the size is in the track header ('tkhd') of the video track, inside moov > trak. We follow the
+    # box headers down, skipping over the media data, which is where almost all of the file is.
+    @staticmethod
+    def __read_mp4_dimensions(f, file_size):
+        return MediaInfo.__find_mp4_track_size(f, 0, file_size)
+
+    @staticmethod
+    def __find_mp4_track_size(f, start, end):
+        position = start
+        while position + 8 <= end:
+            f.seek(position)
+            box_size, box_type = struct.unpack('>I4s', f.read(8))
+            header_size = 8
+            if box_size == 1:
+                box_size = struct.unpack('>Q', f.read(8))[0]
+                header_size = 16
+            elif box_size == 0:
+                box_size = end - position
+            if box_size < header_size:
+                return None, None
+            if box_type in (b'moov', b'trak'):
+                width, height = MediaInfo.__find_mp4_track_size(f, position + header_size, position + box_size)
+                if width:
+                    return width, height
+            elif box_type == b'tkhd':
+                version = f.read(1)[0]
+                # The size is the last 8 bytes of the box, as 16.16 fixed point numbers. Audio tracks have 0x0.
+                f.seek(position + box_size - 8)
+                width, height = struct.unpack('>II', f.read(8))
+                if width and height and version in (0, 1):
+                    return width >> 16, height >> 16
+            position += box_size
+        return None, None
@@ -0,0 +1,179 @@
+from lib.file_hasher import FileHasher
+import json
+import os
+import shutil
+import time
+
+# MEDIA STORE =====================================================================================
+# A content-addressed store for media files, shared between runs (and between archives, if you point
+# several conversions at the same folder). Every file is kept once, under the hash of its contents, and
+# the files in the output `media/` folder are hard links to the copy in the store. (If the output folder
+# is on a different drive, we fall back to an ordinary copy.)
+#
+# The store also remembers which source (a remote URL, or the path of a file in an archive) gave which
+# hash, so that on the next run we can skip the copy or download altogether.
+class MediaStore:
+
+    INDEX_FILENAME = 'index.json'
+    BLOBS_FOLDER = 'blobs'
+
+    def __init__(self, store_directory, max_size = None, hasher = None):
+        self.store_directory = store_directory
+        self.max_size = max_size                # In bytes. None or 0 means no limit.
+        self.hasher = hasher if hasher else FileHasher()
+        self.index_filename = os.path.join(store_directory, MediaStore.INDEX_FILENAME)
+        self.blobs = {}                         # hash -> { 'size': bytes, 'ext': '.jpg', 'last_used': timestamp }
+        self.sources = {}                       # source URL or path -> hash
+        if not os.path.exists(os.path.join(store_directory, MediaStore.BLOBS_FOLDER)):
+            os.makedirs(os.path.join(store_directory, MediaStore.BLOBS_FOLDER))
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.index_filename):
+            return False
+        try:
+            with open(self.index_filename, 'r', encoding='utf8') as f:
+                index = json.loads(f.read())
+                self.blobs = index.get('blobs', {})
+                self.sources = index.get('sources', {})
+                return True
+        except Exception as e:
+            print(f"Error loading media store index: {e}")
+            return False
+
+    def save(self):
+        # Write to a temporary file first, so an interrupted run can't leave us with half an index.
+        tmp_filename = self.index_filename + '.tmp'
+        with open(tmp_filename, 'w', encoding='utf8') as f:
+            f.write(json.dumps({ 'blobs': self.blobs, 'sources': self.sources }))
+        os.replace(tmp_filename, self.index_filename)
+
+    # Blobs are spread over 256 sub-folders, so no single folder gets too big.
+    def blob_path(self, content_hash):
+        ext = self.blobs[content_hash]['ext'] if content_hash in self.blobs else ''
+        return os.path.join(self.store_directory, MediaStore.BLOBS_FOLDER, content_hash[:2], content_hash + ext)
+
+    def contains(self, content_hash):
+        return content_hash in self.blobs and os.path.exists(self.blob_path(content_hash))
+
+    # Returns the hash for a source we've seen before, as long as we still have the file for it.
+    def lookup_source(self, source):
+        content_hash = self.sources.get(source)
+        if content_hash and self.contains(content_hash):
+            return content_hash
+        return None
+
+    # Adds a file on disk to the store, if it isn't already there. Returns the hash. With move set, the
+    # file is moved into the store rather than copied, (eg. for a fresh download) and so is no longer
+    # at filename afterwards- use link() to put it back.
+    def add_file(self, filename, source = None, move = False, ext = None):
+        content_hash = self.hasher.hash_file(filename)
+        if not self.contains(content_hash):
+            self.__register(content_hash, os.path.getsize(filename), ext if ext is not None else os.path.splitext(filename)[1])
+            blob_filename = self.blob_path(content_hash)
+            tmp_filename = blob_filename + '.tmp'
+            if move:
+                shutil.move(filename, tmp_filename)
+            else:
+                shutil.copy(filename, tmp_filename)
+            os.replace(tmp_filename, blob_filename)
+        elif move:
+            os.remove(filename)
+        self.__touch(content_hash, source)
+        return content_hash
+
+    # Adds a block of data (eg. a downloaded file, or a decoded data URL) to the store. Returns the hash.
+    def add_data(self, data, ext = '', source = None):
+        content_hash = FileHasher.hash_data(data)
+        if not self.contains(content_hash):
+            self.__register(content_hash, len(data), ext)
+            blob_filename = self.blob_path(content_hash)
+            tmp_filename = blob_filename + '.tmp'
+            with open(tmp_filename, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_filename, blob_filename)
+            self.hasher.remember(blob_filename, content_hash)
+        self.__touch(content_hash, source)
+        return content_hash
+
+    # Puts a file from the store at output_filename. Hard links are used where the file system lets us.
+    def link(self, content_hash, output_filename):
+        blob_filename = self.blob_path(content_hash)
+        if os.path.exists(output_filename):
+            if os.path.samefile(blob_filename, output_filename):
+                self.__touch(content_hash)
+                return output_filename
+            os.remove(output_filename)
+        try:
+            os.link(blob_filename, output_filename)
+        except OSError:
+            shutil.copy(blob_filename, output_filename)
+        self.__touch(content_hash)
+        return output_filename
+
+    def total_size(self):
+        return sum(blob['size'] for blob in self.blobs.values())
+
+    # Throw out the least recently used blobs until we're under the size limit. Files already linked
+    # into an output folder are unaffected, as the link keeps the data alive.
+    def evict(self):
+        if not self.max_size:
+            return 0
+        evicted = 0
+        total_size = self.total_size()
+        for content_hash in sorted(self.blobs, key=lambda blob: self.blobs[blob]['last_used']):
+            if total_size <= self.max_size:
+                break
+            total_size -= self.blobs[content_hash]['size']
+            self.__remove(content_hash)
+            evicted += 1
+        return evicted
+
+    # Tidy up the store:
+    #  * forget about blobs whose files have gone missing,
+    #  * delete files in the blobs folder we have no record of (eg. left over from an interrupted run),
+    #  * if unlinked_only is set, delete blobs that are no longer linked from any output folder,
+    #  * and finally, get under the size limit.
+    # Returns the number of files removed.
+    def garbage_collect(self, unlinked_only = False):
+        removed = 0
+        for content_hash in list(self.blobs):
+            if not os.path.exists(self.blob_path(content_hash)):
+                del self.blobs[content_hash]
+        blobs_directory = os.path.join(self.store_directory, MediaStore.BLOBS_FOLDER)
+        known_files = set(os.path.normcase(self.blob_path(content_hash)) for content_hash in self.blobs)
+        for root, folders, files in os.walk(blobs_directory):
+            for file in files:
+                filename = os.path.join(root, file)
+                if os.path.normcase(filename) not in known_files:
+                    os.remove(filename)
+                    removed += 1
+        if unlinked_only:
+            for content_hash in list(self.blobs):
+                if os.stat(self.blob_path(content_hash)).st_nlink <= 1:
+                    self.__remove(content_hash)
+                    removed += 1
+        removed += self.evict()
+        self.sources = { source: content_hash for source, content_hash in self.sources.items() if content_hash in self.blobs }
+        self.save()
+        return removed
+
+    def __register(self, content_hash, size, ext):
+        self.blobs[content_hash] = { 'size': size, 'ext': ext.lower(), 'last_used': time.time() }
+        self.__make_folder(content_hash)
+
+    def __make_folder(self, content_hash):
+        folder = os.path.dirname(self.blob_path(content_hash))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def __touch(self, content_hash, source = None):
+        self.blobs[content_hash]['last_used'] = time.time()
+        if source:
+            self.sources[source] = content_hash
+
+    def __remove(self, content_hash):
+        blob_filename = self.blob_path(content_hash)
+        if os.path.exists(blob_filename):
+            os.remove(blob_filename)
+        del self.blobs[content_hash]
@@ -0,0 +1,210 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.utils import parsedate_to_datetime
+from lib.utils import UriLoader
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+import random
+import requests
+import threading
+import time
+
+# TOKEN BUCKET ====================================================================================
+# Lets requests through at a steady rate, with a few allowed to go straight away (the 'burst').
+# Callers that arrive when the bucket is empty wait until the next token is due.
+class TokenBucket:
+
+    def __init__(self, rate, capacity):
+        self.rate = rate                        # Tokens added per second
+        self.capacity = capacity                # Most tokens the bucket can hold
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+# ADAPTIVE RATE CONTROLLER ========================================================================
+# Decides how fast we can make requests to each host, based on how the host is responding. There's one
+# of these shared by every step that touches the network. (UriLoader asks it before each request, and
+# tells it how each request went.)
+#  * While a host is answering happily, we gradually speed up, up to max_rate.
+#  * When it answers '429 Too Many Requests' or a 5xx error, (or the connection fails) we halve the
+#    rate, and pause all requests to that host. The pause is what the server asks for in 'Retry-After'
+#    if it says, otherwise it doubles with each failure in a row, with some randomness added so that
+#    all the waiting requests don't hit the server again at the same moment.
+class AdaptiveRateController:
+
+    THROTTLE_STATUS_CODES = [429, 500, 502, 503, 504]
+    SPEED_UP_AFTER = 10             # Successes in a row before we speed up
+    SPEED_UP_FACTOR = 1.25
+    SLOW_DOWN_FACTOR = 0.5
+    BASE_BACKOFF = 1.0              # Seconds
+    MAX_BACKOFF = 120.0
+
+    def __init__(self, rate, burst = 1, max_retries = 4):
+        self.base_rate = rate
+        self.min_rate = rate / 16
+        self.max_rate = rate * 8
+        self.burst = burst
+        self.max_retries = max_retries
+        self.hosts = {}             # host -> { 'bucket', 'successes', 'failures', 'paused_until' }
+        self.lock = threading.Lock()
+
+    def __host_state(self, url):
+        host = urlsplit(url).netloc.lower()
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = { 'bucket': TokenBucket(self.base_rate, self.burst), 'successes': 0, 'failures': 0, 'paused_until': 0 }
+            return self.hosts[host]
+
+    # Waits until we're allowed to make a request to the URL's host. This is the only place the parser
+    # waits between requests: the delay depends only on how recently we last asked the same host, so
+    # requests to different hosts, and anything that doesn't touch the network, never wait.
+    def acquire(self, url):
+        state = self.__host_state(url)
+        pause = state['paused_until'] - time.monotonic()
+        while pause > 0:
+            time.sleep(pause)
+            pause = state['paused_until'] - time.monotonic()
+        state['bucket'].acquire()
+
+    # Records how a request went. Returns True if the request should be tried again, once acquire()
+    # lets it. (status_code is None if the connection failed altogether.)
+    def record(self, url, status_code, headers = None, attempt = 0):
+        state = self.__host_state(url)
+        with self.lock:
+            bucket = state['bucket']
+            if status_code is not None and status_code not in AdaptiveRateController.THROTTLE_STATUS_CODES:
+                state['failures'] = 0
+                state['successes'] += 1
+                if state['successes'] >= AdaptiveRateController.SPEED_UP_AFTER:
+                    state['successes'] = 0
+                    bucket.rate = min(self.max_rate, bucket.rate * AdaptiveRateController.SPEED_UP_FACTOR)
+                return False
+            state['successes'] = 0
+            state['failures'] += 1
+            bucket.rate = max(self.min_rate, bucket.rate * AdaptiveRateController.SLOW_DOWN_FACTOR)
+            bucket.tokens = min(bucket.tokens, 0)
+            pause = AdaptiveRateController.retry_after(headers)
+            if pause is None:
+                backoff = min(AdaptiveRateController.MAX_BACKOFF, AdaptiveRateController.BASE_BACKOFF * (2 ** (state['failures'] - 1)))
+                pause = backoff / 2 + random.uniform(0, backoff / 2)
+            state['paused_until'] = max(state['paused_until'], time.monotonic() + pause)
+            return attempt < self.max_retries
+
+    # The number of seconds a 'Retry-After' header asks us to wait. It can be either a number of
+    # seconds or a date.
+    @staticmethod
+    def retry_after(headers):
+        if not headers or 'Retry-After' not in headers:
+            return None
+        value = headers['Retry-After'].strip()
+        if value.isdigit():
+            return min(float(value), AdaptiveRateController.MAX_BACKOFF)
+        try:
+            return min(max(0.0, parsedate_to_datetime(value).timestamp() - time.time()), AdaptiveRateController.MAX_BACKOFF)
+        except (TypeError, ValueError):
+            return None
+
+    # The current request rate for each host, for the progress window. eg. 'pbs.twimg.com 6.1/s'
+    def describe(self):
+        with self.lock:
+            rates = []
+            for host, state in self.hosts.items():
+                rate = f'{host} {state["bucket"].rate:.1f}/s'
+                if state['paused_until'] > time.monotonic():
+                    rate += ' (paused)'
+                rates.append(rate)
+        return ', '.join(rates)
+
+# DOWNLOADER ======================================================================================
+# Fetches a batch of URLs over a shared, pooled session (so connections to the same host are kept
+# alive and reused), a few at a time, at whatever rate the AdaptiveRateController allows. Results come
+# back to the caller, in the calling thread, as each one finishes, so the caller can safely update its
+# own data and the progress window.
+#
+# Example:
+#   with Downloader(config) as downloader:
+#       for key, loader in downloader.fetch_all([(media_id, url, filename), ...]):
+#           if loader.success: ...
+#   print(downloader.failure_summary())
+class Downloader:
+
+    def __init__(self, config, workers = None):
+        self.config = config
+        self.workers = workers or config.download_workers or 1
+        self.session = Downloader.make_session(self.workers)
+        self.failures = []                      # (key, url, error)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def make_session(pool_size):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def close(self):
+        self.session.close()
+
+    # Fetches a single URL. (UriLoader waits for the rate controller.) If a filename is given, the response
+    # is streamed to that file (see UriLoader.download) rather than kept in memory.
+    def fetch(self, url, head = False, redirects = True, filename = None):
+        loader = UriLoader(url, self.config, head=head, redirects=redirects, session=self.session)
+        if filename:
+            loader.download(filename)
+        else:
+            loader.load()
+        return loader
+
+    # Fetches just the start of a URL, to find its size. (See UriLoader.probe)
+    def probe(self, url, header_size = 65536):
+        loader = UriLoader(url, self.config, session=self.session)
+        loader.probe(header_size)
+        return loader
+
+    # Fetches each (key, url) or (key, url, filename) job, yielding (key, loader) as they complete.
+    # The order isn't guaranteed.
+    def fetch_all(self, jobs, head = False):
+        return self.__run_all(jobs, lambda job: self.fetch(job[1], head, True, job[2] if len(job) > 2 else None))
+
+    # Probes each (key, url) job, yielding (key, loader) as they complete.
+    def probe_all(self, jobs, header_size = 65536):
+        return self.__run_all(jobs, lambda job: self.probe(job[1], header_size))
+
+    def __run_all(self, jobs, work):
+        if not jobs:
+            return
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = { pool.submit(work, job): (job[0], job[1]) for job in jobs }
+            for future in as_completed(futures):
+                key, url = futures[future]
+                loader = future.result()
+                if not loader.success:
+                    self.failures.append((key, url, loader.error))
+                yield key, loader
+
+    # A short description of what went wrong, grouped by error, eg. '12 failed: 404 (10), timed out (2)'
+    def failure_summary(self):
+        if not self.failures:
+            return None
+        errors = {}
+        for key, url, error in self.failures:
+            errors[error] = errors.get(error, 0) + 1
+        error_list = ', '.join(f'{error} ({count})' for error, count in sorted(errors.items(), key=lambda item: -item[1]))
+        return f'{len(self.failures)} failed: {error_list}'
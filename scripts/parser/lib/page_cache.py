@@ -0,0 +1,56 @@
+import hashlib
+import json
+import os
+
+# PAGE CACHE ======================================================================================
+# Remembers the users read from the saved followers and following pages, so that when a page hasn't
+# changed since the last run, we can skip reading it altogether. (Which is often the slowest part of a
+# run.)
+#
+# There's one entry for each page, keyed on its timeline label, (eg. 'Timeline: Followers') holding a
+# fingerprint of everything the results depend on, (the page itself, the users we were looking for, and
+# the settings) the users, in the order they are on the page, and the files we saved for them along the
+# way. If any of those files have gone missing from the output folder, the page is read again.
+class PageCache:
+
+    VERSION = 2                 # Bump this if what's kept for each user changes, (or how it's worked out)
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.pages = {}             # timeline label -> { 'fingerprint', 'users', 'files' }
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return False
+        try:
+            with open(self.filename, 'r', encoding='utf8') as f:
+                self.pages = json.loads(f.read())
+                return True
+        except Exception as e:
+            print(f"Error loading page cache: {e}")
+            return False
+
+    def save(self):
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w', encoding='utf8') as f:
+            f.write(json.dumps(self.pages))
+        os.replace(tmp_filename, self.filename)
+
+    # page_hash is the hash of the page file; anything else the results depend on goes in settings.
+    @staticmethod
+    def fingerprint(page_hash, *settings):
+        return hashlib.blake2b(json.dumps([PageCache.VERSION, page_hash, settings]).encode('utf8'), digest_size=20).hexdigest()
+
+    # The users from a page, if we have them for this fingerprint, or None if the page needs reading.
+    def get(self, timeline_label, fingerprint, output_folder):
+        entry = self.pages.get(timeline_label)
+        if entry is None or entry['fingerprint'] != fingerprint:
+            return None
+        for filename in entry['files']:
+            if not os.path.exists(os.path.join(output_folder, filename)):
+                return None
+        return entry['users']
+
+    def put(self, timeline_label, fingerprint, users, files):
+        self.pages[timeline_label] = { 'fingerprint': fingerprint, 'users': users, 'files': sorted(set(files)) }
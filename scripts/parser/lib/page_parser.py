@@ -0,0 +1,432 @@
+from bs4 import BeautifulSoup
+from html.parser import HTMLParser
+from lib.file_hasher import FileHasher
+from lib.utils import UriLoader, Utils
+from urllib.parse import unquote
+import binascii
+import codecs
+import data_url
+import html
+import os
+import re
+
+# USER CELL STREAM ================================================================================
+# Reads a saved followers or following page a piece at a time, and hands back the HTML of each user's
+# cell (a <div> with data-testid="cellInnerDiv", inside the timeline <div>) as soon as we've read to the
+# end of it. Nothing else of the page is kept, so however big the page is, we only ever hold one chunk
+# of the file and one cell in memory.
+#
+# Example:
+#   cells = UserCellStream('followers.html', 'Timeline: Followers')
+#   for cell_html in cells:
+#       cell = BeautifulSoup(cell_html, 'html.parser')
+#       ...
+#   print(cells.title, cells.progress)
+class UserCellStream(HTMLParser):
+
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, filename, timeline_label):
+        # Character references are passed through untouched, so the cell HTML we hand back is exactly
+        # what was in the page.
+        super().__init__(convert_charrefs=False)
+        self.filename = filename
+        self.timeline_label = timeline_label
+        self.title = None
+        self.progress = 0                       # How far through the file we are, from 0 to 1
+        self.__in_title = False
+        self.__timeline_depth = 0               # Open <div>s inside the timeline, including itself
+        self.__cell_depth = 0                   # Open <div>s inside the current cell, including itself
+        self.__cell = []
+        self.__cells = []
+
+    def __iter__(self):
+        file_size = os.path.getsize(self.filename) or 1
+        decoder = codecs.getincrementaldecoder('utf8')(errors='replace')
+        bytes_read = 0
+        with open(self.filename, 'rb') as f:
+            while True:
+                chunk = f.read(UserCellStream.CHUNK_SIZE)
+                if not chunk:
+                    break
+                bytes_read += len(chunk)
+                self.feed(decoder.decode(chunk))
+                self.progress = bytes_read / file_size
+                yield from self.__take_cells()
+        self.feed(decoder.decode(b'', final=True))
+        self.close()
+        yield from self.__take_cells()
+
+    def __take_cells(self):
+        cells, self.__cells = self.__cells, []
+        return cells
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'title' and self.title is None:
+            self.__in_title = True
+            self.title = ''
+        if tag == 'div':
+            if self.__timeline_depth:
+                self.__timeline_depth += 1
+                if self.__cell_depth:
+                    self.__cell_depth += 1
+                elif ('data-testid', 'cellInnerDiv') in attrs:
+                    self.__cell_depth = 1
+                    self.__cell = []
+            elif ('aria-label', self.timeline_label) in attrs:
+                self.__timeline_depth = 1
+        if self.__cell_depth:
+            self.__cell.append(self.get_starttag_text())
+
+    def handle_startendtag(self, tag, attrs):
+        if self.__cell_depth:
+            self.__cell.append(self.get_starttag_text())
+
+    def handle_endtag(self, tag):
+        if tag == 'title':
+            self.__in_title = False
+        if self.__cell_depth:
+            self.__cell.append(f'</{tag}>')
+        if tag == 'div':
+            if self.__cell_depth:
+                self.__cell_depth -= 1
+                if not self.__cell_depth:
+                    self.__cells.append(''.join(self.__cell))
+                    self.__cell = []
+            if self.__timeline_depth:
+                self.__timeline_depth -= 1
+
+    def handle_data(self, data):
+        if self.__in_title:
+            self.title += data
+        if self.__cell_depth:
+            self.__cell.append(data)
+
+    def handle_entityref(self, name):
+        if self.__in_title:
+            self.title += html.unescape(f'&{name};')
+        if self.__cell_depth:
+            self.__cell.append(f'&{name};')
+
+    def handle_charref(self, name):
+        if self.__in_title:
+            self.title += html.unescape(f'&#{name};')
+        if self.__cell_depth:
+            self.__cell.append(f'&#{name};')
+
+    def handle_comment(self, data):
+        if self.__cell_depth:
+            self.__cell.append(f'<!--{data}-->')
+
+
+# LXML USER CELL STREAM ===========================================================================
+# The same as UserCellStream, but using lxml's parser, which is written in C and much faster. lxml
+# builds the page as a tree as it goes, so we clear out everything we've finished with (each cell once
+# it's handed back, and everything outside them straight away), so the tree never gets any bigger than
+# the cell we're in the middle of.
+class LxmlUserCellStream:
+
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, filename, timeline_label):
+        self.filename = filename
+        self.timeline_label = timeline_label
+        self.title = None
+        self.progress = 0
+
+    def __iter__(self):
+        from lxml import etree
+        # huge_tree, as the avatars and emojis in the saved pages are data URLs, which can be very long.
+        parser = etree.HTMLPullParser(events=('start', 'end'), encoding='utf-8', huge_tree=True)
+        file_size = os.path.getsize(self.filename) or 1
+        bytes_read = 0
+        timeline = None
+        cell = None
+        with open(self.filename, 'rb') as f:
+            while True:
+                chunk = f.read(LxmlUserCellStream.CHUNK_SIZE)
+                if chunk:
+                    bytes_read += len(chunk)
+                    parser.feed(chunk)
+                    self.progress = bytes_read / file_size
+                else:
+                    parser.close()
+                for event, element in parser.read_events():
+                    if event == 'start':
+                        if element.tag != 'div':
+                            continue
+                        if timeline is None:
+                            if element.get('aria-label') == self.timeline_label:
+                                timeline = element
+                        elif cell is None and element.get('data-testid') == 'cellInnerDiv':
+                            cell = element
+                        continue
+                    if element is cell:
+                        cell = None
+                        yield etree.tostring(element, encoding='unicode', method='html', with_tail=False)
+                    elif element is timeline:
+                        timeline = None
+                    elif cell is not None:
+                        continue                # Still needed, until the cell it's in is finished with.
+                    elif element.tag == 'title' and self.title is None:
+                        self.title = element.text or ''
+                    # Done with this element, and everything before it.
+                    element.clear(keep_tail=True)
+                    while element.getprevious() is not None:
+                        del element.getparent()[0]
+                if not chunk:
+                    break
+
+
+# USER CELL =======================================================================================
+# Pulls the details of a user out of one of the cells from the followers or following page.
+#
+# Example:
+#   for cell_html in UserCell.stream('followers.html', 'Timeline: Followers'):
+#       username, screen_name, description, follow_state, avatar_url = UserCell.extract(cell_html)
+class UserCell:
+
+    BATCH_SIZE = 50                 # Cells sent to a worker process at a time
+    # The image type of an avatar data URL. (eg. 'data:image/webp;base64,...')
+    AVATAR_DATA_URL_TYPE = re.compile(r'data:image/([\w.+-]+)[;,]', re.IGNORECASE)
+    # Emojis in descriptions are SVG images, as data URLs.
+    EMOJI_DATA_URL = re.compile(r'data:image/svg\+xml[;,][^"\'\\\s<>]*')
+    EMOJI_FOLDER = 'assets/images/emoji'
+    emoji_urls = {}                 # Emoji data URL -> URL of the file it's been saved as, in this process
+    # Lower-cased usernames of the users we're interested in, (None for everyone) so we don't save the
+    # avatars of anyone else. Set in each worker process by set_known_usernames.
+    known_usernames = None
+
+    @staticmethod
+    def set_known_usernames(usernames):
+        UserCell.known_usernames = usernames
+
+    # The cells from a page, read with the given HTML backend (see Utils.select_html_backend).
+    @staticmethod
+    def stream(filename, timeline_label, backend = 'html.parser'):
+        if backend == 'lxml':
+            return LxmlUserCellStream(filename, timeline_label)
+        return UserCellStream(filename, timeline_label)
+
+    # Extracts a batch of cells, in order. (This is what runs in the worker processes.)
+    #
+    # If the page was saved with the images as data URLs, and we're given the output folder, the avatars
+    # and emojis are saved there as we go, (see save_avatar and save_emojis) so only their URLs come back,
+    # rather than a long data URL per user, and per emoji. Returns (username, screen name, description,
+    # follow state, avatar URL, local URL) for each cell.
+    @staticmethod
+    def extract_batch(cells, backend = 'html.parser', output_folder = None, sharded = False, emoji_url_base = '/assets/images/emoji/'):
+        results = []
+        for cell_html in cells:
+            username, screen_name, description, follow_state, avatar_url = UserCell.extract(cell_html, backend)
+            if output_folder and description:
+                description = UserCell.save_emojis(description, output_folder, emoji_url_base)
+            local_url = None
+            if output_folder and avatar_url and avatar_url.startswith('data:image') and username:
+                if UserCell.known_usernames is None or username.lower() in UserCell.known_usernames:
+                    local_url = UserCell.save_avatar(avatar_url, output_folder, sharded)
+                    if local_url:
+                        avatar_url = None
+            results.append((username, screen_name, description, follow_state, avatar_url, local_url))
+        return results
+
+    # Saves an avatar data URL as a file in the avatar folder, named after the hash of its contents, so
+    # users with the same picture share one file. Returns its URL, relative to the website root, or None
+    # if it couldn't be decoded.
+    @staticmethod
+    def save_avatar(avatar_url, output_folder, sharded = False):
+        # Anything that isn't an image is left alone, so the user keeps the default avatar.
+        image_type = UserCell.AVATAR_DATA_URL_TYPE.match(avatar_url)
+        if image_type is None:
+            return None
+        image_data = UserCell.decode_data_url(avatar_url)
+        if image_data is None:
+            return None
+        sub_type = image_type.group(1).lower()
+        file_ext = UriLoader.MIME_EXTENSIONS.get(sub_type, sub_type)
+        content_hash = FileHasher.hash_data(image_data)
+        avatar_folder = 'assets/images/users'
+        if sharded:
+            avatar_folder += '/' + content_hash[:2]
+        local_url = f'{avatar_folder}/{content_hash}.{file_ext}'
+        UserCell.write_once(image_data, os.path.join(output_folder, local_url))
+        return local_url
+
+    # Saves each emoji in a description as assets/images/emoji/<hash of its contents>.svg, and points the
+    # description at that instead. The same few hundred emojis turn up over and over, so this way each is
+    # only in the website once, rather than in every description, in users.js, and in users.yml. The URLs
+    # are from the site root: the templates put the site's baseurl in front. (See _includes/twitter-user.html.)
+    @staticmethod
+    def save_emojis(description, output_folder, emoji_url_base = '/assets/images/emoji/'):
+        def save_emoji(match):
+            emoji_data_url = match.group(0)
+            emoji_url = UserCell.emoji_urls.get(emoji_data_url)
+            if emoji_url is None:
+                emoji_data = UserCell.decode_data_url(emoji_data_url)
+                if emoji_data is None:
+                    return emoji_data_url
+                content_hash = FileHasher.hash_data(emoji_data)
+                UserCell.write_once(emoji_data, os.path.join(output_folder, UserCell.EMOJI_FOLDER, content_hash + '.svg'))
+                emoji_url = emoji_url_base + content_hash + '.svg'
+                UserCell.emoji_urls[emoji_data_url] = emoji_url
+            return emoji_url
+        return UserCell.EMOJI_DATA_URL.sub(save_emoji, description)
+
+    # The files (relative to the output folder) saved for a user by extract_batch.
+    @staticmethod
+    def saved_files(description, local_url, emoji_url_base = '/assets/images/emoji/'):
+        files = []
+        if local_url:
+            files.append(local_url)
+        if description:
+            for content_hash in re.findall(re.escape(emoji_url_base) + r'([0-9a-f]+)\.svg', description):
+                files.append(f'{UserCell.EMOJI_FOLDER}/{content_hash}.svg')
+        return files
+
+    # The contents of a data URL, or None if it's not one we can read.
+    @staticmethod
+    def decode_data_url(url):
+        try:
+            decoded_url = data_url.DataURL.from_url(url)
+        except (binascii.Error, ValueError):
+            return None
+        if decoded_url is None:
+            return None
+        if isinstance(decoded_url.data, str):         # Not base64, so it's percent-encoded text
+            return unquote(decoded_url.data).encode('utf8')
+        return decoded_url.data
+
+    # Writes a content-addressed file, unless it's already there.
+    @staticmethod
+    def write_once(data, output_filename):
+        if os.path.exists(output_filename):
+            return
+        os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+        # Other workers may be writing the same file, so each writes its own temporary file.
+        tmp_filename = f'{output_filename}.{os.getpid()}.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_filename, output_filename)
+
+    # Extract user information from the a fragment of HTML of the followers/following page. As the HTML
+    # fragment contains lots of divs within divs, which loads of inscrutable class names which suspiciously
+    # look like they're generated by a UI framework like Angular or React, we have to think laterally in
+    # how we extract from the HTML. We're using the BeautifulSoup library to parse.
+    #
+    # Returns the username, screen name, description, follow state and avatar URL, any of which may be None.
+    # (Working out which user it is from the username is up to the caller.)
+    @staticmethod
+    def extract(cell_html, backend = 'html.parser'):
+        follower_node = BeautifulSoup(cell_html, backend)
+        # First, to make things easier, we extract the bit that's 
+        # easy to extract. The user cell, which is in a <button> tag (!!!) with the data-testid
+        # attribute set to 'UserCell'.
+        user_cell_search = follower_node.find_all('button', attrs={'data-testid': 'UserCell'})
+        if not len(user_cell_search) > 0:
+            return None, None, None, None, None
+        user_cell = user_cell_search[0]
+                
+        # Getting the username is a bit tricky. It's in a <span> class with the inline style attribute
+        # 'text-overflow:unset', and there are a lot of those! So we look for ones that contain text starting
+        # with '@' and extract that. We also have to verify this, as a lot of people put the usernames of their
+        # other social media on the screen name and descriptions. Luckily, the <span> is contained within an
+        # <a> tag three parents up with the href attribute set to the user's profile URL. (https//x.com/[username without @])
+        style_spans = user_cell.select('span[style*="text-overflow:unset"]')    # There may be more than one of these.
+        username = None
+        a_tag = None
+        for style_span in style_spans:
+            span_text = style_span.string
+            if span_text:
+                if span_text.startswith('@'):
+                    username = span_text.replace('@', '')
+            # For the verification, we look for the <a> tag three parents up.
+            if username:
+                a_tag = style_span.parent.parent.parent
+                if a_tag.name == 'a':
+                    test_url = 'https://x.com/' + username
+                    actual_url = a_tag['href']
+                    if test_url == actual_url:
+                        break
+                    else:
+                        username = None
+        
+        # We're going to use the <a> to get to the node containing the screen name, as we can
+        # just go up two parents, and it's contained in the previous sibling next to it.
+        screen_name = None
+        if a_tag:
+            screen_name_tag = a_tag.parent.parent.previous_sibling
+            if screen_name_tag:
+                screen_name =" ".join(el.strip() for el in screen_name_tag.strings)
+                if screen_name:
+                    screen_name = '"' + screen_name + '"'
+                #print('Screen name:', screen_name)
+        
+        # The easiest thing to extract is the avatar, which is a div with an inline style attribute
+        # containing a background-image CSS property (!) pointing to the avatar.
+        avatar_url = None
+        avatar_tag = user_cell.select('div[style*="background-image"]')
+        if avatar_tag:
+            avatar_style = str(avatar_tag[0]['style'])
+            #print('avatar_style:', avatar_style)
+            avatar_url_search = re.search(r'url\((.*?)\)', avatar_style)
+            if avatar_url_search:
+                avatar_url = avatar_url_search.group(1).strip('"\'')
+            else:
+                avatar_url = None
+                    
+        # Get "follow/following" state. This is 4 parents up from the <a>, and the next sibling along
+        follow_state = None
+        follow_state_tag = None
+        if a_tag:
+            follow_state_tag = a_tag.parent.parent.parent.parent.next_sibling
+            if follow_state_tag:
+                #follow_state = follow_state_tag.string
+                follow_state = " ".join(el.strip() for el in follow_state_tag.strings)
+                follow_state = follow_state.split(' ')[0].lower()
+                #print('Follow state:', follow_state)
+                
+        # This is where it gets dirty! The desciption text is up a parent, and then the next sibling,
+        # we can't use the '.string' method to get it as it's a div tag containing a series of <span>, <div>
+        # or <a> tags, containing parts of the description text in order. For example, links are in separate 
+        # <span> tags. This also contains emojis, which are in <img> containing a data url for an SVG image. (Quite a good
+        # idea, really, as it means they're compatible across devices.)
+        description_tag = None
+        description = None
+        if follow_state_tag:
+            description_tag = follow_state_tag.parent.next_sibling
+            if description_tag:
+                description_parts = description_tag.findChildren(recursive=False)
+                if description_parts:
+                    description = ''
+                    for part in description_parts:
+                        if part:
+                            link_start = ''
+                            if part.name == 'img':
+                                description += '<img src=\\\"' + part['src'] + '\\\"/>'
+                            else:
+                                for content in part.contents:
+                                    if content:
+                                        content_result = ''
+                                        if content.name == 'span':
+                                            content_result += str(content.text)
+                                            if content_result.startswith('http'):
+                                                link_start = content_result
+                                                content_result = ''
+                                        elif content.name == 'div':
+                                            twitter_handle = content.select('a')
+                                            if twitter_handle:
+                                                content_result = '<a href=\"' + twitter_handle[0]['href'] + '\">' + twitter_handle.text + '</a>'
+                                            else:
+                                                content_result = str(content)
+                                        else:
+                                            if link_start != '':
+                                                content_result = '<a href=\"' + link_start + str(content) + '\">' + str(content) + '</a>' 
+                                                link_start = ''
+                                            else:
+                                                content_result = str(content)
+                                        if content_result != '':
+                                            description += str(content_result).replace('\n', '<br/>').replace('\"', '\\\"')
+                    if description != '':
+                        description = '"' + Utils.sanitise_html(description) + '"'
+                        description = description.replace('\'\\\"', '\\\"').replace('\\\"\'', '\\\"')
+        return username, screen_name, description, follow_state, avatar_url
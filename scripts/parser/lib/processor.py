@@ -1,18 +1,28 @@
-from bs4 import BeautifulSoup
-from filecmp import cmp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from lib.config import Config
+from lib.file_hasher import FileHasher
+from lib.http_cache import HttpCache
+from lib.image_variants import ImageVariants
+from lib.link_resolver import LinkResolver
+from lib.media_info import MediaInfo
+from lib.network import AdaptiveRateController, Downloader
+from lib.page_cache import PageCache
+from lib.page_parser import UserCell
+from lib.media_store import MediaStore
+from lib.retry_queue import RetryQueue
 from lib.ui import ProgressWindow
+from lib.user_pages import UserPages
 from lib.user_profile import UserProfile
 from lib.utils import *
 from lib.tweet import Tweet, Media, DateStats
 from tkinter import messagebox
-import data_url
 import glob
 import json
 import os
+import queue
 import re
 import shutil
-import time
+import threading
 
 class Processor:
 
@@ -27,15 +37,23 @@ class Processor:
         self.__media = None
         self.__hastags = None
         self.__users = None
+        self.__mentions = None                  # User ID -> latest username and screen name they were mentioned with, and how often
+        self.__user_ids_by_username = None      # Lower-cased username -> user ID, for everyone in self.__users
         self.__data_directory = None
         self.__assets_directory = None
         self.__tweet_filenames = []
         self.__tweet_media_folder = None
         self.__process_window = None
-        self.__MAX_STEPS = 15
+        self.__MAX_STEPS = 20
         self.__CURRENT_STEP = 0
         self.__tweetstats = None
         self.__threadstats = None
+        self.__media_store = None
+        self.__file_hasher = None
+        self.__retry_queue = None
+        self.__link_resolver = None
+        self.__page_cache = None
+        self.__avatar_index = {}
     
     # Check if the directory is a Twitter archive
     def is_twitter_archive(self, directory):
@@ -119,6 +137,7 @@ class Processor:
         
         self.__tweet_filenames = self.__find_tweet_files( self.config.data_folder )
         self.__tweet_media_folder = self.__find_media_folder( self.config.data_folder )
+        self.__open_caches()
         
         self.__process_window = ProgressWindow()
         self.__process_window.thread(self.process_steps)
@@ -128,19 +147,23 @@ class Processor:
             self.__copy_jekyll_files()              # Step 1
             self.__get_user_profile()               # Step 2
             self.__read_tweets()                    # Step 3
+            self.__resolve_short_links()            # Step 3a
             self.__copy_local_media()               # Step 4
             self.__download_missing_media()         # Step 5
+            self.__read_media_dimensions()          # Step 5a
+            self.__upgrade_media_quality()          # Step 5b
             self.__write_hashtag_pages()            # Step 6
             self.__analyse_followers_following()    # Step 7
-            self.__parse_followers_page()           # Step 8
-            self.__parse_following_page()           # Step 9
+            self.__parse_followers_following_pages()    # Steps 8 and 9
             self.__save_users_avatars()             # Step 10 
+            self.__make_image_variants()            # Step 10a
             self.__save_followers_following()       # Step 11
             self.__analyse_retweets()               # Step 12
             self.__analyse_threads()                # Step 13
             self.__consolidate_media()              # Step 14
             self.__write_tweets()                   # Step 15
             self.__clear_duplicates()               # Step 16
+            self.__save_caches()
             
             self.processing = False
             
@@ -156,135 +179,141 @@ class Processor:
     def __next_step(self):
         self.__CURRENT_STEP += 1
         self.__process_window.update_top_progress(int((self.__CURRENT_STEP / self.__MAX_STEPS) * 100))
-    
-    # Extract user information from the a fragment of HTML of the followers/following page. As the HTML
-    # fragment contains lots of divs within divs, which loads of inscrutable class names which suspiciously
-    # look like they're generated by a UI framework like Angular or React, we have to think laterally in
-    # how we extract from the HTML. We're using the BeautifulSoup library to parse.
-    def __extract_user_data_from_html(self, follower_node, follower_id, output_dir, user_list):
-        sleep_time = self.config.sleep_time
-        # First, to make things easier, we extract the bit that's 
-        # easy to extract. The user cell, which is in a <button> tag (!!!) with the data-testid
-        # attribute set to 'UserCell'.
-        user_cell_search = follower_node.find_all('button', attrs={'data-testid': 'UserCell'})
-        if not len(user_cell_search) > 0:
-            return None, None, None, None, None, None, None
-        user_cell = user_cell_search[0]
-                
-        # Getting the username is a bit tricky. It's in a <span> class with the inline style attribute
-        # 'text-overflow:unset', and there are a lot of those! So we look for ones that contain text starting
-        # with '@' and extract that. We also have to verify this, as a lot of people put the usernames of their
-        # other social media on the screen name and descriptions. Luckily, the <span> is contained within an
-        # <a> tag three parents up with the href attribute set to the user's profile URL. (https//x.com/[username without @])
-        style_spans = user_cell.select('span[style*="text-overflow:unset"]')    # There may be more than one of these.
-        username = None
-        a_tag = None
-        for style_span in style_spans:
-            span_text = style_span.string
-            if span_text:
-                if span_text.startswith('@'):
-                    username = span_text.replace('@', '')
-            # For the verification, we look for the <a> tag three parents up.
-            if username:
-                a_tag = style_span.parent.parent.parent
-                if a_tag.name == 'a':
-                    test_url = 'https://x.com/' + username
-                    actual_url = a_tag['href']
-                    if test_url == actual_url:
-                        break
-                    else:
-                        username = None
         
-        # If we've got the username, we can get the user ID from the user list.
-        user_id = None       
-        if username:
-            user_id = UserProfile.find_id_for_username(username, user_list)
-        else:
-            user_id = follower_id   # <- If don't have an id, allocate one.
-            print('user_id:', user_id)
-            
-        # We're going to use the <a> to get to the node containing the screen name, as we can
-        # just go up two parents, and it's contained in the previous sibling next to it.
-        screen_name = None
-        if a_tag:
-            screen_name_tag = a_tag.parent.parent.previous_sibling
-            if screen_name_tag:
-                screen_name =" ".join(el.strip() for el in screen_name_tag.strings)
-                if screen_name:
-                    screen_name = '"' + screen_name + '"'
-                #print('Screen name:', screen_name)
-        
-        # The easiest thing to extract is the avatar, which is a div with an inline style attribute
-        # containing a background-image CSS property (!) pointing to the avatar.
-        avatar_url = None
-        local_url = None
-        avatar_tag = user_cell.select('div[style*="background-image"]')
-        if avatar_tag:
-            avatar_style = str(avatar_tag[0]['style'])
-            #print('avatar_style:', avatar_style)
-            avatar_url_search = re.search(r'url\((.*?)\)', avatar_style)
-            if avatar_url_search:
-                avatar_url = avatar_url_search.group(1)
-            else:
-                avatar_url = None
-                    
-        # Get "follow/following" state. This is 4 parents up from the <a>, and the next sibling along
-        follow_state = None
-        follow_state_tag = None
-        if a_tag:
-            follow_state_tag = a_tag.parent.parent.parent.parent.next_sibling
-            if follow_state_tag:
-                #follow_state = follow_state_tag.string
-                follow_state = " ".join(el.strip() for el in follow_state_tag.strings)
-                follow_state = follow_state.split(' ')[0].lower()
-                #print('Follow state:', follow_state)
-                
-        # This is where it gets dirty! The desciption text is up a parent, and then the next sibling,
-        # we can't use the '.string' method to get it as it's a div tag containing a series of <span>, <div>
-        # or <a> tags, containing parts of the description text in order. For example, links are in separate 
-        # <span> tags. This also contains emojis, which are in <img> containing a data url for an SVG image. (Quite a good
-        # idea, really, as it means they're compatible across devices.)
-        description_tag = None
-        description = None
-        if follow_state_tag:
-            description_tag = follow_state_tag.parent.next_sibling
-            if description_tag:
-                description_parts = description_tag.findChildren(recursive=False)
-                if description_parts:
-                    description = ''
-                    for part in description_parts:
-                        if part:
-                            link_start = ''
-                            if part.name == 'img':
-                                description += '<img src=\\\"' + part['src'] + '\\\"/>'
-                            else:
-                                for content in part.contents:
-                                    if content:
-                                        content_result = ''
-                                        if content.name == 'span':
-                                            content_result += str(content.text)
-                                            if content_result.startswith('http'):
-                                                link_start = content_result
-                                                content_result = ''
-                                        elif content.name == 'div':
-                                            twitter_handle = content.select('a')
-                                            if twitter_handle:
-                                                content_result = '<a href=\"' + twitter_handle[0]['href'] + '\">' + twitter_handle.text + '</a>'
-                                            else:
-                                                content_result = str(content)
-                                        else:
-                                            if link_start != '':
-                                                content_result = '<a href=\"' + link_start + str(content) + '\">' + str(content) + '</a>' 
-                                                link_start = ''
-                                            else:
-                                                content_result = str(content)
-                                        if content_result != '':
-                                            description += str(content_result).replace('\n', '<br/>').replace('\"', '\\\"')
-                    if description != '':
-                        description = '"' + Utils.sanitise_html(description) + '"'
-                        description = description.replace('\'\\\"', '\\\"').replace('\\\"\'', '\\\"')
-        return user_id, username, screen_name, description, follow_state, avatar_url, local_url
+    # Sets up the caches and the network, for a conversion or a retry of failed downloads.
+    def __open_caches(self):
+        self.__file_hasher = FileHasher(self.config.hash_cache_filename)
+        self.__media_store = self.__open_media_store()
+        self.__retry_queue = RetryQueue(self.config.retry_queue_filename)
+        self.__link_resolver = LinkResolver(self.config, self.config.link_cache_filename)
+        self.__page_cache = PageCache(self.config.page_cache_filename)
+        self.__avatar_index = self.__load_avatar_index()
+        UriLoader.http_cache = HttpCache(self.config.http_cache_folder, 
+                                         (self.config.http_cache_max_size or 0) * 1024 * 1024,
+                                         (self.config.http_cache_max_age_days or 0) * 24 * 60 * 60,
+                                         self.config.offline)
+        # One rate controller for every step that goes out to the network, so what one step learns
+        # about a server (eg. that it's telling us to slow down) carries over to the next.
+        UriLoader.rate_controller = AdaptiveRateController(self.config.host_requests_per_second or (1 / self.config.sleep_time if self.config.sleep_time else 10),
+                                                           self.config.download_workers or 1)
+        Utils.select_html_backend(self.config.html_parser)
+        
+    # Which remote avatar URL gave which file in the avatar folder, from previous runs.
+    def __load_avatar_index(self):
+        if not self.config.avatar_index_filename or not os.path.exists(self.config.avatar_index_filename):
+            return {}
+        try:
+            with open(self.config.avatar_index_filename, 'r', encoding='utf8') as f:
+                return json.loads(f.read())
+        except Exception as e:
+            print(f"Error loading avatar index: {e}")
+            return {}
         
+    # The shared media store is optional- if there's no folder set in the config, we just copy
+    # and download files as normal.
+    def __open_media_store(self):
+        if not self.config.media_store_folder:
+            return None
+        max_size = (self.config.media_store_max_size or 0) * 1024 * 1024
+        return MediaStore(self.config.media_store_folder, max_size, self.__file_hasher)
+    
+    # Trim and save the caches we've used during the run, ready for the next one.
+    def __save_caches(self):
+        if self.__media_store:
+            if self.__process_window:
+                self.__process_window.status('Tidying up media store...')
+            self.__media_store.evict()
+            self.__media_store.save()
+        if self.__file_hasher:
+            self.__file_hasher.save()
+        if UriLoader.http_cache:
+            http_cache = UriLoader.http_cache
+            print(f'HTTP cache: {http_cache.hits} hits, {http_cache.revalidated} revalidated, {http_cache.misses} fetched.')
+            http_cache.evict()
+            http_cache.save()
+        if self.__link_resolver:
+            self.__link_resolver.save()
+        if self.__page_cache:
+            self.__page_cache.save()
+        if self.config.avatar_index_filename:
+            tmp_filename = self.config.avatar_index_filename + '.tmp'
+            with open(tmp_filename, 'w', encoding='utf8') as f:
+                f.write(json.dumps(self.__avatar_index))
+            os.replace(tmp_filename, self.config.avatar_index_filename)
+        if self.__retry_queue is not None:
+            if len(self.__retry_queue):
+                print(f'{len(self.__retry_queue)} downloads failed. Run `python main.py --retry-failed` to try them again.')
+            self.__retry_queue.save()
+    
+    # Tidy up the shared media store without doing a conversion. (See main.py)
+    def garbage_collect_media_store(self, unlinked_only = False):
+        media_store = self.__open_media_store()
+        if not media_store:
+            return None
+        return media_store.garbage_collect(unlinked_only)
+    
+    # Try the downloads that failed during the last conversion again, without doing the whole conversion,
+    # and patch the status pages and data files they should have been in. (See main.py) Returns the number
+    # fixed and the number still failing, or None if there's nothing to retry.
+    def retry_failed_downloads(self):
+        self.__open_caches()
+        if not len(self.__retry_queue):
+            return None
+        jobs = [(RetryQueue.key(entry['kind'], entry['id']), entry['url'], entry['filename']) for entry in self.__retry_queue.items()]
+        fixed = 0
+        with Downloader(self.config) as downloader:
+            for key, loader in downloader.fetch_all(jobs):
+                entry = self.__retry_queue.entries[key]
+                if not loader.success:
+                    self.__retry_queue.add(entry['kind'], entry['id'], entry['url'], entry['filename'], loader.error)
+                    print(f"Still failing: {entry['url']} ({loader.error}, {entry['attempts']} attempts)")
+                    continue
+                if entry['kind'] == 'media':
+                    self.__patch_retried_media(entry)
+                else:
+                    self.__patch_retried_avatar(entry, loader.guess_ext())
+                self.__retry_queue.remove(entry['kind'], entry['id'])
+                fixed += 1
+        self.__save_caches()
+        return fixed, len(self.__retry_queue)
+    
+    # A media file has turned up on a retry: add it to the status pages that were missing it, and to the
+    # tweets in the Javascript data.
+    def __patch_retried_media(self, entry):
+        output_filename = entry['filename']
+        media_obj = Media(entry['id'], url=entry['url'], type=entry['type'], local_filename=output_filename, downloaded=True,
+                          duration_millis=entry.get('duration_millis'))
+        if media_obj.duration_millis:
+            media_obj.video_info = { 'duration_millis': media_obj.duration_millis }
+        if self.__media_store:
+            media_obj.content_hash = self.__media_store.add_file(output_filename, media_obj.url, move=True)
+            self.__media_store.link(media_obj.content_hash, output_filename)
+        media_obj.file_size = os.path.getsize(output_filename)
+        width, height = MediaInfo.read_dimensions(output_filename)
+        if width and height:
+            media_obj.set_dimensions(width, height)
+        media_obj.local_filename = media_obj.relative_filename(self.config.output_folder)
+        tweet_ids = []
+        for page_filename in entry.get('pages', []):
+            if os.path.exists(page_filename):
+                Tweet.add_media_to_page(page_filename, media_obj)
+                tweet_ids.append(os.path.splitext(os.path.basename(page_filename))[0])
+        tweets_output_json_filename = os.path.join(self.config.output_json_folder_name, 'tweets.js')
+        if tweet_ids and os.path.exists(tweets_output_json_filename):
+            variable_name, tweets_data = Utils.read_js_data_file(tweets_output_json_filename)
+            for tweet_data in tweets_data:
+                if tweet_data['id'] in tweet_ids:
+                    tweet_media = tweet_data.setdefault('media', [])
+                    if not any(media_data['id'] == media_obj.id for media_data in tweet_media):
+                        tweet_media.append(media_obj.as_dict(self.config.output_folder))
+            Utils.write_js_data_file(tweets_output_json_filename, variable_name, tweets_data)
+    
+    # An avatar has turned up on a retry: put it in place, and point the user at it in the data files.
+    def __patch_retried_avatar(self, entry, file_ext):
+        user_ids = entry.get('user_ids', [entry['id']])
+        local_url = self.__store_avatar(file_ext, entry['url'], downloaded_filename=entry['filename'])
+        UserPages(self.config.output_json_folder_name, self.config.output_users_filename).set_local_url(user_ids, local_url)
+    
     # Step 1: Copy the Norwegian Blue Jekyll template files to the output directory
     def __copy_jekyll_files(self):
         self.__process_window.top_status('Copying Norwegian Blue template files...')
@@ -319,7 +348,6 @@ class Processor:
         no_of_steps = 9
         self.__process_window.update_progress(int((step / no_of_steps)*100))
         self.__process_window.top_status('Getting user profile...')
-        sleep_time= self.config.sleep_time
         download_media = self.config.download_media 
         self.__process_window.status('Reading profile data...')
         
@@ -378,7 +406,6 @@ class Processor:
                     if urls:
                         website = urls[0]
                 self.__user_profile.url = website
-                time.sleep(sleep_time)
         step += 1
         self.__process_window.update_progress(int((step / no_of_steps)*100))
         
@@ -386,12 +413,9 @@ class Processor:
         if avatar_url and download_media:      
             self.__process_window.status('Downloading avatar...')
             avatar_file = os.path.join(self.config.output_assets_images_folder, 'avatar' + avatar_url_ext)
-            with UriLoader(avatar_url, self.config) as avatar_loader:
-                if avatar_loader.success:
-                    with open(avatar_file, 'wb') as f:
-                        f.write(avatar_loader.data.content)
-                        self.__user_profile.local_url = avatar_file.replace(self.config.output_folder, '')
-                time.sleep(sleep_time)
+            avatar_loader = UriLoader(avatar_url, self.config)
+            if avatar_loader.download(avatar_file):
+                self.__user_profile.local_url = avatar_file.replace(self.config.output_folder, '')
         step += 1
         self.__process_window.update_progress(int((step / no_of_steps)*100))
         
@@ -400,14 +424,13 @@ class Processor:
         # extension here, so we have to infer it from the content-type.
         if header_url and download_media:
             self.__process_window.status('Downloading header...')
-            with UriLoader(header_url, self.config) as header_loader:
-                if header_loader.success:
-                    header_ext = header_loader.guess_ext()
-                    header_file = os.path.join(self.config.output_assets_images_folder, 'header.' + header_ext)
-                    with open(header_file, 'wb') as f:
-                        f.write(header_loader.data.content)
-                        self.__user_profile.local_header_url = header_file.replace(self.config.output_folder, '')
-            time.sleep(sleep_time)
+            header_loader = UriLoader(header_url, self.config)
+            holding_filename = os.path.join(self.config.output_assets_images_folder, 'header.download')
+            if header_loader.download(holding_filename):
+                header_ext = header_loader.guess_ext() or MediaInfo.sniff_ext(holding_filename) or 'jpg'
+                header_file = os.path.join(self.config.output_assets_images_folder, 'header.' + header_ext)
+                os.replace(holding_filename, header_file)
+                self.__user_profile.local_header_url = header_file.replace(self.config.output_folder, '')
         step += 1
         self.__process_window.update_progress(int((step / no_of_steps)*100))
 
@@ -416,7 +439,6 @@ class Processor:
         timezone_data = Utils.read_json_file(os.path.join(self.config.data_folder, 'account-timezone.js'))
         timezone = timezone_data[0]['accountTimezone']['timeZone']
         self.__user_profile.timezone = timezone
-        time.sleep(sleep_time)
         step += 1
         self.__process_window.update_progress(int((step / no_of_steps)*100))
         
@@ -425,7 +447,6 @@ class Processor:
         birthdate_data = Utils.read_json_file(os.path.join(self.config.data_folder, 'ageinfo.js'))
         birthdate = birthdate_data[0]['ageMeta']['ageInfo'] ['birthDate']
         self.__user_profile.birthdate = birthdate
-        time.sleep(sleep_time)
         step += 1
         self.__process_window.update_progress(int((step / no_of_steps)*100))
         
@@ -437,7 +458,6 @@ class Processor:
         following = len(following_data)
         self.__user_profile.no_of_followers = followers
         self.__user_profile.no_following = following
-        time.sleep(sleep_time)
         step += 1
         self.__process_window.update_progress(int((step / no_of_steps)*100))
         
@@ -448,7 +468,6 @@ class Processor:
             tweet_data = Utils.read_json_file(tweet_filename)
             tweet_count += len(tweet_data)
         self.__user_profile.no_tweets = tweet_count
-        time.sleep(sleep_time)
         step += 1
         self.__process_window.update_progress(int((step / no_of_steps)*100))
 
@@ -457,7 +476,6 @@ class Processor:
         self.__user_profile.add_to_config_file(self.config.jekyll_config_filename)
         step += 1
         self.__process_window.update_progress(int((step / no_of_steps)*100))
-        time.sleep(sleep_time)
             
         self.__next_step()
         
@@ -469,6 +487,7 @@ class Processor:
         self.__tweets = {}
         self.__media = {}
         self.__hastags = {}
+        self.__mentions = {}
         self.__process_window.update_progress(0)
         for tweet_filename in self.__tweet_filenames:
             tweet_data = Utils.read_json_file(tweet_filename)
@@ -486,6 +505,7 @@ class Processor:
                     if hashtag not in self.__hastags:
                         self.__hastags[hashtag] = []
                     self.__hastags[hashtag].append(new_tweet.id)
+                self.__index_mentions(new_tweet)
                 tweet_count += 1
         # If a hashtag has only one tweet from your archive, then it's a bit of a waste of time
         # to create a whole page for it. So we'll remove hastags with only one tweet.
@@ -495,6 +515,47 @@ class Processor:
                 del self.__hastags[hashtag]
         self.__next_step()
         
+    # Notes the username and screen name of each user mentioned in a tweet, and how many times they've
+    # been mentioned. People change their names, so the ones from the latest tweet are kept.
+    def __index_mentions(self, tweet):
+        if not tweet.user_mentions:
+            return
+        for mention in tweet.user_mentions:
+            if 'id' not in mention:
+                continue
+            indexed_mention = self.__mentions.get(mention['id'])
+            if indexed_mention is None:
+                self.__mentions[mention['id']] = { 'username': mention.get('screen_name'), 'screen_name': mention.get('name'),
+                                                   'date': tweet.date, 'count': 1 }
+                continue
+            indexed_mention['count'] += 1
+            if tweet.date and indexed_mention['date'] and tweet.date > indexed_mention['date']:
+                indexed_mention['username'] = mention.get('screen_name')
+                indexed_mention['screen_name'] = mention.get('name')
+                indexed_mention['date'] = tweet.date
+
+    # Step 3a: Find out where the short links in the tweets go. Most tweets' links already have the full
+    # URL alongside the t.co one, but in some older ones it's missing, or is itself a bit.ly (etc.) link.
+    # Each distinct link is only looked up once, ever. (See LinkResolver.)
+    def __resolve_short_links(self):
+        self.__process_window.top_status('Resolving short links...')
+        self.__process_window.update_progress(0)
+        short_links = set()
+        for tweet_id in self.__tweets:
+            for url in self.__tweets[tweet_id].urls:
+                short_link = LinkResolver.short_link_for(url)
+                if short_link:
+                    short_links.add(short_link)
+        def progress(count, total):
+            self.__process_window.update_progress(int((count / total)*100))
+            self.__process_window.status(f'Resolving {count} of {total} links. ({UriLoader.rate_controller.describe()})')
+        if not self.config.offline:
+            self.__link_resolver.resolve_all(short_links, progress)
+        # Put the targets in the tweets now, so tweets.js and the tweet pages both get them.
+        for tweet_id in self.__tweets:
+            self.__tweets[tweet_id].resolve_urls(self.__link_resolver.links)
+        self.__next_step()
+        
     # Step 4: Copy local media files from the archive to the output directory
     def __copy_local_media(self):
         self.__process_window.top_status('Copying local media from archive...')
@@ -507,8 +568,19 @@ class Processor:
             local_filename = media_obj.make_local_filename(self.__tweet_media_folder)
             if local_filename:
                 if os.path.exists(local_filename):
-                    output_filename = media_obj.make_output_filename(output_folder)
-                    shutil.copy(local_filename, output_filename)
+                    output_filename = media_obj.make_output_filename(output_folder, self.config.sharded_media_layout)
+                    if self.__media_store:
+                        # The archive file's size and date are part of the key, in case a different archive
+                        # has been unzipped into the same folder since the last run.
+                        local_stat = os.stat(local_filename)
+                        source = f'{local_filename}|{local_stat.st_size}|{local_stat.st_mtime}'
+                        content_hash = self.__media_store.lookup_source(source)
+                        if not content_hash:
+                            content_hash = self.__media_store.add_file(local_filename, source)
+                        self.__media_store.link(content_hash, output_filename)
+                        self.__media[media_id].content_hash = content_hash
+                    else:
+                        shutil.copy(local_filename, output_filename)
                     self.__media[media_id].local_filename = output_filename
                     self.__media[media_id].file_size = os.path.getsize(output_filename)
                     self.__media[media_id].downloaded = True
@@ -518,39 +590,169 @@ class Processor:
         self.__next_step()
         
     # Step 5: Download any media files missing from the archive.
+    #
+    # Downloads run a few at a time through the Downloader, which keeps connections open, and the rate
+    # controller spaces out requests to each server, slowing down if the server asks us to. Results are
+    # handled here as they arrive, so only this thread ever touches the media list.
     def __download_missing_media(self):
         self.__process_window.top_status('Downloading media not in archive...')
         self.__process_window.update_progress(0)
-        sleep_time= self.config.sleep_time
         media_count = 0
         media_downloads = []
         # Work out how many to download
         for media_id in self.__media:
             if not self.__media[media_id].local_filename:
                 media_downloads.append(media_id)
+            else:
+                self.__retry_queue.remove('media', media_id)
         media_total = len(media_downloads)
         output_folder = self.config.output_media_folder_name
-        not_downloaded = 0
+        remote_downloads = []
         for media_id in media_downloads:
             media_obj = self.__media[media_id]
-            output_filename = media_obj.make_output_filename(output_folder)
-            with UriLoader(media_obj.url, self.config) as media_loader:
+            output_filename = media_obj.make_output_filename(output_folder, self.config.sharded_media_layout)
+            # If we've already downloaded this file on a previous run, we can get it from the media store.
+            if self.__media_store:
+                content_hash = self.__media_store.lookup_source(media_obj.url)
+                if content_hash:
+                    self.__media_store.link(content_hash, output_filename)
+                    self.__media[media_id].content_hash = content_hash
+                    self.__media[media_id].local_filename = output_filename
+                    self.__media[media_id].file_size = os.path.getsize(output_filename)
+                    self.__media[media_id].downloaded = True
+                    self.__retry_queue.remove('media', media_id)
+                    media_count += 1
+                    self.__process_window.update_progress(int((media_count / media_total)*100))
+                    self.__process_window.status(f'Downloading {media_count} of {media_total} media files.')
+                    continue
+            remote_downloads.append((media_id, media_obj.url, output_filename))
+        # Each file is streamed straight to disk by the worker threads, and picks up where it left
+        # off if a previous run was interrupted.
+        output_filenames = { media_id: output_filename for media_id, url, output_filename in remote_downloads }
+        with Downloader(self.config) as downloader:
+            for media_id, media_loader in downloader.fetch_all(remote_downloads):
+                output_filename = output_filenames[media_id]
                 if media_loader.success:
-                    with open(output_filename, 'wb') as f:
-                        f.write(media_loader.data.content)
+                    if self.__media_store:
+                        content_hash = self.__media_store.add_file(output_filename, self.__media[media_id].url, move=True)
+                        self.__media_store.link(content_hash, output_filename)
+                        self.__media[media_id].content_hash = content_hash
                     self.__media[media_id].local_filename = output_filename
                     self.__media[media_id].file_size = os.path.getsize(output_filename)
                     self.__media[media_id].downloaded = True    # <- Mark as downloaded. (The default is False.)
+                    self.__retry_queue.remove('media', media_id)
                 else:
-                    not_downloaded += 1
-            media_count += 1
-            self.__process_window.update_progress(int((media_count / media_total)*100))
-            self.__process_window.status(f'Downloading {media_count} of {media_total} media files.')
-            if not_downloaded > 0:
-                self.__process_window.top_status(f'Downloading media not in archive... ({not_downloaded} failed)')
-            time.sleep(sleep_time)
+                    # Keep a note of it, so it can be tried again later. (See retry_failed_downloads.)
+                    media_obj = self.__media[media_id]
+                    self.__retry_queue.add('media', media_id, media_obj.url, output_filename, media_loader.error,
+                                           type=media_obj.type, duration_millis=media_obj.duration_millis)
+                media_count += 1
+                self.__process_window.update_progress(int((media_count / media_total)*100))
+                self.__process_window.status(f'Downloading {media_count} of {media_total} media files. ({UriLoader.rate_controller.describe()})')
+                if downloader.failures:
+                    self.__process_window.top_status(f'Downloading media not in archive... ({len(downloader.failures)} failed)')
+            failure_summary = downloader.failure_summary()
+            if failure_summary:
+                print(f'Media downloads: {failure_summary}')
+                self.__process_window.top_status(f'Downloading media not in archive... ({failure_summary})')
+        self.__next_step()
+        
+    # Step 5a: Get the width and height of each media file, so the pages can reserve space for them
+    # before they load. Only the file headers are read, and these are spread over a few threads, as
+    # the time is nearly all spent waiting for the disk.
+    def __read_media_dimensions(self):
+        self.__process_window.top_status('Reading media dimensions...')
+        self.__process_window.update_progress(0)
+        media_ids = [media_id for media_id in self.__media if self.__media[media_id].local_filename]
+        media_total = len(media_ids)
+        media_count = 0
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            futures = { pool.submit(MediaInfo.read_dimensions, self.__media[media_id].local_filename): media_id for media_id in media_ids }
+            for future in as_completed(futures):
+                width, height = future.result()
+                if width and height:
+                    self.__media[futures[future]].set_dimensions(width, height)
+                media_count += 1
+                self.__process_window.update_progress(int((media_count / media_total)*100))
+                self.__process_window.status(f'Checking {media_count} of {media_total} media files.')
         self.__next_step()
         
+    # Step 5b: Optionally, swap photos for the original-quality versions on Twitter's servers. (The
+    # archive only has the web-sized version.)
+    #
+    # Rather than downloading every original just to compare it with what we have, we first ask for the
+    # first 64KB of each one. That's enough to tell us the size of the whole file, and the width and
+    # height from the image header, and only those that turn out to be bigger get downloaded in full.
+    def __upgrade_media_quality(self):
+        if not self.config.upgrade_media_quality or not self.config.download_media:
+            self.__next_step()
+            return
+        self.__process_window.top_status('Upgrading media to original quality...')
+        self.__process_window.update_progress(0)
+        probes = []
+        for media_id in self.__media:
+            media_obj = self.__media[media_id]
+            if media_obj.type != 'photo' or not media_obj.local_filename or not media_obj.url:
+                continue
+            original_url = media_obj.url.split('?')[0] + ':orig'
+            # Already upgraded on a previous run?
+            content_hash = self.__media_store.lookup_source(original_url) if self.__media_store else None
+            if content_hash:
+                self.__media_store.link(content_hash, media_obj.local_filename)
+                self.__set_upgraded_media(media_id, content_hash)
+                continue
+            probes.append((media_id, original_url))
+        media_total = len(probes)
+        media_count = 0
+        upgrades = []
+        with Downloader(self.config) as downloader:
+            for media_id, probe_loader in downloader.probe_all(probes):
+                media_count += 1
+                self.__process_window.update_progress(int((media_count / media_total)*50))
+                self.__process_window.status(f'Checking {media_count} of {media_total} photos. ({UriLoader.rate_controller.describe()})')
+                if probe_loader.success and self.__is_larger_media(self.__media[media_id], probe_loader):
+                    media_obj = self.__media[media_id]
+                    upgrades.append((media_id, probe_loader.uri, media_obj.local_filename + '.orig'))
+            media_total = len(upgrades)
+            media_count = 0
+            for media_id, media_loader in downloader.fetch_all(upgrades):
+                media_count += 1
+                self.__process_window.update_progress(50 + int((media_count / media_total)*50))
+                self.__process_window.status(f'Downloading {media_count} of {media_total} larger photos.')
+                if not media_loader.success:
+                    continue
+                media_obj = self.__media[media_id]
+                os.replace(media_loader.filename, media_obj.local_filename)
+                content_hash = None
+                if self.__media_store:
+                    content_hash = self.__media_store.add_file(media_obj.local_filename, media_loader.uri, move=True)
+                    self.__media_store.link(content_hash, media_obj.local_filename)
+                self.__set_upgraded_media(media_id, content_hash)
+            failure_summary = downloader.failure_summary()
+            if failure_summary:
+                print(f'Media upgrades: {failure_summary}')
+        self.__next_step()
+
+    # Whether the original on the server, going by the start of it we've probed, is better than ours: more
+    # pixels, or where we can't tell, more bytes.
+    def __is_larger_media(self, media_obj, probe_loader):
+        if not probe_loader.length:
+            return False
+        width, height = MediaInfo.read_dimensions_from_data(probe_loader.header)
+        if width and height and media_obj.width and media_obj.height:
+            if width * height != media_obj.width * media_obj.height:
+                return width * height > media_obj.width * media_obj.height
+        return probe_loader.length > os.path.getsize(media_obj.local_filename)
+
+    def __set_upgraded_media(self, media_id, content_hash):
+        media_obj = self.__media[media_id]
+        media_obj.file_size = os.path.getsize(media_obj.local_filename)
+        width, height = MediaInfo.read_dimensions(media_obj.local_filename)
+        if width and height:
+            media_obj.set_dimensions(width, height)
+        if content_hash:
+            media_obj.content_hash = content_hash
+        
     # Step 6: After going through the tweets, we've got all the information about hashtags used in the tweets.
     # So now we can create the pages for the hashtags.
     def __write_hashtag_pages(self):
@@ -605,208 +807,384 @@ class Processor:
             url = following['following']['userLink']
             following_user_profile = UserProfile(following_id, url=url, following=True)
             followers_following[following_id] = following_user_profile
-        # Second pass- go through the tweets and see if any of the users are mentioned in the tweets. This
-        # will give us the screen name and the user name, which we match up with the user ID. The next two
-        # steps will go through the followers/following pages, which will give us more information.
-        self.__process_window.top_status('Analysing tweets for mentions...')
+        # Second pass- see if any of the users are mentioned in the tweets. This will give us the screen
+        # name and the user name, which we match up with the user ID. The mentions were gathered up as the
+        # tweets were read, (see __index_mentions) so it's just a matter of looking each user up. The next
+        # two steps will go through the followers/following pages, which will give us more information.
+        self.__process_window.top_status('Matching mentions in tweets...')
         found_mentions = 0
-        current_tweet_count = 0
-        no_of_tweets = len(self.__tweets)
-        for tweet in self.__tweets:
-            current_tweet = self.__tweets[tweet]
-            current_tweet_count += 1
-            self.__process_window.update_progress(int((current_tweet_count / no_of_tweets)*100))
-            self.__process_window.status(f'Analysing tweet {current_tweet_count} of {no_of_tweets}.')
-            # While we're here, we'll also check for a retweet.
-            if current_tweet.full_text.startswith('RT @'):
-                self.__tweets[tweet].is_retweet = True
-            # Check the the mentions in the tweet, as this contains the screen names of the users mentioned
-            mentions = current_tweet.user_mentions
-            if mentions:
-                for mention in mentions:
-                    if 'id' in mention:
-                        if mention['id'] in followers_following:
-                            found = False
-                            mention_id = mention['id']
-                            if followers_following[mention_id].username is None:
-                                followers_following[mention_id].username = mention['screen_name']
-                                followers_following[mention_id].url =self.config.user_id_URL_template.format(mention['screen_name'])
-                                found = True
-                            if followers_following[mention_id].screen_name is None:
-                                followers_following[mention_id].screen_name = mention['name']
-                                found = True
-                            if found:
-                                found_mentions += 1
-                            self.__process_window.top_status('Analysing tweets for mentions... (Found ' + str(found_mentions) + ')')
+        for user_id in followers_following:
+            mention = self.__mentions.get(user_id)
+            if mention is None:
+                continue
+            found = False
+            if followers_following[user_id].username is None and mention['username']:
+                followers_following[user_id].username = mention['username']
+                followers_following[user_id].url =self.config.user_id_URL_template.format(mention['username'])
+                found = True
+            if followers_following[user_id].screen_name is None and mention['screen_name']:
+                followers_following[user_id].screen_name = mention['screen_name']
+                found = True
+            if found:
+                found_mentions += 1
+        self.__process_window.top_status('Matching mentions in tweets... (Found ' + str(found_mentions) + ')')
 
         # Finally, weed out any users that don't have a username linked to their ID.
         # (Hopefully we'll be able to get most of those from the followers/following pages)
         self.__users = {}
+        self.__user_ids_by_username = {}
         for user_id in followers_following:
             if followers_following[user_id].username:
                 self.__users[user_id] = followers_following[user_id]
+                self.__user_ids_by_username[followers_following[user_id].username.lower()] = user_id
         self.__next_step()
                             
-    # Step 8: Go through the pre-saved followers page if the user has supplied one
+    # Steps 8 and 9: Go through the pre-saved followers and following pages if the user has supplied them
     #
     # This is the ugliest part of the process. To say the HTML for a Twitter page is a bit
-    # bloated is like saying the sun is a bit warm. This is where we use the Beuatiful Soup
-    # library to parse the HTML.
-    def __parse_followers_page(self):
-        if self.config.followers_page:
-            if os.path.exists(self.config.followers_page):
-                self.__process_window.top_status('Analysing followers page...')
-                self.__process_window.status('Reading followers page...')
-                self.__process_window.update_progress(0)
-                with open(self.config.followers_page, 'r', encoding='utf8') as followers_page_file:
-                    html_parser = BeautifulSoup(followers_page_file, 'html.parser')
-                    page_title = html_parser.title.string
-                    print('Page title:', page_title)
-                    # The followers list is in a div with the aria-label attribute set to 'Timeline: Followers'. Within *that* is another div that contains the followers list.
-                    follower_list = html_parser.find_all('div', attrs={'aria-label': 'Timeline: Followers'})[0].find_all('div')[0]
-                    # Each follower is in a div with the data-testid attribute set to 'cellInnerDiv'
-                    follower_nodes = follower_list.find_all('div', attrs={'data-testid': 'cellInnerDiv'})
-                    no_nodes_found = len(follower_nodes)
-                    current_node_count = 0
-                    for follower_node in follower_nodes:
-                        user_id, username, screen_name, description, follow_state, avatar_url, local_url = self.__extract_user_data_from_html(follower_node, current_node_count, os.path.join(self.config.output_assets_images_folder, 'followers'), self.__users)
-                        
-                        if user_id:
-                            if username:
-                                self.__users[user_id].username = username
-                                self.__users[user_id].url =self.config.user_id_URL_template.format(username)
-                            if screen_name:
-                                self.__users[user_id].screen_name = screen_name
-                            if description:
-                                self.__users[user_id].description = description
-                            if avatar_url:
-                                self.__users[user_id].avatar_url = avatar_url
-                            if local_url:
-                                self.__users[user_id].local_url = local_url
-                            if follow_state:
-                                if follow_state == 'Following':
-                                    self.__users[user_id].following = True
-                                    
-                        current_node_count += 1
-                        
-                        self.__process_window.update_progress(int((current_node_count / no_nodes_found)*100))
-                        self.__process_window.status(f'Analysing node {current_node_count} of {no_nodes_found}.')
+    # bloated is like saying the sun is a bit warm. Rather than load the whole page, we read through
+    # it and pick out each user's cell as we come to it, (see UserCellStream) and only parse that with
+    # the Beautiful Soup library.
+    def __parse_followers_following_pages(self):
+        pages = []
+        if self.config.followers_page and os.path.exists(self.config.followers_page):
+            # The followers list is in a div with the aria-label attribute set to 'Timeline: Followers'.
+            pages.append((self.config.followers_page, 'Timeline: Followers', True))
+        if self.config.following_page and os.path.exists(self.config.following_page):
+            # The following list is in a div with the aria-label attribute set to 'Timeline: Following'.
+            pages.append((self.config.following_page, 'Timeline: Following', False))
+        if pages:
+            self.__process_window.top_status('Analysing followers and following pages...')
+            self.__process_window.status('Reading pages...')
+            self.__process_window.update_progress(0)
+            self.__parse_users_pages(pages)
+        self.__next_step()
         self.__next_step()
 
-    # Step 9: Go through the pre-saved following page if the user has supplied one
+    # Sets a user's username, (the page might have it in a different case to the tweets) keeping the
+    # username index up to date.
+    def __set_username(self, user_id, username):
+        old_username = self.__users[user_id].username
+        if old_username and self.__user_ids_by_username.get(old_username.lower()) == user_id:
+            del self.__user_ids_by_username[old_username.lower()]
+        self.__users[user_id].username = username
+        self.__users[user_id].url =self.config.user_id_URL_template.format(username)
+        self.__user_ids_by_username[username.lower()] = user_id
+
+    # Each user is in a div with the data-testid attribute set to 'cellInnerDiv'. The pages are read at the
+    # same time, each in its own thread, and the cells are sent off in batches to a pool of processes to
+    # have the details pulled out of them. (see UserCell) The results are merged page by page, and in the
+    # order the cells are on the page, so it all comes out the same as doing one cell at a time.
     #
-    # See notes above about parsing the followers page.
-    def __parse_following_page(self):
-        if self.config.following_page:
-            if os.path.exists(self.config.following_page):
-                self.__process_window.top_status('Analysing following page...')
-                self.__process_window.status('Reading following page...')
-                self.__process_window.update_progress(0)
-                with open(self.config.following_page, 'r', encoding='utf8') as followings_page_file:
-                    html_parser = BeautifulSoup(followings_page_file, 'html.parser')
-                    page_title = html_parser.title.string
-                    print('Page title:', page_title)
-                    # The following list is in a div with the aria-label attribute set to 'Timeline: Following'. Within *that* is another div that contains the followings list.
-                    following_list = html_parser.find_all('div', attrs={'aria-label': 'Timeline: Following'})[0].find_all('div')[0]
-                    # Each following is in a div with the data-testid attribute set to 'cellInnerDiv'
-                    following_nodes = following_list.find_all('div', attrs={'data-testid': 'cellInnerDiv'})
-                    no_nodes_found = len(following_nodes)
-                    current_node_count = 0
-                    for following_node in following_nodes:
-                        user_id, username, screen_name, description, follow_state, avatar_url, local_url = self.__extract_user_data_from_html(following_node, current_node_count, os.path.join(self.config.output_assets_images_folder, 'following'), self.__users)
-                        
-                        if user_id:
-                            if username:
-                                self.__users[user_id].username = username
-                                self.__users[user_id].url =self.config.user_id_URL_template.format(username)
-                            if screen_name:
-                                self.__users[user_id].screen_name = screen_name
-                            if description:
-                                self.__users[user_id].description = description
-                            if avatar_url:
-                                self.__users[user_id].avatar_url = avatar_url
-                            if local_url:
-                                self.__users[user_id].local_url = local_url
-                                    
-                        current_node_count += 1
-                        
-                        self.__process_window.update_progress(int((current_node_count / no_nodes_found)*100))
-                        self.__process_window.status(f'Analysing nodes {current_node_count} of {no_nodes_found}.')
-        self.__next_step()
+    # A page that hasn't changed since the last run isn't read at all: the users we got from it last time
+    # come from the page cache instead.
+    def __parse_users_pages(self, pages):
+        backend = Utils.html_backend
+        known_usernames = set(self.__user_ids_by_username)
+        fingerprints = []
+        cached_pages = []
+        for page_filename, timeline_label, check_follow_state in pages:
+            fingerprint = PageCache.fingerprint(self.__file_hasher.hash_file(page_filename), sorted(known_usernames),
+                                                self.config.sharded_media_layout, self.config.output_emoji_url_base)
+            fingerprints.append(fingerprint)
+            cached_pages.append(self.__page_cache.get(timeline_label, fingerprint, self.config.output_folder))
+        pages_to_read = [page for page, cached_users in zip(pages, cached_pages) if cached_users is None]
+        if not pages_to_read:
+            for (page_filename, timeline_label, check_follow_state), cached_users in zip(pages, cached_pages):
+                self.__merge_cached_users(page_filename, cached_users, check_follow_state)
+            return
+
+        workers = self.config.parser_workers or os.cpu_count() or 1
+        # Stops the pages being read faster than the batches can be dealt with, as each batch holds its
+        # cells, then its users, in memory until it's been merged. Each page has its own limit, and a
+        # batch only gives its place up once it's merged, so a page read ahead (while an earlier page is
+        # still being merged) can only get so far ahead.
+        in_flight = {}
+        streams = {}
+        batch_queues = {}
+        for page_filename, timeline_label, check_follow_state in pages_to_read:
+            streams[timeline_label] = UserCell.stream(page_filename, timeline_label, backend)
+            batch_queues[timeline_label] = queue.Queue()
+            in_flight[timeline_label] = threading.BoundedSemaphore(workers * 2)
+        stopping = threading.Event()
+        current_node_count = 0
+        # The workers save the avatars as they go, but only for users we know about.
+        with ProcessPoolExecutor(max_workers=workers, initializer=UserCell.set_known_usernames, initargs=(known_usernames,)) as pool, \
+             ThreadPoolExecutor(max_workers=len(pages_to_read)) as readers:
+            reader_futures = { timeline_label: readers.submit(Processor.__read_users_page, streams[timeline_label], batch_queues[timeline_label], pool, in_flight[timeline_label], stopping,
+                                                             backend, self.config.output_folder, self.config.sharded_media_layout, self.config.output_emoji_url_base)
+                               for page_filename, timeline_label, check_follow_state in pages_to_read }
+            try:
+                for (page_filename, timeline_label, check_follow_state), fingerprint, cached_users in zip(pages, fingerprints, cached_pages):
+                    if cached_users is not None:
+                        self.__merge_cached_users(page_filename, cached_users, check_follow_state)
+                        continue
+                    users = []
+                    files = []
+                    while True:
+                        batch = batch_queues[timeline_label].get()
+                        if batch is None:
+                            break
+                        for username, screen_name, description, follow_state, avatar_url, local_url in batch.result():
+                            self.__merge_user_data(username, screen_name, description, follow_state, avatar_url, local_url, check_follow_state)
+                            if username and username.lower() in known_usernames:
+                                users.append([username, screen_name, description, follow_state, avatar_url, local_url])
+                                files += UserCell.saved_files(description, local_url, self.config.output_emoji_url_base)
+                            current_node_count += 1
+                        in_flight[timeline_label].release()
+                        self.__process_window.update_progress(int(sum(stream.progress for stream in streams.values()) / len(streams) * 100))
+                        self.__process_window.status(f'Analysing node {current_node_count}.')
+                    reader_futures[timeline_label].result()          # Passes on anything that went wrong reading the page
+                    self.__page_cache.put(timeline_label, fingerprint, users, files)
+            finally:
+                stopping.set()          # (So a reader waiting for a place gives up, if something went wrong)
+
+    def __merge_cached_users(self, page_filename, cached_users, check_follow_state):
+        self.__process_window.status(f'{os.path.basename(page_filename)} hasn\'t changed, so using the users from last time.')
+        for username, screen_name, description, follow_state, avatar_url, local_url in cached_users:
+            self.__merge_user_data(username, screen_name, description, follow_state, avatar_url, local_url, check_follow_state)
+
+    # Reads the cells from one page, and queues up a batch for the worker processes every
+    # UserCell.BATCH_SIZE cells. The end of the page is marked with a None. Each batch takes a place in
+    # in_flight, which is given back once the batch has been merged.
+    @staticmethod
+    def __read_users_page(stream, batch_queue, pool, in_flight, stopping, *batch_args):
+        try:
+            cells = []
+            for cell_html in stream:
+                cells.append(cell_html)
+                if len(cells) == UserCell.BATCH_SIZE:
+                    if not Processor.__queue_user_batch(cells, batch_queue, pool, in_flight, stopping, batch_args):
+                        return
+                    cells = []
+            if cells:
+                Processor.__queue_user_batch(cells, batch_queue, pool, in_flight, stopping, batch_args)
+        finally:
+            batch_queue.put(None)
+
+    # Waits for a place in in_flight, then hands the batch to the workers. Returns False if we've
+    # stopped merging, and so the place would never come.
+    @staticmethod
+    def __queue_user_batch(cells, batch_queue, pool, in_flight, stopping, batch_args):
+        while not in_flight.acquire(timeout=0.5):
+            if stopping.is_set():
+                return False
+        batch_queue.put(pool.submit(UserCell.extract_batch, cells, *batch_args))
+        return True
+
+    # An avatar saved straight from the page goes in the shared media store too, and the file in the output
+    # folder becomes a link to the copy there, the same as the avatars saved in step 10.
+    def __add_avatar_to_media_store(self, local_url):
+        output_filename = os.path.join(self.config.output_folder, local_url)
+        content_hash = os.path.splitext(os.path.basename(local_url))[0]
+        if not self.__media_store.contains(content_hash):
+            self.__media_store.add_file(output_filename, ext=os.path.splitext(local_url)[1])
+        self.__media_store.link(content_hash, output_filename)
+
+    # Adds what we got from a user's cell to the user, if it's one we know about.
+    def __merge_user_data(self, username, screen_name, description, follow_state, avatar_url, local_url, check_follow_state):
+        # If we've got the username, we can get the user ID from the user list.
+        user_id = None
+        if username:
+            user_id = self.__user_ids_by_username.get(username.lower())
+        if user_id and user_id in self.__users:
+            if username:
+                self.__set_username(user_id, username)
+            if screen_name:
+                self.__users[user_id].screen_name = screen_name
+            if description:
+                self.__users[user_id].description = description
+            if avatar_url:
+                self.__users[user_id].avatar_url = avatar_url
+            if local_url:
+                self.__users[user_id].avatar_url = None
+                self.__users[user_id].local_url = local_url
+                if self.__media_store:
+                    self.__add_avatar_to_media_store(local_url)
+            if check_follow_state and follow_state:
+                if follow_state == 'Following':
+                    self.__users[user_id].following = True
         
     # Step 10: Save the user avatars
+    #
+    # Avatars are saved under the hash of their contents, so users with the same picture (and there are a
+    # lot of default avatars out there) all point at one shared file. Remote avatars are downloaded a few
+    # at a time, each distinct URL only once, and the avatar index remembers which URL gave which file, so
+    # a rerun doesn't fetch them again.
     def __save_users_avatars(self):
         self.__process_window.top_status('Saving user avatars...')
         self.__process_window.update_progress(0)
-        sleep_time= self.config.sleep_time
         avatar_count = 0
         current_user = 0
         user_count = len(self.__users)
-        output_dir = os.path.join(self.config.output_assets_images_folder, 'users')
+        downloads = {}              # remote avatar URL -> [user IDs]
         for user_id in self.__users:
             current_user += 1
-            if self.__users[user_id].avatar_url:
-                avatar_url = self.__users[user_id].avatar_url
-                image_data = None
-                file_ext = None
-  
-                # If you've been a good person and saved the webpage using a web page saver that saves
-                # the images as data URLs, then we already have the image, and all we need to do is save it.
-                #print('avatar_url:', avatar_url)
-                if avatar_url:
-                    if avatar_url.startswith('data:image'):
-                        image_data_url =  data_url.DataURL.from_url(avatar_url)
-                        image_data = image_data_url.data
-                        if avatar_url.startswith('data:image/png'):
-                            file_ext = 'png'
-                        elif avatar_url.startswith('data:image/jpeg'):
-                            file_ext = 'jpg'
-                        elif avatar_url.startswith('data:image/gif'):
-                            file_ext = 'gif'
-                        avatar_url = None
-                    # If you've been a bad person and saved the webpage using a web page saver that saves
-                    # the image URLs, then we need to download the image.
-                    elif avatar_url.startswith('https://') or avatar_url.startswith('http://'):
-                        with UriLoader(avatar_url, self.config) as avatar_loader:
-                            if avatar_loader.success:
-                                image_data = avatar_loader.data.content
-                                file_ext = avatar_loader.guess_ext()
-                            time.sleep(sleep_time)
+            avatar_url = self.__users[user_id].avatar_url
+            if avatar_url:
+                # If you've been a bad person and saved the webpage using a web page saver that saves
+                # the image URLs, then we need to download the image. (Unless we already have.)
+                if avatar_url.startswith('https://') or avatar_url.startswith('http://'):
+                    local_url = self.__avatar_index.get(avatar_url)
+                    content_hash = self.__media_store.lookup_source(avatar_url) if self.__media_store else None
+                    if local_url and os.path.exists(os.path.join(self.config.output_folder, local_url)):
+                        self.__users[user_id].local_url = local_url
+                        avatar_count += 1
+                    elif content_hash:
+                        file_ext = self.__media_store.blobs[content_hash]['ext'].lstrip('.')
+                        self.__users[user_id].local_url = self.__store_avatar(file_ext, avatar_url, content_hash=content_hash)
+                        avatar_count += 1
                     else:
-                        avatar_url = None       # Generic avatar
-                if image_data:
-                    avatar_count += 1
-                    output_filename = os.path.join(output_dir, f'avatar-{user_id}.{file_ext}')
-                    with open(output_filename, 'wb') as f:
-                        f.write(image_data)
-                    self.__users[user_id].avatar_url = avatar_url
-                    self.__users[user_id].local_url = f'assets/images/users/avatar-{user_id}.{file_ext}'
-                    #time.sleep(sleep_time)
-                    self.__process_window.top_status(f'Saving user avatars... ({avatar_count} found)')
-            self.__process_window.update_progress(int((current_user / user_count)*100))
+                        downloads.setdefault(avatar_url, []).append(user_id)
+            # If you've been a good person and saved the webpage using a web page saver that saves the images
+            # as data URLs, then the avatar was saved as the page was read. (See UserCell.extract_batch.)
+            elif self.__users[user_id].local_url:
+                avatar_count += 1
+            self.__process_window.update_progress(int((current_user / user_count)*50))
             self.__process_window.status(f'Scanning {current_user} of {user_count} user.')
+        self.__process_window.top_status(f'Saving user avatars... ({avatar_count} found)')
+        
+        # We don't know the file extension until we see the content type, so each download goes to a
+        # holding filename first.
+        avatar_folder = os.path.join(self.config.output_folder, 'assets/images/users')
+        Utils.create_directory(avatar_folder)
+        jobs = [(avatar_url, avatar_url, os.path.join(avatar_folder, f'avatar-{user_ids[0]}.download')) for avatar_url, user_ids in downloads.items()]
+        download_total = len(jobs)
+        download_count = 0
+        with Downloader(self.config) as downloader:
+            for avatar_url, avatar_loader in downloader.fetch_all(jobs):
+                user_ids = downloads[avatar_url]
+                if avatar_loader.success:
+                    local_url = self.__store_avatar(avatar_loader.guess_ext(), avatar_url, downloaded_filename=avatar_loader.filename)
+                    for user_id in user_ids:
+                        self.__users[user_id].local_url = local_url
+                    self.__retry_queue.remove('avatar', user_ids[0])
+                    avatar_count += len(user_ids)
+                else:
+                    holding_filename = os.path.join(avatar_folder, f'avatar-{user_ids[0]}.download')
+                    self.__retry_queue.add('avatar', user_ids[0], avatar_url, holding_filename, avatar_loader.error, user_ids=user_ids)
+                download_count += 1
+                self.__process_window.update_progress(50 + int((download_count / download_total)*50))
+                self.__process_window.status(f'Downloading {download_count} of {download_total} avatars. ({UriLoader.rate_controller.describe()})')
+                self.__process_window.top_status(f'Saving user avatars... ({avatar_count} found)')
+            failure_summary = downloader.failure_summary()
+            if failure_summary:
+                print(f'Avatar downloads: {failure_summary}')
+        # Users who have their avatar now, however we got it, don't need it retrying.
+        for entry in self.__retry_queue.items('avatar'):
+            user_ids = [user_id for user_id in entry.get('user_ids', [entry['id']])
+                        if not (user_id in self.__users and self.__users[user_id].local_url)]
+            if user_ids:
+                entry['user_ids'] = user_ids
+            else:
+                self.__retry_queue.remove('avatar', entry['id'])
+        self.__next_step()
+
+    # Puts an avatar in the avatar folder, named after the hash of its contents, from whichever of a
+    # downloaded file, or the media store we got it from. If we already have a file with those
+    # contents, that's used instead. Returns its URL, relative to the website root.
+    def __store_avatar(self, file_ext, avatar_url, downloaded_filename = None, content_hash = None):
+        if not file_ext:
+            # The server didn't say what it is, so go by the file itself.
+            file_ext = (MediaInfo.sniff_ext(downloaded_filename) if downloaded_filename else None) or 'jpg'
+        if content_hash is None:
+            content_hash = self.__file_hasher.hash_file(downloaded_filename)
+        avatar_folder = 'assets/images/users'
+        if self.config.sharded_media_layout:
+            avatar_folder += '/' + content_hash[:2]
+        local_url = f'{avatar_folder}/{content_hash}.{file_ext}'
+        output_filename = os.path.join(self.config.output_folder, local_url)
+        if os.path.exists(output_filename):
+            if downloaded_filename:
+                os.remove(downloaded_filename)
+        else:
+            Utils.create_directory(os.path.dirname(output_filename))
+            if self.__media_store:
+                if downloaded_filename:
+                    self.__media_store.add_file(downloaded_filename, avatar_url, move=True, ext='.' + str(file_ext))
+                self.__media_store.link(content_hash, output_filename)
+            else:
+                os.replace(downloaded_filename, output_filename)
+        if avatar_url:
+            self.__avatar_index[avatar_url] = local_url
+        return local_url
+
+    # Step 10a: Make smaller copies of the photos and avatars, for the web pages to use in `srcset`.
+    #
+    # Images are grouped by content hash, so the same picture used in several tweets (or the default
+    # avatar used by lots of users) is only resized once. Anything already done on an earlier run is
+    # picked up from the variants index without opening the image at all.
+    def __make_image_variants(self):
+        if not self.config.make_image_variants or not ImageVariants.available():
+            self.__next_step()
+            return
+        self.__process_window.top_status('Making web-sized copies of images...')
+        self.__process_window.status('Checking images...')
+        self.__process_window.update_progress(0)
+        media_variants = ImageVariants(os.path.join(self.config.output_media_folder_name, 'variants'), self.config.output_media_url_base + 'variants/')
+        avatar_variants = ImageVariants(os.path.join(self.config.output_assets_images_folder, 'users', 'variants'), 'assets/images/users/variants/')
+        photo_jobs = {}         # content hash -> (source filename, [media items])
+        avatar_jobs = {}        # content hash -> (source filename, [user profiles])
+        for media_id in self.__media:
+            media_obj = self.__media[media_id]
+            if media_obj.type == 'photo' and media_obj.downloaded and media_obj.local_filename:
+                if media_obj.content_hash is None:
+                    media_obj.content_hash = self.__file_hasher.hash_file(media_obj.local_filename)
+                if media_obj.content_hash not in photo_jobs:
+                    photo_jobs[media_obj.content_hash] = (media_obj.local_filename, [])
+                photo_jobs[media_obj.content_hash][1].append(media_obj)
+        if self.__users:
+            for user_id in self.__users:
+                user = self.__users[user_id]
+                if user.local_url:
+                    avatar_filename = os.path.join(self.config.output_folder, user.local_url)
+                    content_hash = self.__file_hasher.hash_file(avatar_filename)
+                    if content_hash not in avatar_jobs:
+                        avatar_jobs[content_hash] = (avatar_filename, [])
+                    avatar_jobs[content_hash][1].append(user)
+        # Work out which images still need doing.
+        pending = []
+        for variants, jobs, widths in [(media_variants, photo_jobs, ImageVariants.PHOTO_WIDTHS), 
+                                       (avatar_variants, avatar_jobs, ImageVariants.AVATAR_WIDTHS)]:
+            for content_hash in jobs:
+                cached = variants.cached(content_hash)
+                if cached is not None:
+                    self.__apply_image_variants(variants, cached, jobs[content_hash][1])
+                else:
+                    pending.append((variants, content_hash, jobs[content_hash], widths))
+        image_total = len(pending)
+        image_count = 0
+        if image_total > 0:
+            with ProcessPoolExecutor(max_workers=self.config.image_workers or None) as pool:
+                futures = {}
+                for variants, content_hash, (source_filename, items), widths in pending:
+                    future = pool.submit(ImageVariants.make_variants, source_filename, content_hash, variants.output_directory, widths)
+                    futures[future] = (variants, content_hash, items)
+                for future in as_completed(futures):
+                    variants, content_hash, items = futures[future]
+                    result = future.result()
+                    if result is not None:
+                        variants.add(content_hash, result)
+                        self.__apply_image_variants(variants, result, items)
+                    image_count += 1
+                    self.__process_window.update_progress(int((image_count / image_total)*100))
+                    self.__process_window.status(f'Resized {image_count} of {image_total} images.')
+        media_variants.save()
+        avatar_variants.save()
         self.__next_step()
+        
+    def __apply_image_variants(self, variants, result, items):
+        for item in items:
+            if isinstance(item, UserProfile):
+                item.avatar_variants = variants.as_urls(result)
+            else:
+                item.variants = variants.as_urls(result)
 
     # Step 11: Now we have all the information we can possibly get for the followers and following data,
-    # we save it to a JSON file (for the search) and a YAML file. (For Jekyll.)
+    # we save it: as an index and alphabetical pages of users for the followers/following pages to load
+    # as they're scrolled, and a YAML file. (For Jekyll.) See UserPages.
     def __save_followers_following(self):
-        followers_following = self.__users  
-        # First the JSON file
-        users_output_json_filename = os.path.join(self.config.output_json_folder_name, 'users.js')
-        users_data = []
-        for user_id in followers_following:
-            if followers_following[user_id].username:     # Only save users with usernames and screen names
-                users_data.append(followers_following[user_id].as_dict())
-        users_output_json = json.dumps(users_data, indent=4)
-        with open(users_output_json_filename, 'w', encoding='utf8') as followers_output_json_file:
-            followers_output_json_file.write('var users = '+ (users_output_json + ';'))
-        # Now the YAML file
-        output_yaml = ''
-        for user_id in followers_following:
-            if followers_following[user_id].follower:
-                output_yaml += followers_following[user_id].as_yaml()
-        with open(self.config.output_users_filename, 'w', encoding='utf8') as users_output_yaml_file:
-            users_output_yaml_file.write(output_yaml)
+        UserPages(self.config.output_json_folder_name, self.config.output_users_filename).save(self.__users)
 
     # Step 12: Analyse for retweets.
     #
@@ -909,6 +1287,10 @@ class Processor:
         self.__next_step()
         
     # Step 14: Consolidate any duplicate media files
+    #
+    # Rather than comparing every file with every other file, we hash each file once (the hasher
+    # remembers hashes from previous runs, so unchanged files aren't read again) and group by hash.
+    # The first media item we come across with a given hash is treated as the original.
     def __consolidate_media(self):
         no_of_duplicates = 0
         self.__process_window.top_status('Consolidating media...')
@@ -916,6 +1298,7 @@ class Processor:
         media_count = len(self.__media)
         current_media_count = 0
         size_saved = 0
+        originals = {}
         for current_media_id in self.__media:
             current_media_count += 1
             self.__process_window.update_progress(int((current_media_count / media_count)*100))
@@ -924,32 +1307,19 @@ class Processor:
             if current_media.downloaded:
                 if current_media.file_size is None:
                     current_media.file_size = os.path.getsize(current_media.local_filename)
-                    self.__media[current_media_id].file_size = current_media.file_size
-                for other_media_id in self.__media:
-                    is_duplicate = False
-                    other_media = self.__media[other_media_id]
-                    if other_media.downloaded:
-                        if current_media_id != other_media_id:
-                            if other_media.file_size is None:
-                                other_media.file_size = os.path.getsize(other_media.local_filename)
-                                self.__media[other_media_id].file_size = other_media.file_size
-                            # First check if the media is the same size
-                            if current_media.file_size == other_media.file_size:
-                                # Check if it's the same filename.
-                                if current_media.local_filename == other_media.local_filename:
-                                    is_duplicate = True
-                                    self.__media[other_media_id].is_duplicated = True
-                                    self.__media[other_media_id].duplicate_of = current_media_id
-                                else:
-                                    # Now check if the media is the same file
-                                    is_duplicate = cmp(current_media.local_filename, other_media.local_filename, shallow=False)
-                                    if is_duplicate:
-                                        self.__media[other_media_id].is_duplicated = True
-                                        self.__media[other_media_id].duplicate_of = current_media_id
-                                if is_duplicate:
-                                    no_of_duplicates += 1
-                                    size_saved += current_media.file_size
-                                    self.__process_window.top_status('Consolidating media... (Found ' + str(no_of_duplicates) + ' duplicates, saved ' + str(size_saved) + ' bytes)')
+                if current_media.content_hash is None:
+                    current_media.content_hash = self.__file_hasher.hash_file(current_media.local_filename)
+                if current_media.content_hash not in originals:
+                    originals[current_media.content_hash] = current_media_id
+                    continue
+                # Two media items can share the same file, in which case there's nothing to remove.
+                if current_media.local_filename == self.__media[originals[current_media.content_hash]].local_filename:
+                    continue
+                current_media.is_duplicated = True
+                current_media.duplicate_of = originals[current_media.content_hash]
+                no_of_duplicates += 1
+                size_saved += current_media.file_size
+                self.__process_window.top_status('Consolidating media... (Found ' + str(no_of_duplicates) + ' duplicates, saved ' + str(size_saved) + ' bytes)')
         self.__next_step()
         
     # Step 15: Write the tweets to the output directory
@@ -959,7 +1329,7 @@ class Processor:
         tweets_output_json_filename = os.path.join(self.config.output_json_folder_name, 'tweets.js')
         tweets_data = []
         for tweet_id in self.__tweets:
-            tweets_data.append(self.__tweets[tweet_id].as_dict())
+            tweets_data.append(self.__tweets[tweet_id].as_dict(self.__media, self.config.output_folder))
         tweets_output_json = json.dumps(tweets_data, indent=4)
         with open(tweets_output_json_filename, 'w', encoding='utf8') as tweets_output_json_file:
             tweets_output_json_file.write('var tweets = '+ (tweets_output_json + ';'))
@@ -971,9 +1341,13 @@ class Processor:
             current_tweet_count += 1
             self.__process_window.update_progress(int((current_tweet_count / tweet_count)*100))
             self.__process_window.status(f'Writing tweet {current_tweet_count} of {tweet_count}.')
+            failed_media_ids = [media_item.id for media_item in self.__tweets[tweet_id].media if self.__retry_queue.get('media', media_item.id)]
             self.__tweets[tweet_id].process(self.__media, self.__users, self.__hastags, self.config)
             if self.__tweets[tweet_id].filename:
                 self.__tweets[tweet_id].write()
+                # Remember which pages are missing which media, so a retry can put them back.
+                for media_id in failed_media_ids:
+                    self.__retry_queue.add_page('media', media_id, self.__tweets[tweet_id].filename)
             self.__process_window.update_progress(int((current_tweet_count / tweet_count)*100))
             self.__process_window.status(f'Writing tweet {current_tweet_count} of {tweet_count}.')
         # Add tweet and thread stats to the data folder.
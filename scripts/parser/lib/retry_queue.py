@@ -0,0 +1,70 @@
+import json
+import os
+import time
+
+# RETRY QUEUE =====================================================================================
+# Keeps a list of the downloads that failed, in the output folder, so they can be tried again later on
+# their own (see Processor.retry_failed_downloads) rather than by running the whole conversion again.
+#
+# Each entry is keyed on what it's for, either a media item ('media') or a user's avatar ('avatar'),
+# and records where the file should end up, and which output files need patching once we have it.
+class RetryQueue:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}           # 'kind:id' -> { 'kind', 'id', 'url', 'filename', 'error', 'attempts', 'last_attempt', ... }
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return False
+        try:
+            with open(self.filename, 'r', encoding='utf8') as f:
+                self.entries = json.loads(f.read())
+                return True
+        except Exception as e:
+            print(f"Error loading failed downloads queue: {e}")
+            return False
+
+    def save(self):
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w', encoding='utf8') as f:
+            f.write(json.dumps(self.entries, indent=4))
+        os.replace(tmp_filename, self.filename)
+
+    @staticmethod
+    def key(kind, id):
+        return f'{kind}:{id}'
+
+    # Records a failed download. Anything else worth keeping about it (eg. the tweet it's for) can be
+    # passed in as keyword arguments.
+    def add(self, kind, id, url, filename, error, **details):
+        key = RetryQueue.key(kind, id)
+        entry = self.entries.get(key, {})
+        entry.update(details)
+        entry.update({ 'kind': kind, 'id': id, 'url': url, 'filename': filename, 'error': error,
+                       'attempts': entry.get('attempts', 0) + 1, 'last_attempt': time.time() })
+        self.entries[key] = entry
+        return entry
+
+    def remove(self, kind, id):
+        return self.entries.pop(RetryQueue.key(kind, id), None)
+
+    def get(self, kind, id):
+        return self.entries.get(RetryQueue.key(kind, id))
+
+    # Notes an output file that will need patching if this download ever works.
+    def add_page(self, kind, id, page_filename):
+        entry = self.get(kind, id)
+        if entry is None:
+            return
+        if 'pages' not in entry:
+            entry['pages'] = []
+        if page_filename not in entry['pages']:
+            entry['pages'].append(page_filename)
+
+    def items(self, kind = None):
+        return [entry for entry in self.entries.values() if kind is None or entry['kind'] == kind]
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,189 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import hashlib
+import random
+import threading
+import time
+
+# STAND-IN SERVER =================================================================================
+# A local web server that stands in for Twitter's servers, so the download code can be measured (see
+# benchmark.py) without going anywhere near the real thing. It serves:
+#  * /media/<name>?size=<bytes>     Made-up media files of the given size. (Range requests work.)
+#  * /avatar/<name>                 Small made-up avatar images. Avatars with the same name are identical.
+#  * /t.co/<code>                   t.co style short links. Browsers get a page with the target in the
+#                                   <title>, everyone else a 301 redirect, the way t.co does it.
+#
+# and can be made to misbehave:
+#  * latency        Seconds to wait before answering each request.
+#  * bandwidth      Bytes per second to send each response at. (None for as fast as possible.)
+#  * throttle_rate  Requests per second allowed before answering '429 Too Many Requests', with a
+#                   Retry-After header. (None for no limit.)
+#  * failure_rate   Fraction of requests (0-1) answered with '503 Service Unavailable'.
+#
+# Example:
+#   with StandInServer(latency=0.05, failure_rate=0.1) as server:
+#       loader = UriLoader(server.url('/media/photo.jpg?size=100000'), config)
+class StandInServer:
+
+    CHUNK_SIZE = 16 * 1024
+    AVATAR_SIZE = 2048
+    BROWSER_AGENTS = ['Mozilla', 'Chrome', 'Safari']
+
+    def __init__(self, latency = 0, bandwidth = None, throttle_rate = None, failure_rate = 0, retry_after = 1, seed = 0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.throttle_rate = throttle_rate
+        self.failure_rate = failure_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.failed = 0
+        self.bytes_sent = 0
+        self.__window_start = time.monotonic()
+        self.__window_requests = 0
+        self.__server = ThreadingHTTPServer(('127.0.0.1', 0), StandInServer.__make_handler(self))
+        self.__server.daemon_threads = True
+        self.__thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.__server.server_port}'
+
+    def url(self, path):
+        return self.base_url + path
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = self.throttled = self.failed = self.bytes_sent = 0
+
+    # The made-up contents of a file. The same name always gives the same bytes.
+    @staticmethod
+    def make_content(name, size):
+        block = hashlib.sha256(name.encode('utf8')).digest() * 128
+        return (block * (size // len(block) + 1))[:size]
+
+    # Decides what to do with a request before it's answered: None to go ahead, or an error status.
+    def __admit(self):
+        with self.lock:
+            self.requests += 1
+            if self.throttle_rate:
+                now = time.monotonic()
+                if now - self.__window_start >= 1:
+                    self.__window_start = now
+                    self.__window_requests = 0
+                self.__window_requests += 1
+                if self.__window_requests > self.throttle_rate:
+                    self.throttled += 1
+                    return 429
+            if self.failure_rate and self.random.random() < self.failure_rate:
+                self.failed += 1
+                return 503
+        return None
+
+    @staticmethod
+    def __make_handler(server):
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self.__respond(send_body=True)
+
+            def do_HEAD(self):
+                self.__respond(send_body=False)
+
+            def log_message(self, format, *args):
+                pass
+
+            def __respond(self, send_body):
+                if server.latency:
+                    time.sleep(server.latency)
+                error = server._StandInServer__admit()
+                if error:
+                    self.send_response(error)
+                    if error == 429:
+                        self.send_header('Retry-After', str(server.retry_after))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                url = urlsplit(self.path)
+                name = url.path.rsplit('/', 1)[-1]
+                if url.path.startswith('/media/'):
+                    size = int(parse_qs(url.query).get('size', ['65536'])[0])
+                    content_type = 'image/png' if name.endswith('.png') else 'video/mp4' if name.endswith('.mp4') else 'image/jpeg'
+                    self.__send_content(StandInServer.make_content(name, size), content_type, send_body)
+                elif url.path.startswith('/avatar/'):
+                    self.__send_content(StandInServer.make_content(name, StandInServer.AVATAR_SIZE), 'image/png', send_body)
+                elif url.path.startswith('/t.co/'):
+                    target = f'https://example.com/{name}'
+                    if any(agent in self.headers.get('User-Agent', '') for agent in StandInServer.BROWSER_AGENTS):
+                        page = (f'<head><noscript><META http-equiv="refresh" content="0;URL={target}"></noscript>'
+                                f'<title>{target}</title></head>').encode('utf8')
+                        self.__send_content(page, 'text/html', send_body)
+                    else:
+                        self.send_response(301)
+                        self.send_header('Location', target)
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                else:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+
+            def __send_content(self, content, content_type, send_body):
+                etag = '"' + hashlib.sha1(content).hexdigest() + '"'
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                start, end = 0, len(content) - 1
+                range_header = self.headers.get('Range')
+                if range_header and range_header.startswith('bytes='):
+                    first, last = range_header[6:].split('-', 1)
+                    start = int(first) if first else 0
+                    end = min(int(last), end) if last else end
+                    if start >= len(content):
+                        self.send_response(416)
+                        self.send_header('Content-Range', f'bytes */{len(content)}')
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header('Content-Range', f'bytes {start}-{end}/{len(content)}')
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(end - start + 1))
+                self.send_header('ETag', etag)
+                self.send_header('Accept-Ranges', 'bytes')
+                self.end_headers()
+                if not send_body:
+                    return
+                body = content[start:end + 1]
+                for offset in range(0, len(body), StandInServer.CHUNK_SIZE):
+                    chunk = body[offset:offset + StandInServer.CHUNK_SIZE]
+                    self.wfile.write(chunk)
+                    if server.bandwidth:
+                        time.sleep(len(chunk) / server.bandwidth)
+                with server.lock:
+                    server.bytes_sent += len(body)
+
+        return Handler
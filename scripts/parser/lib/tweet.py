@@ -128,14 +128,15 @@ class Tweet:
 
         new_tweet.symbols = [symbol['text'] for symbol in symbols]
         for url in urls:
-            expanded_url = url['expanded_url']
+            # Some older tweets don't have an expanded URL. (These get resolved later, see LinkResolver.)
+            expanded_url = url.get('expanded_url') or ''
             status_search = re.search(r'http.*\:\/\/twitter.com\/\w+\/status\/(\d+)', expanded_url)
             if status_search:
                 new_tweet.embed_urls.append( { 'type': 'twitter', 'embed_id': status_search.group(1) } )
             new_tweet.urls.append({
                 'url': url['url'],
-                'expanded_url': url['expanded_url'],
-                'display_url': url['display_url']
+                'expanded_url': expanded_url,
+                'display_url': url.get('display_url') or ''
             })
         
         if user_mentions:
@@ -216,7 +217,8 @@ class Tweet:
             for tco_url in tco_urls:
                 for url in self.urls:
                     if str(url['url']) == str(tco_url):
-                        replacment_url = '<a href="' + url['expanded_url'] + '">' + url['display_url'] + '</a>'
+                        # (A link we couldn't find the target of stays as the t.co link.)
+                        replacment_url = '<a href="' + (url['expanded_url'] or url['url']) + '">' + (url['display_url'] or url['url']) + '</a>'
                         source_full_text = source_full_text.replace(str(tco_url), replacment_url)
         # Next come the hashtags.
         if self.hashtags:
@@ -241,21 +243,45 @@ class Tweet:
         self.full_text = source_full_text
         # Finally, let's check the media, and remove any duplicates.
         if self.media:
-            media_check = self.media
-            self.media = []
-            for media_item in media_check:
-                if media[media_item.id].local_filename:
-                    if media[media_item.id].is_duplicated:
-                        duplicate_id = media[media_item.id].duplicate_of
-                        #print('Duplicate:', media_item.id, 'of', duplicate_id)      
-                        original_media = media[duplicate_id]
-                    else:
-                        original_media = media[media_item.id]
-                        original_media.local_filename = original_media.local_filename.replace(root_directory, '').replace('\\', '/')
-                    #print('Filename:', root_directory, original_media.local_filename)
-                    self.media.append(original_media)
+            self.media = self.resolve_media(media)
+            for original_media in self.media:
+                original_media.local_filename = original_media.relative_filename(root_directory)
+                
+    # Swaps any short links in the URLs for where they actually go, using the links resolved by the
+    # LinkResolver. (A dictionary of short URL -> target.)
+    def resolve_urls(self, links):
+        for url in self.urls:
+            short_url = url['expanded_url'] if url['expanded_url'] else url['url']
+            target = links.get(short_url)
+            if target and target != short_url:
+                url['expanded_url'] = target
+                url['display_url'] = Tweet.make_display_url(target)
+
+    # A shortened version of a URL to show as the link text, the way Twitter does it: no 'https://www.',
+    # and cut off with an ellipsis after 26 characters.
+    @staticmethod
+    def make_display_url(url):
+        display_url = re.sub(r'^https?://(www\.)?', '', url)
+        if len(display_url) > 26:
+            display_url = display_url[:26] + '\u2026'
+        return display_url
+        
+    # Returns the media for this tweet that actually made it to the output folder, swapping any
+    # duplicates for the original file.
+    def resolve_media(self, media):
+        resolved_media = []
+        for media_item in self.media:
+            if media[media_item.id].local_filename:
+                if media[media_item.id].is_duplicated:
+                    duplicate_id = media[media_item.id].duplicate_of
+                    #print('Duplicate:', media_item.id, 'of', duplicate_id)      
+                    original_media = media[duplicate_id]
+                else:
+                    original_media = media[media_item.id]
+                resolved_media.append(original_media)
+        return resolved_media
                     
-    def as_dict(self):
+    def as_dict(self, media = None, root_directory = None):
         dest_dict = {}
         if self.id:
             dest_dict['id'] = self.id
@@ -305,6 +331,8 @@ class Tweet:
             dest_dict['no_of_favorites'] = self.no_of_favorites
         if self.no_of_retweets:
             dest_dict['no_of_retweets'] = self.no_of_retweets
+        if self.media and media:
+            dest_dict['media'] = [media_item.as_dict(root_directory) for media_item in self.resolve_media(media)]
         return dest_dict
                     
     def write(self):
@@ -371,38 +399,38 @@ class Tweet:
                 f.write('is_retweet: ' + str(self.is_retweet) + '\n')
             if self.is_quote_tweet:
                 f.write('is_quote_tweet: ' + str(self.is_quote_tweet) + '\n')
-            if self.media:
-                for media_item in self.media:
-                    if media_item.local_filename:
-                        f.write('media:\n')
-                        f.write('  - id: ' + str(media_item.id) + '\n')
-                        f.write('    url: "' + media_item.url + '"\n')
-                        f.write('    local_filename: "' + media_item.local_filename + '"\n')
-                        f.write('    file_size: ' + str(media_item.file_size) + '\n')
-                        f.write('    type: ' + media_item.type + '\n')
-                        if media_item.video_info:
-                            f.write('    video_info:\n')
-                            f.write('      duration_millis: ' + str(media_item.duration_millis) + '\n')
-                    #if media_item.additional_media_info:
-                        #f.write('    additional_media_info:\n')
-                        #if media_item.additional_media_info['description']:
-                        #    f.write('      description: ' + media_item.additional_media_info['description'] + '\n')
-                        #if media_item.additional_media_info['alt_text']:
-                        #    f.write('      alt_text: ' + media_item.additional_media_info['alt_text'] + '\n')
-                    if media_item.source_tweet_id:
-                        f.write('    source_tweet_id: ' + str(media_item.source_tweet_id) + '\n')
-                    if media_item.source_user_id:
-                        f.write('    source_user_id: ' + str(media_item.source_user_id) + '\n')
-                    if media_item.is_duplicated:
-                        f.write('    is_duplicated: ' + str(media_item.is_duplicated) + '\n')
-                    if media_item.duplicate_of:
-                        f.write('    duplicate_of: ' + str(media_item.duplicate_of) + '\n')
+            written_media = [media_item for media_item in self.media if media_item.local_filename]
+            if written_media:
+                f.write('media:\n')
+                for media_item in written_media:
+                    f.write(media_item.as_yaml())
             if self.no_of_favorites:
                 f.write('no_of_favorites: ' + str(self.no_of_favorites) + '\n')
             if self.no_of_retweets:
                 f.write('no_of_retweets: ' + str(self.no_of_retweets) + '\n')
             f.write('---\n')
             f.write(self.full_text) 
+
+    # Adds a media item to the front matter of a status page that has already been written, (eg. when a
+    # download that failed first time round works on a retry) leaving the rest of the page as it is.
+    @staticmethod
+    def add_media_to_page(page_filename, media_item):
+        with open(page_filename, 'r', encoding='utf8') as f:
+            page = f.read()
+        front_matter_end = page.index('\n---\n', 3) + 1
+        front_matter = page[:front_matter_end]
+        if f'  - id: {media_item.id}\n' in front_matter:
+            return False
+        if '\nmedia:\n' in front_matter:
+            front_matter = front_matter.replace('\nmedia:\n', '\nmedia:\n' + media_item.as_yaml(), 1)
+        else:
+            front_matter += 'media:\n' + media_item.as_yaml()
+        tmp_filename = page_filename + '.tmp'
+        with open(tmp_filename, 'w', encoding='utf8') as f:
+            f.write(front_matter + page[front_matter_end:])
+        os.replace(tmp_filename, page_filename)
+        return True
+
 class Media:
     def __init__(self, 
                     id,
@@ -423,7 +451,12 @@ class Media:
                     alt_text = None,
                     duration_millis = None,
                     is_duplicated = None,
-                    duplicate_of = None
+                    duplicate_of = None,
+                    content_hash = None,
+                    variants = None,
+                    width = None,
+                    height = None,
+                    aspect_ratio = None
         ):
         self.id = id
         self.url = url
@@ -445,6 +478,11 @@ class Media:
         self.duration_millis = duration_millis
         self.is_duplicated = is_duplicated
         self.duplicate_of = duplicate_of
+        self.content_hash = content_hash
+        self.variants = variants
+        self.width = width
+        self.height = height
+        self.aspect_ratio = aspect_ratio
 
     @staticmethod
     def __get_best_video_url(video_info):
@@ -509,15 +547,86 @@ class Media:
         else:
             return None
         
-    def make_output_filename(self, output_media_folder_name):
+    def make_output_filename(self, output_media_folder_name, sharded = False):
         if self.local_filename:
             original_filename = os.path.split(self.local_filename)[1]
         else:
             original_filename = os.path.split(self.url)[1]
+        if sharded:
+            output_media_folder_name = os.path.join(output_media_folder_name, Utils.shard_folder(self.tweet_id))
         if not os.path.exists(output_media_folder_name):
             os.makedirs(output_media_folder_name)
         output_filename = os.path.join(output_media_folder_name, original_filename)
         return output_filename
+    
+    def set_dimensions(self, width, height):
+        self.width = width
+        self.height = height
+        self.aspect_ratio = round(width / height, 4)
+        
+    # The output filename, as a URL relative to the root of the website.
+    def relative_filename(self, root_directory):
+        if not self.local_filename or not root_directory:
+            return self.local_filename
+        return self.local_filename.replace(root_directory, '').replace('\\', '/')
+    
+    def as_dict(self, root_directory = None):
+        dest_dict = {}
+        if self.id:
+            dest_dict['id'] = self.id
+        if self.url:
+            dest_dict['url'] = self.url
+        if self.local_filename:
+            dest_dict['local_filename'] = self.relative_filename(root_directory)
+        if self.file_size:
+            dest_dict['file_size'] = self.file_size
+        if self.type:
+            dest_dict['type'] = self.type
+        if self.width and self.height:
+            dest_dict['width'] = self.width
+            dest_dict['height'] = self.height
+            dest_dict['aspect_ratio'] = self.aspect_ratio
+        if self.duration_millis:
+            dest_dict['duration_millis'] = self.duration_millis
+        if self.variants:
+            dest_dict['variants'] = self.variants
+        return dest_dict
+
+    # The media item as an entry in the 'media' list of a status page's front matter.
+    def as_yaml(self):
+        yaml_string = '  - id: ' + str(self.id) + '\n'
+        yaml_string += '    url: "' + self.url + '"\n'
+        yaml_string += '    local_filename: "' + self.local_filename + '"\n'
+        yaml_string += '    file_size: ' + str(self.file_size) + '\n'
+        yaml_string += '    type: ' + self.type + '\n'
+        if self.width and self.height:
+            yaml_string += '    width: ' + str(self.width) + '\n'
+            yaml_string += '    height: ' + str(self.height) + '\n'
+            yaml_string += '    aspect_ratio: ' + str(self.aspect_ratio) + '\n'
+        if self.video_info:
+            yaml_string += '    video_info:\n'
+            yaml_string += '      duration_millis: ' + str(self.duration_millis) + '\n'
+        if self.variants:
+            yaml_string += '    variants:\n'
+            for variant in self.variants:
+                yaml_string += '      - width: ' + str(variant['width']) + '\n'
+                yaml_string += '        height: ' + str(variant['height']) + '\n'
+                yaml_string += '        url: "' + variant['url'] + '"\n'
+        #if self.additional_media_info:
+            #yaml_string += '    additional_media_info:\n'
+            #if self.additional_media_info['description']:
+            #    yaml_string += '      description: ' + self.additional_media_info['description'] + '\n'
+            #if self.additional_media_info['alt_text']:
+            #    yaml_string += '      alt_text: ' + self.additional_media_info['alt_text'] + '\n'
+        if self.source_tweet_id:
+            yaml_string += '    source_tweet_id: ' + str(self.source_tweet_id) + '\n'
+        if self.source_user_id:
+            yaml_string += '    source_user_id: ' + str(self.source_user_id) + '\n'
+        if self.is_duplicated:
+            yaml_string += '    is_duplicated: ' + str(self.is_duplicated) + '\n'
+        if self.duplicate_of:
+            yaml_string += '    duplicate_of: ' + str(self.duplicate_of) + '\n'
+        return yaml_string
 
 
 class DateStats:
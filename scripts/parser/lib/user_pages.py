@@ -0,0 +1,109 @@
+from lib.user_profile import UserProfile
+from lib.utils import Utils
+import json
+import os
+
+# USER PAGES ======================================================================================
+# Writes the followers and following data for the website. There can be tens of thousands of users, which
+# is far too many to put in one file and make the followers page download and parse it before showing
+# anything, so they're split up:
+#
+#   assets/js/data/users.js             A small index: how many users are in each list, and the pages
+#                                       they're in. (var users = { "page_size": 100, "followers": {...}, ... })
+#   assets/js/data/users/followers-0001.json
+#   assets/js/data/users/following-0001.json
+#                                       Each list, in alphabetical order of username, PAGE_SIZE users a page.
+#                                       The followers/following pages load these as they're scrolled. (See
+#                                       assets/js/twitter-users.js)
+#   _data/users.yaml                    Everyone, in the same order, for Jekyll. The followers/following
+#                                       pages only show the first page from this, so they can be read
+#                                       without JavaScript.
+#
+# A user who's both a follower and followed is in both lists.
+class UserPages:
+
+    PAGE_SIZE = 100
+    LISTS = { 'followers': 'follower', 'following': 'following' }      # list -> the UserProfile flag for it
+    FOLDER = 'users'
+
+    def __init__(self, json_folder, yaml_filename):
+        self.index_filename = os.path.join(json_folder, 'users.js')
+        self.pages_folder = os.path.join(json_folder, UserPages.FOLDER)
+        self.yaml_filename = yaml_filename
+
+    # Writes everyone with a username. users is a dictionary of UserProfiles, keyed on user ID.
+    def save(self, users):
+        users = sorted((user for user in users.values() if user.username), key=lambda user: user.username)
+        Utils.create_directory(self.pages_folder)
+        index = { 'page_size': UserPages.PAGE_SIZE }
+        page_filenames = set()
+        for list_name, flag in UserPages.LISTS.items():
+            list_users = [user.as_json_dict() for user in users if getattr(user, flag)]
+            pages = []
+            for start in range(0, len(list_users), UserPages.PAGE_SIZE):
+                page_filename = f'{list_name}-{len(pages) + 1:04d}.json'
+                UserPages.write_page(os.path.join(self.pages_folder, page_filename), list_users[start:start + UserPages.PAGE_SIZE])
+                pages.append(UserPages.FOLDER + '/' + page_filename)
+                page_filenames.add(page_filename)
+            index[list_name] = { 'count': len(list_users), 'pages': pages }
+        # Clear out any pages left over from a previous run with more users.
+        for filename in os.listdir(self.pages_folder):
+            if filename.endswith('.json') and filename not in page_filenames:
+                os.remove(os.path.join(self.pages_folder, filename))
+        Utils.write_js_data_file(self.index_filename, 'users', index, minify=True)
+        self.write_yaml(users)
+        return index
+
+    # The YAML goes straight out to the file a user at a time, rather than being built up in memory first.
+    def write_yaml(self, users):
+        tmp_filename = self.yaml_filename + '.tmp'
+        with open(tmp_filename, 'w', encoding='utf8') as f:
+            for user in users:
+                f.write(user.as_yaml())
+        os.replace(tmp_filename, self.yaml_filename)
+
+    # The page files listed in the index, for both lists. (None if it hasn't been written yet.)
+    def page_filenames(self):
+        if not os.path.exists(self.index_filename):
+            return []
+        variable_name, index = Utils.read_js_data_file(self.index_filename)
+        if not isinstance(index, dict):             # (The single file users.js of older versions)
+            return []
+        return [os.path.join(os.path.dirname(self.index_filename), page)
+                for list_name in UserPages.LISTS for page in index.get(list_name, {}).get('pages', [])]
+
+    # Everyone in the pages, as they were written. (Users in both lists come up twice.)
+    def read_users(self):
+        users = []
+        for page_filename in self.page_filenames():
+            with open(page_filename, 'r', encoding='utf8') as f:
+                users += json.loads(f.read())
+        return users
+
+    # Points users at an avatar that's turned up since their pages were written. (eg. on a retry)
+    def set_local_url(self, user_ids, local_url):
+        for page_filename in self.page_filenames():
+            self.__set_local_url_in_page(page_filename, user_ids, local_url)
+        if os.path.exists(self.yaml_filename):
+            for user_id in user_ids:
+                UserProfile.set_local_url_in_yaml(self.yaml_filename, user_id, local_url)
+
+    def __set_local_url_in_page(self, page_filename, user_ids, local_url):
+        if not os.path.exists(page_filename):
+            return
+        with open(page_filename, 'r', encoding='utf8') as f:
+            page_users = json.loads(f.read())
+        changed = False
+        for user_data in page_users:
+            if user_data['id'] in user_ids:
+                user_data['local_url'] = local_url
+                changed = True
+        if changed:
+            UserPages.write_page(page_filename, page_users)
+
+    @staticmethod
+    def write_page(page_filename, page_users):
+        tmp_filename = page_filename + '.tmp'
+        with open(tmp_filename, 'w', encoding='utf8') as f:
+            f.write(json.dumps(page_users, separators=(',', ':')))
+        os.replace(tmp_filename, page_filename)
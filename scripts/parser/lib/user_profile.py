@@ -21,7 +21,8 @@ class UserProfile:
             follower = None,
             no_of_followers = None,
             no_following = None,
-            no_tweets = None
+            no_tweets = None,
+            avatar_variants = None
         ):
         self.id = id
         self.username = username
@@ -43,6 +44,7 @@ class UserProfile:
         self.no_of_followers = no_of_followers
         self.no_following = no_following
         self.no_tweets = no_tweets
+        self.avatar_variants = avatar_variants
         
     def __str__(self):
         return f"{self.username} ({self.screen_name})"
@@ -70,6 +72,12 @@ class UserProfile:
         if self.local_url:
             local_url = self.local_url.replace('\\', '\\\\')
             yaml_string += f"  local_url: \"{local_url}\"\n"
+        if self.avatar_variants:
+            yaml_string += "  avatar_variants:\n"
+            for variant in self.avatar_variants:
+                yaml_string += f"    - width: {variant['width']}\n"
+                yaml_string += f"      height: {variant['height']}\n"
+                yaml_string += f"      url: \"{variant['url']}\"\n"
         if self.header_url:
             yaml_string += f"  header_url: \"{self.header_url}\"\n"
         if self.local_header_url:
@@ -116,6 +124,8 @@ class UserProfile:
             dict['avatar_url'] = self.avatar_url
         if self.local_url:
             dict['local_url'] = self.local_url
+        if self.avatar_variants:
+            dict['avatar_variants'] = self.avatar_variants
         if self.header_url:
             dict['header_url'] = self.header_url
         if self.local_header_url:
@@ -144,10 +154,50 @@ class UserProfile:
             dict['no_tweets'] = self.no_tweets
         return dict 
     
+    # The same, but with the values as they are, for JSON. The screen name and description are kept
+    # quoted ready for the YAML, (see UserCell.extract) so the quotes come off again here.
+    def as_json_dict(self):
+        dict = self.as_dict()
+        for key in ['screen_name', 'description']:
+            if key in dict:
+                dict[key] = UserProfile.unquote(dict[key])
+        return dict
+
     @staticmethod
-    def find_id_for_username(username, user_profiles):
-        for user_profile in user_profiles:
-            if user_profiles[user_profile].username == username:
-                return user_profiles[user_profile].id
-        return None
+    def unquote(value):
+        if len(value) >= 2 and value.startswith('"') and value.endswith('"'):
+            return value[1:-1].replace('\\"', '"')
+        return value
 
+    # Sets a user's local_url in a users YAML file that has already been written, (eg. when their avatar
+    # is downloaded on a retry) leaving everyone else's entry as it is.
+    @staticmethod
+    def set_local_url_in_yaml(yaml_filename, user_id, local_url):
+        with open(yaml_filename, 'r', encoding='utf8') as f:
+            lines = f.read().split('\n')
+        local_url_line = '  local_url: "' + local_url.replace('\\', '\\\\') + '"'
+        start = None
+        for line_no, line in enumerate(lines):
+            if line == f'- id: {user_id}':
+                start = line_no
+                break
+        if start is None:
+            return False
+        end = start + 1
+        while end < len(lines) and lines[end].startswith('  '):
+            end += 1
+        insert_at = start + 1
+        for line_no in range(start + 1, end):
+            if lines[line_no].startswith('  local_url:'):
+                lines[line_no] = local_url_line
+                insert_at = None
+                break
+            if lines[line_no].startswith('  avatar_url:'):
+                insert_at = line_no + 1
+        if insert_at:
+            lines.insert(insert_at, local_url_line)
+        tmp_filename = yaml_filename + '.tmp'
+        with open(tmp_filename, 'w', encoding='utf8') as f:
+            f.write('\n'.join(lines))
+        os.replace(tmp_filename, yaml_filename)
+        return True
@@ -1,5 +1,7 @@
-from bs4 import BeautifulSoup
 from datetime import datetime
+from html.parser import HTMLParser
+import html
+import hashlib
 import json
 import os
 import requests
@@ -29,24 +31,70 @@ class Utils:
             # parse the resulting JSON and return as a dict
             return json.loads(data)
         
+    # Reads one of our own data files from assets/js/data, (eg. 'var tweets = [...];') returning the
+    # variable name and the data.
+    @staticmethod
+    def read_js_data_file(filename):
+        with open(filename, 'r', encoding='utf8') as f:
+            declaration, data = f.read().split('=', 1)
+        return declaration.replace('var', '', 1).strip(), json.loads(data.strip().rstrip(';'))
+
+    @staticmethod
+    def write_js_data_file(filename, variable_name, data, minify = False):
+        tmp_filename = filename + '.tmp'
+        if minify:
+            json_data = json.dumps(data, separators=(',', ':'))
+        else:
+            json_data = json.dumps(data, indent=4)
+        with open(tmp_filename, 'w', encoding='utf8') as f:
+            f.write(f'var {variable_name} = ' + json_data + ';')
+        os.replace(tmp_filename, filename)
+
+    # Which parser Beautiful Soup uses. lxml's is written in C, and several times faster than Python's
+    # own html.parser, but it's an extra install, so we fall back to html.parser without it.
+    HTML_BACKENDS = ['lxml', 'html.parser']
+    html_backend = 'html.parser'
+
+    # Picks the HTML parser to use from the config setting ('auto', 'lxml' or 'html.parser'), and returns it.
+    @staticmethod
+    def select_html_backend(name = 'auto'):
+        if name in (None, 'auto', 'lxml'):
+            try:
+                import lxml
+                Utils.html_backend = 'lxml'
+                return Utils.html_backend
+            except ImportError:
+                if name == 'lxml':
+                    print("lxml isn't installed, so using html.parser instead.")
+        elif name not in Utils.HTML_BACKENDS:
+            print(f"Unknown HTML parser '{name}', so using html.parser instead.")
+        Utils.html_backend = 'html.parser'
+        return Utils.html_backend
+
     # This cleans up a string containing HTML so that it doesn't contain
-    # the elevently bazillion attributes that React or Angular add to it.
+    # the elevently bazillion attributes that React or Angular add to it. (See HtmlSanitiser.)
+    # Descriptions turn up again and again, (eg. on both the followers and following pages) so the
+    # answers are remembered, by the hash of the HTML.
+    SANITISE_CACHE_SIZE = 10000
+    sanitise_cache = {}
+
     @staticmethod
     def sanitise_html(html):
-        html_parser = BeautifulSoup(html, 'html.parser')
-        a_tags = html_parser.find_all('a')
-        if a_tags:
-            allow_attributes = ['href', 'target']
-            for tag in a_tags:
-                tag.attrs = {key: value for key, value in tag.attrs.items()
-                        if key in allow_attributes}
-        img_tags = html_parser.find_all('img')
-        if img_tags:
-            allow_attributes = ['src', 'alt']
-            for tag in img_tags:
-                tag.attrs = {key: value for key, value in tag.attrs.items()
-                        if key in allow_attributes}
-        return str(html_parser)
+        key = hashlib.blake2b(html.encode('utf8'), digest_size=16).digest()
+        sanitised_html = Utils.sanitise_cache.get(key)
+        if sanitised_html is None:
+            sanitised_html = HtmlSanitiser().sanitise(html)
+            if len(Utils.sanitise_cache) >= Utils.SANITISE_CACHE_SIZE:
+                Utils.sanitise_cache.clear()
+            Utils.sanitise_cache[key] = sanitised_html
+        return sanitised_html
+    
+    # Works out a two-level sub-folder (eg. 'ab/cd') for a file, from its tweet or user ID. Hashing the ID
+    # spreads the files evenly, as tweet IDs next to each other tend to share most of their digits.
+    @staticmethod
+    def shard_folder(key):
+        key_hash = hashlib.blake2b(str(key).encode('utf8'), digest_size=2).hexdigest()
+        return key_hash[:2] + '/' + key_hash[2:]
     
     @staticmethod
     def import_date(date_string):
@@ -57,14 +105,158 @@ class Utils:
         return date.strftime('%a %b %d %H:%M:%S %z %Y')
         
 
+# HTML SANITISER ==================================================================================
+# Strips all but a few harmless attributes from the <a> and <img> tags in a fragment of HTML, and leaves
+# everything else as it is. It works straight off the tokens from Python's HTML parser rather than
+# building a tree, and writes the HTML back out the same way Beautiful Soup (with html.parser) would,
+# so the output is exactly what the Beautiful Soup version used to give. (See check_sanitiser.py.)
+class HtmlSanitiser(HTMLParser):
+
+    ALLOWED_ATTRIBUTES = { 'a': ['href', 'target'], 'img': ['src', 'alt'] }
+    # Tags that never have an end tag, written as '<br/>'.
+    VOID_ELEMENTS = ['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem',
+                     'meta', 'param', 'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame',
+                     'image', 'isindex', 'nextid', 'spacer']
+    # Tags whose contents are written out as they are, without escaping.
+    RAW_TEXT_ELEMENTS = ['script', 'style']
+    # Tags inside which text that's only whitespace is kept as it is. (Anywhere else, it's cut down to
+    # a single newline or space.)
+    PRESERVE_WHITESPACE_ELEMENTS = ['pre', 'textarea']
+    ASCII_SPACES = ' \n\t\f\r'
+
+    def __init__(self):
+        # Character references are dealt with below, the way Beautiful Soup does it.
+        super().__init__(convert_charrefs=False)
+        self.__output = []
+        self.__open_tags = []
+        self.__text = []
+        self.__closed_void_tags = []            # Void tags written as '<br>', whose '</br>' may turn up later
+
+    def sanitise(self, html):
+        self.feed(html)
+        self.close()
+        self.__flush_text()
+        # Anything left open is closed at the end.
+        for tag in reversed(self.__open_tags):
+            self.__output.append(f'</{tag}>')
+        self.__open_tags = []
+        return ''.join(self.__output)
+
+    @staticmethod
+    def escape(text):
+        return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+    @staticmethod
+    def quote_attribute(value):
+        value = HtmlSanitiser.escape(value)
+        if '"' in value:
+            if "'" in value:
+                return '"' + value.replace('"', '&quot;') + '"'
+            return "'" + value + "'"
+        return '"' + value + '"'
+
+    # Text is gathered up until the next tag, comment or the like, and then written out.
+    def __flush_text(self):
+        if not self.__text:
+            return
+        text = ''.join(self.__text)
+        self.__text = []
+        if not text.strip(HtmlSanitiser.ASCII_SPACES) and not any(tag in HtmlSanitiser.PRESERVE_WHITESPACE_ELEMENTS for tag in self.__open_tags):
+            text = '\n' if '\n' in text else ' '
+        if self.__open_tags and self.__open_tags[-1] in HtmlSanitiser.RAW_TEXT_ELEMENTS:
+            self.__output.append(text)
+        else:
+            self.__output.append(HtmlSanitiser.escape(text))
+
+    def __start_tag(self, tag, attrs):
+        self.__flush_text()
+        attributes = {}
+        for key, value in attrs:
+            attributes[key] = value if value is not None else ''
+        if tag in HtmlSanitiser.ALLOWED_ATTRIBUTES:
+            attributes = { key: value for key, value in attributes.items() if key in HtmlSanitiser.ALLOWED_ATTRIBUTES[tag] }
+        start_tag = '<' + tag + ''.join(f' {key}={HtmlSanitiser.quote_attribute(value)}' for key, value in sorted(attributes.items()))
+        if tag in HtmlSanitiser.VOID_ELEMENTS:
+            self.__output.append(start_tag + '/>')
+            return False
+        self.__output.append(start_tag + '>')
+        self.__open_tags.append(tag)
+        return True
+
+    def handle_starttag(self, tag, attrs):
+        if not self.__start_tag(tag, attrs):
+            self.__closed_void_tags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        if self.__start_tag(tag, attrs):
+            self.handle_endtag(tag)
+
+    # An end tag closes everything opened since its start tag. One without a start tag is dropped, as is
+    # the end tag of a void tag, which we've already closed.
+    def handle_endtag(self, tag):
+        if tag in self.__closed_void_tags:
+            self.__closed_void_tags.remove(tag)
+            return
+        self.__flush_text()
+        if tag not in self.__open_tags:
+            return
+        while self.__open_tags:
+            open_tag = self.__open_tags.pop()
+            self.__output.append(f'</{open_tag}>')
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        self.__text.append(data)
+
+    def handle_charref(self, name):
+        self.handle_data(html.unescape(f'&#{name};'))
+
+    # An entity we don't know is kept as it is, less the ';'.
+    def handle_entityref(self, name):
+        self.handle_data(html.entities.html5.get(name + ';', '&' + name))
+
+    def handle_comment(self, data):
+        self.__flush_text()
+        self.__output.append(f'<!--{data}-->')
+
+    def handle_decl(self, decl):
+        self.__flush_text()
+        self.__output.append('<!DOCTYPE ' + decl[len('DOCTYPE '):] + '>\n')
+
+    def handle_pi(self, data):
+        self.__flush_text()
+        self.__output.append(f'<?{data}>')
+
+    def unknown_decl(self, data):
+        self.__flush_text()
+        if data.upper().startswith('CDATA['):
+            self.__output.append(f'<![CDATA[{data[len("CDATA["):]}]]>')
+        else:
+            self.__output.append(f'<?{data}?>')
+
+
 class UriLoader():
-    def __init__(self, uri, config, head = False, redirects = True):
+    TIMEOUT = 60                    # Seconds to wait for the server before giving up
+    CHUNK_SIZE = 256 * 1024         # Bytes written to disk at a time when downloading to a file
+    http_cache = None               # Shared HttpCache (see lib/http_cache.py), set up by the Processor
+    rate_controller = None          # Shared AdaptiveRateController (see lib/network.py), set up by the Processor
+    # Content-Type subtypes whose usual file extension is something else.
+    MIME_EXTENSIONS = { 'jpeg': 'jpg', 'pjpeg': 'jpg', 'svg+xml': 'svg', 'x-icon': 'ico',
+                        'vnd.microsoft.icon': 'ico', 'quicktime': 'mov' }
+    
+    def __init__(self, uri, config, head = False, redirects = True, session = None, user_agent = None):
         self.uri = uri
         self.data = None
-        self.user_agent = config.user_agent
+        self.user_agent = user_agent if user_agent else config.user_agent
         self.success = False
+        self.error = None
         self.head = head
         self.redirects = redirects
+        self.session = session      # Pass in a requests.Session to reuse its connections
+        self.filename = None
+        self.length = None          # Set by probe()
+        self.header = None
         
     def __enter__(self):
         self.load()
@@ -75,20 +267,211 @@ class UriLoader():
         
     def load(self):
         headers = {'User-Agent': self.user_agent}
+        http = self.session if self.session else requests
+        cache = UriLoader.http_cache
+        entry = None
+        if cache:
+            entry = cache.lookup(self.uri) if not self.head else None
+            if entry and cache.is_fresh(entry):
+                self.data = cache.response(self.uri, entry)
+                self.success = True
+                return
+            if cache.offline:
+                self.success = False
+                self.error = 'Not cached (offline)'
+                return
+            if entry:
+                headers.update(cache.conditional_headers(entry))
         try:
-            if self.head:
-                self.data = requests.head(self.uri, headers=headers, allow_redirects=self.redirects)
-            else:
-                self.data = requests.get(self.uri, headers=headers, allow_redirects=self.redirects)
+            self.data = self.__request(http, 'HEAD' if self.head else 'GET', headers)
+            if entry and self.data.status_code == 304:
+                self.data = cache.response(self.uri, entry, revalidated=True)
+            elif cache and not self.head and self.data.status_code == 200:
+                cache.store_data(self.uri, self.data, self.data.content)
             if self.redirects:
                 self.success = self.data.status_code == 200
             else:
                 #print(f"HEAD: {self.data.headers}")
                 self.success = self.data.status_code in [200, 301, 302]
+            if not self.success:
+                self.error = f'HTTP {self.data.status_code}'
         except Exception as err:
             print(f"FAIL. Original URL of {self.uri} because of exception: {err}")
             self.success = False
+            self.error = type(err).__name__
     
+    # Downloads straight to a file, a chunk at a time, rather than holding it all in memory. The data goes
+    # to a '.part' file, which is only renamed to filename once it's complete. If an earlier download was
+    # interrupted, we ask the server for just the rest of the file. (Servers that can't do that send
+    # the whole file again, in which case we start over.) Returns whether it worked.
+    #
+    # The ETag (or failing that, the Last-Modified date) of the file goes in a '.part.validator' file
+    # alongside, and is sent back as If-Range, so if the file has changed since, the server sends all of
+    # the new one rather than the rest of the old one. A part file we can't check that way is thrown away.
+    def download(self, filename):
+        headers = {'User-Agent': self.user_agent}
+        http = self.session if self.session else requests
+        part_filename = filename + '.part'
+        validator_filename = part_filename + '.validator'
+        resume_from = 0
+        validator = None
+        if os.path.exists(part_filename):
+            if os.path.exists(validator_filename):
+                with open(validator_filename, 'r', encoding='utf8') as f:
+                    validator = f.read().strip()
+            if validator:
+                resume_from = os.path.getsize(part_filename)
+            else:
+                os.remove(part_filename)
+        cache = UriLoader.http_cache
+        entry = cache.lookup(self.uri) if cache else None
+        if entry and cache.is_fresh(entry):
+            cache.copy_body(self.uri, filename)
+            self.data = cache.response(self.uri, entry)
+            self.filename = filename
+            self.success = True
+            return True
+        if cache and cache.offline:
+            self.success = False
+            self.error = 'Not cached (offline)'
+            return False
+        if resume_from > 0:
+            headers['Range'] = f'bytes={resume_from}-'
+            headers['If-Range'] = validator
+        elif entry:
+            headers.update(cache.conditional_headers(entry))
+        try:
+            with self.__request(http, 'GET', headers, stream=True) as response:
+                self.data = response
+                if entry and response.status_code == 304:
+                    cache.copy_body(self.uri, filename)
+                    self.data = cache.response(self.uri, entry, revalidated=True)
+                    self.filename = filename
+                    self.success = True
+                    return True
+                if response.status_code == 416:
+                    # The part file is no good for this range (most likely the file has changed), so
+                    # throw it away. The next attempt will start from scratch.
+                    UriLoader.__discard_part(part_filename)
+                    self.success = False
+                    self.error = 'HTTP 416'
+                    return False
+                if response.status_code == 206 and resume_from > 0:
+                    if not response.headers.get('Content-Range', '').startswith(f'bytes {resume_from}-'):
+                        UriLoader.__discard_part(part_filename)
+                        self.success = False
+                        self.error = 'Bad Content-Range'
+                        return False
+                    mode = 'ab'
+                elif response.status_code == 200:
+                    mode = 'wb'
+                    validator = UriLoader.__validator(response)
+                    if validator:
+                        with open(validator_filename, 'w', encoding='utf8') as f:
+                            f.write(validator)
+                    elif os.path.exists(validator_filename):
+                        os.remove(validator_filename)
+                else:
+                    self.success = False
+                    self.error = f'HTTP {response.status_code}'
+                    return False
+                with open(part_filename, mode) as f:
+                    for chunk in response.iter_content(chunk_size=UriLoader.CHUNK_SIZE):
+                        f.write(chunk)
+            os.replace(part_filename, filename)
+            if os.path.exists(validator_filename):
+                os.remove(validator_filename)
+            if cache:
+                cache.store_file(self.uri, self.data, filename, status=200)     # (Even if the last of it came in a 206)
+            self.filename = filename
+            self.success = True
+        except Exception as err:
+            print(f"FAIL. Couldn't download {self.uri} because of exception: {err}")
+            self.success = False
+            self.error = type(err).__name__
+        return self.success
+    
+    # What to send as If-Range to resume a download of this response: a strong ETag, or the
+    # Last-Modified date. (Weak ETags can't be used for ranges.)
+    @staticmethod
+    def __validator(response):
+        etag = response.headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            return etag
+        return response.headers.get('Last-Modified')
+
+    @staticmethod
+    def __discard_part(part_filename):
+        for filename in [part_filename, part_filename + '.validator']:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    # Fetches just the start of the file, with a Range request, to find out how big the whole thing is
+    # without downloading it. Servers that ignore the Range header send the whole file, but we stop
+    # reading after the first few bytes and drop the connection. Afterwards, self.length is the full size
+    # in bytes (None if the server didn't say), and self.header the bytes we got. Returns whether it worked.
+    def probe(self, header_size = 65536):
+        headers = {'User-Agent': self.user_agent, 'Range': f'bytes=0-{header_size - 1}'}
+        http = self.session if self.session else requests
+        self.length = None
+        self.header = b''
+        if UriLoader.http_cache and UriLoader.http_cache.offline:
+            self.success = False
+            self.error = 'Not cached (offline)'
+            return False
+        try:
+            with self.__request(http, 'GET', headers, stream=True) as response:
+                self.data = response
+                if response.status_code == 206:
+                    content_range = response.headers.get('Content-Range', '')
+                    if '/' in content_range and content_range.rsplit('/', 1)[1].isdigit():
+                        self.length = int(content_range.rsplit('/', 1)[1])
+                elif response.status_code == 200:
+                    if 'Content-Length' in response.headers:
+                        self.length = int(response.headers['Content-Length'])
+                else:
+                    self.success = False
+                    self.error = f'HTTP {response.status_code}'
+                    return False
+                for chunk in response.iter_content(chunk_size=header_size):
+                    self.header += chunk
+                    if len(self.header) >= header_size:
+                        break
+                self.header = self.header[:header_size]
+            self.success = True
+        except Exception as err:
+            print(f"FAIL. Couldn't probe {self.uri} because of exception: {err}")
+            self.success = False
+            self.error = type(err).__name__
+        return self.success
+
+    # Makes the request once the rate controller lets us, and tells the controller how it went. If the
+    # server says it's overloaded ('429 Too Many Requests', 5xx) or the connection fails, the request is
+    # tried again after the controller's back-off, a few times before we give up.
+    def __request(self, http, method, headers, stream = False):
+        controller = UriLoader.rate_controller
+        attempt = 0
+        while True:
+            if controller:
+                controller.acquire(self.uri)
+            try:
+                response = http.request(method, self.uri, headers=headers, allow_redirects=self.redirects, stream=stream, timeout=UriLoader.TIMEOUT)
+            except (requests.ConnectionError, requests.Timeout):
+                if controller and controller.record(self.uri, None, attempt=attempt):
+                    attempt += 1
+                    continue
+                raise
+            if controller and controller.record(self.uri, response.status_code, response.headers, attempt):
+                response.close()
+                attempt += 1
+                continue
+            return response
+
     # Sometimes the content doesn't have an extension, so we have to guess it from the content-type header.
+    # (eg. 'image/jpeg; charset=binary' gives 'jpg') None if it doesn't say, or it's not an image or a video.
     def guess_ext(self):
-        return self.data.headers['Content-Type'].split('/')[1] if 'Content-Type' in self.data.headers else None
\ No newline at end of file
+        content_type = self.data.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        main_type, slash, sub_type = content_type.partition('/')
+        if main_type not in ('image', 'video') or not sub_type:
+            return None
+        return UriLoader.MIME_EXTENSIONS.get(sub_type, sub_type)
\ No newline at end of file
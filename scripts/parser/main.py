@@ -12,6 +12,7 @@ import glob
 import importlib
 import json
 import logging
+import multiprocessing
 import os
 import re
 import shutil
@@ -28,6 +29,25 @@ import time
 f' Error: This script requires Python 3.6 or later.'
 
 if __name__=='__main__':
+    # Reading the followers/following pages and resizing the images both use worker processes, which need
+    # this in the packaged .exe.
+    multiprocessing.freeze_support()
     processor = Processor('../..')
+    # Housekeeping for the shared media store: `python main.py --gc-media-store [--unlinked]`
+    if '--gc-media-store' in sys.argv:
+        removed = processor.garbage_collect_media_store(unlinked_only = '--unlinked' in sys.argv)
+        if removed is None:
+            print('No media store folder is set in config.json.')
+        else:
+            print(f'Media store tidied up: {removed} files removed.')
+        sys.exit()
+    # Try the downloads that failed in the last conversion again: `python main.py --retry-failed`
+    if '--retry-failed' in sys.argv:
+        result = processor.retry_failed_downloads()
+        if result is None:
+            print('No failed downloads to retry.')
+        else:
+            print(f'Retried failed downloads: {result[0]} fixed, {result[1]} still failing.')
+        sys.exit()
     main_window = MainWindow(processor)
     main_window.show()    
\ No newline at end of file